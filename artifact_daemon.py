@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+"""
+Long-lived artifact server.
+
+One background process owns the artifact HTTP port (80 by default) and
+stays up between operations. Platypus, the multi-unit window, the CLI and
+the SNUC tool ask it over a Unix control socket to serve a directory or a
+file and get back the URL path to hand to the BMC, instead of each binding
+and tearing down a server of their own and fighting over port 80. Each
+registration has its own URL prefix (see ArtifactServer.mount), so two
+callers publishing a fru.bin each get theirs.
+
+Downloads of content-addressed store objects are recorded in the store's
+served log (see artifact_store).
+
+Registrations belong to the control connection that made them and are
+dropped when it closes, so a GUI that crashes does not leave files
+published. Pass persist to keep one until it is unregistered.
+
+Control protocol, one JSON object per line in each direction:
+    {"op": "ping"}                  -> {"ok": true, "pid": ..., "port": ...}
+    {"op": "register", "path": P}   -> {"ok": true, "token": T, "url_path": "/r/T/...", "port": ...}
+    {"op": "unregister", "token": T}
+    {"op": "tftp", "port": 69}      -> {"ok": true, "port": ...}, also serve everything over TFTP
+    {"op": "reserve", "client": IP, "interface": IP, "label": L}
+                                    -> {"ok": true, "waited": s} once a large-transfer slot
+                                       is free; held until the connection closes
+    {"op": "limits", "max_transfers": N, "rate": B, "client_rate": B}
+                                    -> the bandwidth limits after applying any given
+    {"op": "status"}                -> mounts, the latest transfers and the transfer slots
+    {"op": "watch"}                 -> then one {"event": ..., "transfer": {...}} per line
+    {"op": "shutdown"}
+
+Usage:
+    python artifact_daemon.py [--port 80] [--host 0.0.0.0] [--max-transfers 4]
+                              [--rate MBPS] [--client-rate MBPS]    run in the foreground
+    python artifact_daemon.py status
+    python artifact_daemon.py stop
+"""
+
+import argparse
+import json
+import os
+import queue
+import select
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+import artifact_server
+import artifact_store
+
+SOCKET_PATH = os.path.expanduser("~/.local/platypus/artifact-server.sock")
+# Always served; mounts are layered over it
+SERVE_DIR = os.path.expanduser("~/.local/platypus/artifacts")
+DAEMON_LOG = os.path.expanduser("~/.local/platypus/logs/artifact-server.log")
+START_TIMEOUT = 5
+# Idle watch connections are checked for a closed peer this often
+WATCH_POLL = 5
+
+
+class ArtifactDaemonError(Exception):
+    """The daemon could not be reached or refused a request"""
+
+
+# ---------- Daemon ----------
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def _send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        owned = []
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    self._send({"ok": False, "error": "malformed request"})
+                    continue
+                if request.get("op") == "watch":
+                    self._send({"ok": True})
+                    self._watch()
+                    return
+                if request.get("op") == "reserve":
+                    self._reserve(request)
+                    return
+                self._send(self.server.daemon.handle(request, owned))
+        except OSError:
+            pass
+        finally:
+            for token in owned:
+                self.server.daemon.artifacts.unmount(token)
+
+    def _peer_closed(self):
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+
+    def _reserve(self, request):
+        """Waits for a transfer slot, then holds it until the client hangs up"""
+        daemon = self.server.daemon
+        try:
+            reservation = daemon.artifacts.scheduler.reservation(request.get("interface", ""), request["client"],
+                                                                 request.get("label", ""))
+        except KeyError:
+            self._send({"ok": False, "error": "bad reserve request: 'client'"})
+            return
+        watcher = threading.Thread(target=self._release_on_close, args=(reservation,), daemon=True)
+        watcher.start()
+        waited = reservation.wait()
+        if waited is None:
+            return
+        if waited >= 1:
+            daemon.callback_output(f"{reservation.slot.client} got a transfer slot after {waited:.0f}s")
+        try:
+            self._send({"ok": True, "waited": waited})
+        except OSError:
+            reservation.release()
+        watcher.join()
+
+    def _release_on_close(self, reservation):
+        try:
+            while not self._peer_closed():
+                time.sleep(0.2)
+        except OSError:
+            pass
+        reservation.release()
+
+    def _watch(self):
+        events = queue.Queue()
+
+        def forward(event, transfer):
+            events.put((event, transfer))
+
+        artifact_server.transfers.subscribe(forward)
+        try:
+            while True:
+                try:
+                    event, transfer = events.get(timeout=WATCH_POLL)
+                except queue.Empty:
+                    if self._peer_closed():
+                        return
+                    continue
+                self._send({"event": event, "transfer": asdict(transfer)})
+        finally:
+            artifact_server.transfers.unsubscribe(forward)
+
+
+class _ControlServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        super().__init__(path, _ControlHandler)
+        os.chmod(path, 0o600)
+
+
+class ArtifactDaemon:
+    """The artifact HTTP server plus its control socket"""
+
+    def __init__(self, port=80, host="0.0.0.0", socket_path=SOCKET_PATH, callback_output=print, limits=None):
+        self.socket_path = socket_path
+        self.callback_output = callback_output
+        if _alive(socket_path):
+            raise ArtifactDaemonError(f"An artifact daemon is already listening on {socket_path}")
+        os.makedirs(SERVE_DIR, exist_ok=True)
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        self.artifacts = artifact_server.ArtifactServer(SERVE_DIR, port, host, callback_output)
+        self.artifacts.scheduler.configure(**(limits or {}))
+        artifact_server.transfers.subscribe(artifact_store.ServedLog(self.artifacts.resolve))
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.control = _ControlServer(socket_path, self)
+
+    def serve_forever(self):
+        self.artifacts.start()
+        self.callback_output(f"Artifact server on port {self.artifacts.port}, control socket {self.socket_path}")
+        try:
+            self.control.serve_forever()
+        finally:
+            self.artifacts.stop()
+            self.control.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            self.callback_output("Artifact server stopped.")
+
+    def shutdown(self):
+        threading.Thread(target=self.control.shutdown, daemon=True).start()
+
+    def handle(self, request, owned):
+        op = request.get("op")
+        try:
+            if op == "ping":
+                return {"ok": True, "pid": os.getpid(), "port": self.artifacts.port}
+            if op == "register":
+                path = os.path.abspath(request["path"])
+                if not os.path.exists(path):
+                    return {"ok": False, "error": f"{path} does not exist"}
+                token = self.artifacts.mount(path)
+                if not request.get("persist"):
+                    owned.append(token)
+                url_path = self.artifacts.url_path(token)
+                self.callback_output(f"Serving {path} at {url_path}")
+                return {"ok": True, "token": token, "url_path": url_path, "port": self.artifacts.port}
+            if op == "unregister":
+                token = request["token"]
+                if token in owned:
+                    owned.remove(token)
+                return {"ok": self.artifacts.unmount(token)}
+            if op == "tftp":
+                try:
+                    port = self.artifacts.start_tftp(request.get("port", 69))
+                except OSError as e:
+                    return {"ok": False, "error": f"Cannot serve TFTP: {e}"}
+                self.callback_output(f"Serving TFTP on port {port}")
+                return {"ok": True, "port": port}
+            if op == "limits":
+                limits = self.artifacts.scheduler.configure(request.get("max_transfers"), request.get("rate"),
+                                                            request.get("client_rate"))
+                return {"ok": True, **limits}
+            if op == "status":
+                return {"ok": True, "pid": os.getpid(), "port": self.artifacts.port,
+                        "mounts": [{"token": t, "path": p} for t, p in self.artifacts.mounts()],
+                        "transfers": [asdict(t) for t in artifact_server.transfers.snapshot()],
+                        "limits": self.artifacts.scheduler.limits(),
+                        "slots": self.artifacts.scheduler.snapshot()}
+            if op == "shutdown":
+                self.shutdown()
+                return {"ok": True}
+            return {"ok": False, "error": f"unknown op {op!r}"}
+        except (KeyError, TypeError) as e:
+            return {"ok": False, "error": f"bad {op} request: {e}"}
+
+
+def _alive(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+# ---------- Client ----------
+
+class DaemonClient:
+    """A control connection. Registrations made through it last as long as it does."""
+
+    def __init__(self, socket_path=SOCKET_PATH, timeout=10):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(socket_path)
+        except OSError:
+            self.sock.close()
+            raise
+        self._file = self.sock.makefile("rwb")
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def request(self, op, **fields):
+        with self._lock:
+            try:
+                self._file.write(json.dumps({"op": op, **fields}).encode() + b"\n")
+                self._file.flush()
+                line = self._file.readline()
+            except OSError as e:
+                self.close()
+                raise ArtifactDaemonError(f"Lost the artifact daemon: {e}")
+        if not line:
+            self.close()
+            raise ArtifactDaemonError("The artifact daemon closed the connection")
+        reply = json.loads(line)
+        if not reply.get("ok"):
+            raise ArtifactDaemonError(reply.get("error") or f"{op} failed")
+        return reply
+
+    def close(self):
+        self.closed = True
+        try:
+            self._file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+@dataclass
+class Registration:
+    """A path published on the daemon"""
+    path: str
+    token: int
+    url_path: str
+    port: int
+
+    def url(self, host):
+        """URL of the registered file, or of the root for a directory, as seen from host"""
+        port = "" if self.port == 80 else f":{self.port}"
+        return f"http://{host}{port}{self.url_path}"
+
+    def stop(self):
+        unregister(self)
+
+
+_client = None
+_client_lock = threading.Lock()
+_relay = None
+
+
+def start_daemon(port=80, host="0.0.0.0", timeout=START_TIMEOUT):
+    """Starts the daemon in the background and waits until it answers"""
+    os.makedirs(os.path.dirname(DAEMON_LOG), exist_ok=True)
+    with open(DAEMON_LOG, "ab") as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "--port", str(port), "--host", host],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                         start_new_session=True, close_fds=True)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # Another process may win the race to start it; any daemon that answers will do
+        if _alive(SOCKET_PATH):
+            return
+        time.sleep(0.05)
+    raise ArtifactDaemonError(f"Artifact daemon did not start: {_log_tail()}")
+
+
+def _log_tail(lines=3):
+    try:
+        with open(DAEMON_LOG, "r", errors="replace") as f:
+            return " | ".join(f.read().strip().splitlines()[-lines:])
+    except OSError:
+        return "no log"
+
+
+def _relay_events():
+    """Republishes the daemon's transfer events in this process (see bmc.TransferProgress)"""
+    try:
+        watcher = DaemonClient(timeout=None)
+        watcher.request("watch")
+        for line in watcher._file:
+            message = json.loads(line)
+            artifact_server.transfers.publish(message["event"],
+                                              artifact_server.Transfer(**message["transfer"]))
+    except (OSError, ValueError, ArtifactDaemonError):
+        pass
+
+
+def client(port=80):
+    """This process's control connection, starting the daemon if nothing answers"""
+    global _client, _relay
+    with _client_lock:
+        if _client is None or _client.closed:
+            try:
+                _client = DaemonClient()
+            except OSError:
+                start_daemon(port)
+                _client = DaemonClient()
+        if _relay is None or not _relay.is_alive():
+            _relay = threading.Thread(target=_relay_events, name="artifact-events", daemon=True)
+            _relay.start()
+        return _client
+
+
+def register(path, port=80, persist=False):
+    """Publishes a directory (at /r/<token>/) or a file (at /r/<token>/<name>) and returns its Registration"""
+    connection = client(port)
+    try:
+        reply = connection.request("register", path=path, persist=persist)
+    except ArtifactDaemonError:
+        if not connection.closed:
+            raise
+        # The daemon went away since the last request; start or reach a new one
+        reply = client(port).request("register", path=path, persist=persist)
+    return Registration(os.path.abspath(path), reply["token"], reply["url_path"], reply["port"])
+
+
+def start_tftp(port=69):
+    """Has the daemon serve its registrations over TFTP as well; returns the TFTP port"""
+    return client().request("tftp", port=port)["port"]
+
+
+class DaemonReservation:
+    """
+    A transfer slot on the daemon for one BMC's downloads (see
+    artifact_server.Reservation), held by a control connection of its own.
+    """
+
+    def __init__(self, client_ip, interface="", label="", port=80):
+        client(port)        # make sure a daemon is running
+        self.request = {"client": client_ip, "interface": interface, "label": label}
+        self.connection = DaemonClient(timeout=None)
+
+    def wait(self):
+        """Blocks until the slot is granted; returns the seconds waited, or None if released first"""
+        try:
+            return self.connection.request("reserve", **self.request)["waited"]
+        except ArtifactDaemonError:
+            if self.connection.closed:
+                return None
+            raise
+
+    def release(self):
+        try:
+            self.connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+def limits(**changes):
+    """Reads, or with max_transfers/rate/client_rate (bytes per second) changes, the bandwidth limits"""
+    reply = client().request("limits", **changes)
+    return {key: reply[key] for key in ("max_transfers", "rate", "client_rate")}
+
+
+def unregister(registration):
+    with _client_lock:
+        current = _client
+    if current is None or current.closed:
+        return
+    try:
+        current.request("unregister", token=registration.token)
+    except ArtifactDaemonError:
+        pass
+
+
+def _request_running(op, **fields):
+    """One request to an already running daemon, without starting one"""
+    try:
+        connection = DaemonClient()
+    except OSError:
+        raise ArtifactDaemonError("not running")
+    try:
+        return connection.request(op, **fields)
+    finally:
+        connection.close()
+
+
+def status():
+    return _request_running("status")
+
+
+def withdraw(token):
+    """Unregisters by token, e.g. a persistent registration made by another process"""
+    _request_running("unregister", token=token)
+
+
+def stop_daemon():
+    """Asks a running daemon to exit. Returns False if none was running."""
+    try:
+        _request_running("shutdown")
+        return True
+    except ArtifactDaemonError:
+        return False
+
+
+def describe_status(reply):
+    """Human-readable form of a status reply"""
+    lines = [f"pid {reply['pid']}, port {reply['port']}"]
+    lines += [f"  [{mount['token']}] {mount['path']}" for mount in reply["mounts"]]
+    lines += [f"  {artifact_server.Transfer(**transfer).describe()} ({transfer['state']})"
+              for transfer in reply["transfers"]]
+    limits = reply.get("limits")
+    if limits:
+        lines.append(f"  limits: {describe_limits(limits)}")
+    for interface, slots in reply.get("slots", {}).items():
+        holding = ", ".join(slot["client"] for slot in slots["holding"]) or "-"
+        waiting = ", ".join(slot["client"] for slot in slots["waiting"]) or "-"
+        lines.append(f"  {interface or '*'}: sending to {holding}; waiting: {waiting}")
+    return "\n".join(lines)
+
+
+def describe_limits(limits):
+    mb = 1024 * 1024
+
+    def rate(value):
+        return f"{value / mb:.1f} MB/s" if value else "unlimited"
+
+    return (f"{limits['max_transfers'] or 'unlimited'} large transfers per interface, "
+            f"{rate(limits['rate'])} per interface, {rate(limits['client_rate'])} per client")
+
+
+def _daemon_log(message):
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Platypus artifact server daemon")
+    parser.add_argument("command", nargs="?", choices=("run", "status", "stop"), default="run")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--max-transfers", type=int, default=artifact_server.MAX_LARGE_TRANSFERS,
+                        help="concurrent large downloads per interface, 0 = no cap")
+    parser.add_argument("--rate", type=float, default=0, help="MB/s per interface shared fairly, 0 = unlimited")
+    parser.add_argument("--client-rate", type=float, default=0, help="MB/s per client, 0 = unlimited")
+    args = parser.parse_args()
+
+    if args.command == "stop":
+        print("Stopped." if stop_daemon() else "No artifact daemon running.")
+        return
+    if args.command == "status":
+        try:
+            print(describe_status(status()))
+        except ArtifactDaemonError:
+            print("No artifact daemon running.")
+            sys.exit(1)
+        return
+
+    try:
+        limits = {"max_transfers": args.max_transfers, "rate": int(args.rate * 1024 * 1024),
+                  "client_rate": int(args.client_rate * 1024 * 1024)}
+        daemon = ArtifactDaemon(args.port, args.host, callback_output=_daemon_log, limits=limits)
+    except (OSError, ArtifactDaemonError) as e:
+        _daemon_log(f"Cannot start artifact server: {e}")
+        sys.exit(1)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
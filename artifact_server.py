@@ -0,0 +1,683 @@
+"""
+HTTP server for flash artifacts.
+
+BMCs pull restore images, bmaps, FIPs and FRU blobs from the host with curl
+or U-Boot wget. Every connection is handled on its own thread, file bodies
+go out with sendfile so the payload never passes through Python, and
+connections stay open between requests (HTTP/1.1 keep-alive). URLs are the
+same as with SimpleHTTPRequestHandler: http://<host>:<port>/<path relative
+to the served directory>.
+
+Single byte ranges are honoured (206 Partial Content), so a download that
+stalls can be resumed with curl -C - instead of starting over.
+
+Files that are objects of the content-addressed store (artifact_store)
+carry their SHA-256 in an X-Checksum-Sha256 header.
+
+Paths mounted next to the served directory (see ArtifactServer.mount)
+are each served under their own prefix, /r/<token>/<name>, so callers
+publishing files of the same name from different releases each get
+their own. A mounted name is also served at the URL root, but only while
+no other mount publishes that name with different content.
+
+The same files can also be offered over TFTP (see start_tftp and
+tftp_server) for U-Boot's tftpboot.
+
+Every file body sent is tracked as a Transfer (client IP, path, bytes,
+throughput, ETA) in the module-level TransferLog, which publishes start,
+progress and end events to its subscribers. Flows use them to drive real
+progress bars.
+
+Large downloads (restore images) go through the server's
+BandwidthScheduler: at most max_transfers of them send at once on each
+host interface and the rest wait in a FIFO queue, so thirty units
+starting curl together do not starve each other into timeouts. An
+interface rate limit is split evenly between the large transfers sending
+on it, and a per-client cap can be set as well. Flows reserve a slot for
+their BMC before starting curl (see reservation), so they wait their turn
+on the host instead of inside curl's stall timeout.
+"""
+
+import io
+import itertools
+import os
+import posixpath
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import quote, unquote, urlsplit
+
+from artifact_store import object_digest
+
+# Idle keep-alive connections are dropped after this many seconds
+IDLE_TIMEOUT = 60
+# File bodies go out in sendfile calls of this size so progress can be reported
+SENDFILE_CHUNK = 1024 * 1024
+# Progress events are published at most this often per transfer
+PROGRESS_INTERVAL = 0.25
+# Downloads at least this big count against the per-interface transfer cap
+LARGE_TRANSFER = 16 * 1024 * 1024
+MAX_LARGE_TRANSFERS = 4
+# First path segment of a mount's own URL prefix, /r/<token>/
+MOUNT_PREFIX = "r"
+# Rate-limited transfers send about this many seconds' worth per sendfile call
+PACE_INTERVAL = 0.1
+MIN_PACED_CHUNK = 64 * 1024
+
+# Transfer events
+QUEUED = "queued"
+STARTED = "started"
+PROGRESS = "progress"
+FINISHED = "finished"
+FAILED = "failed"
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    """
+    Parses a Range header against a file of size bytes. Returns (offset,
+    length), None to serve the whole file (no header, several ranges or a
+    malformed one) or False when the range cannot be satisfied.
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last n bytes
+        length = min(int(last), size)
+        return (size - length, length) if length else False
+    first = int(first)
+    last = size - 1 if last == "" else min(int(last), size - 1)
+    if first >= size or last < first:
+        return False
+    return first, last - first + 1
+
+
+@dataclass
+class Transfer:
+    """One file body being sent to a client"""
+    client: str
+    path: str
+    total: int                  # size of the whole file
+    offset: int = 0             # first byte sent, non-zero for resumed downloads
+    length: int = 0             # bytes this response carries
+    sent: int = 0
+    started: float = field(default_factory=time.monotonic)
+    updated: float = 0.0
+    state: str = STARTED
+
+    @property
+    def done(self):
+        """Bytes of the file the client has, counting a resumed prefix"""
+        return self.offset + self.sent
+
+    @property
+    def fraction(self):
+        return self.done / self.total if self.total else 1.0
+
+    @property
+    def elapsed(self):
+        return (self.updated or time.monotonic()) - self.started
+
+    @property
+    def throughput(self):
+        """Bytes per second over this response"""
+        elapsed = self.elapsed
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds left at the current throughput, None until there is a rate"""
+        if self.state in (FINISHED, FAILED):
+            return 0.0
+        rate = self.throughput
+        return (self.length - self.sent) / rate if rate > 0 else None
+
+    def describe(self):
+        mb = 1024 * 1024
+        text = f"{self.client} {self.path}: {self.done / mb:.1f}/{self.total / mb:.1f} MB, {self.throughput / mb:.1f} MB/s"
+        eta = self.eta
+        if self.state in (STARTED, PROGRESS) and eta is not None:
+            text += f", {eta:.0f}s left"
+        elif self.state == QUEUED:
+            text += ", waiting for a transfer slot"
+        return text
+
+
+class TransferLog:
+    """
+    Latest transfer per (client IP, path). Subscribers are called as
+    callback(event, transfer) on the server thread sending the file, so they
+    must be quick and hand off to their own thread or loop.
+    """
+
+    def __init__(self):
+        self._transfers = {}
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s != callback]
+
+    def get(self, client, path):
+        with self._lock:
+            return self._transfers.get((client, path))
+
+    def active(self):
+        """Transfers still in progress"""
+        with self._lock:
+            return [t for t in self._transfers.values() if t.state in (QUEUED, STARTED, PROGRESS)]
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._transfers.values())
+
+    def publish(self, event, transfer):
+        with self._lock:
+            self._transfers[(transfer.client, transfer.path)] = transfer
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event, transfer)
+            except Exception:
+                pass
+
+    def queue(self, transfer):
+        transfer.state = QUEUED
+        self.publish(QUEUED, transfer)
+
+    def begin(self, transfer):
+        transfer.started = transfer.updated = time.monotonic()
+        transfer.state = STARTED
+        self.publish(STARTED, transfer)
+
+    def advance(self, transfer, sent):
+        transfer.sent += sent
+        now = time.monotonic()
+        if now - transfer.updated >= PROGRESS_INTERVAL:
+            transfer.updated = now
+            transfer.state = PROGRESS
+            self.publish(PROGRESS, transfer)
+
+    def end(self, transfer):
+        transfer.updated = time.monotonic()
+        transfer.state = FINISHED if transfer.sent >= transfer.length else FAILED
+        self.publish(transfer.state, transfer)
+
+
+transfers = TransferLog()
+
+
+@dataclass
+class Slot:
+    """A place among an interface's concurrent large transfers, held or waited for"""
+    interface: str
+    client: str
+    label: str = ""
+    reserved: bool = False
+    queued: float = field(default_factory=time.monotonic)
+    granted: Optional[float] = None
+    cancelled: bool = False
+    claimed: str = ""           # address the reserved downloads actually came from
+
+    @property
+    def waited(self):
+        return (self.granted or time.monotonic()) - self.queued
+
+
+class Lane:
+    """Pacing for one download admitted by a BandwidthScheduler"""
+
+    def __init__(self, scheduler, interface, client, large):
+        self.scheduler = scheduler
+        self.interface = interface
+        self.client = client
+        self.large = large
+        self._next = None
+
+    def chunk(self):
+        """How much to hand sendfile next"""
+        rate = self.scheduler.share(self)
+        if not rate:
+            return SENDFILE_CHUNK
+        return max(MIN_PACED_CHUNK, min(SENDFILE_CHUNK, int(rate * PACE_INTERVAL)))
+
+    def pace(self, sent):
+        """Sleeps as long as sending sent bytes takes at this lane's share of the bandwidth"""
+        rate = self.scheduler.share(self)
+        if not rate:
+            self._next = None
+            return
+        now = time.monotonic()
+        self._next = max(self._next or now, now) + sent / rate
+        if self._next > now:
+            time.sleep(self._next - now)
+
+
+class Reservation:
+    """
+    A slot held for a client ahead of its download (see
+    BandwidthScheduler.reservation). Its requests skip the queue while it is
+    held. release() also abandons a wait() in progress.
+    """
+
+    def __init__(self, scheduler, slot):
+        self.scheduler = scheduler
+        self.slot = slot
+
+    def wait(self):
+        """Blocks until the slot is granted; returns the seconds waited, or None if released first"""
+        return self.slot.waited if self.scheduler.acquire(self.slot) else None
+
+    def release(self):
+        self.scheduler.release(self.slot)
+
+
+class BandwidthScheduler:
+    """
+    Admission and fair sharing for downloads. Limits are in bytes per
+    second, 0 meaning unlimited; max_transfers caps concurrent large
+    transfers per interface (local address the client connected to).
+    """
+
+    def __init__(self, max_transfers=MAX_LARGE_TRANSFERS, rate=0, client_rate=0):
+        self.max_transfers = max_transfers
+        self.rate = rate
+        self.client_rate = client_rate
+        self._cond = threading.Condition()
+        self._waiting = {}      # interface -> [Slot], oldest first
+        self._holding = {}      # interface -> [Slot]
+        self._reserved = {}     # client -> Slot
+        self._sending = {}      # interface -> large transfers sending
+
+    def configure(self, max_transfers=None, rate=None, client_rate=None):
+        with self._cond:
+            if max_transfers is not None:
+                self.max_transfers = max_transfers
+            if rate is not None:
+                self.rate = rate
+            if client_rate is not None:
+                self.client_rate = client_rate
+            self._cond.notify_all()
+        return self.limits()
+
+    def limits(self):
+        return {"max_transfers": self.max_transfers, "rate": self.rate, "client_rate": self.client_rate}
+
+    def _grant(self, slot):
+        queue = self._waiting[slot.interface]
+        holders = self._holding.setdefault(slot.interface, [])
+        if queue[0] is not slot or (self.max_transfers and len(holders) >= self.max_transfers):
+            return False
+        holders.append(slot)
+        slot.granted = time.monotonic()
+        if slot.reserved:
+            self._reserved[slot.client] = slot
+        return True
+
+    def acquire(self, slot, on_wait=None):
+        """Queues slot and blocks until it is granted (True) or released (False)"""
+        with self._cond:
+            queue = self._waiting.setdefault(slot.interface, [])
+            queue.append(slot)
+            granted = self._grant(slot)
+        if not granted and on_wait:
+            on_wait()
+        with self._cond:
+            try:
+                while not granted and not slot.cancelled:
+                    self._cond.wait(1.0)
+                    granted = self._grant(slot)
+            finally:
+                queue.remove(slot)
+                self._cond.notify_all()
+        return granted
+
+    def release(self, slot):
+        with self._cond:
+            slot.cancelled = True
+            holders = self._holding.get(slot.interface, [])
+            if slot in holders:
+                holders.remove(slot)
+            if self._reserved.get(slot.client) is slot:
+                del self._reserved[slot.client]
+            self._cond.notify_all()
+
+    def reservation(self, interface, client, label=""):
+        """A Reservation for client's downloads through interface; call wait() to queue for it"""
+        return Reservation(self, Slot(interface, client, label, reserved=True))
+
+    def _claim(self, interface, client, label):
+        """
+        The reservation a request belongs to: the client's own, else one on
+        the interface for the same file that no other address has claimed
+        (the BMC reaches the host through NAT, or the IP given was wrong).
+        """
+        reserved = self._reserved.get(client)
+        if reserved is None:
+            for slot in self._holding.get(interface, []):
+                if slot.reserved and slot.label == label and slot.claimed in ("", client):
+                    reserved = slot
+                    break
+        if reserved is not None:
+            reserved.claimed = client
+        return reserved
+
+    @contextmanager
+    def admit(self, interface, client, size, label="", on_wait=None):
+        """
+        Admits a download of size bytes, waiting for a slot if it is large
+        and not covered by a reservation, and yields its Lane.
+        """
+        large = size >= LARGE_TRANSFER
+        slot = None
+        if large:
+            with self._cond:
+                reserved = self._claim(interface, client, label)
+            if reserved is not None:
+                interface = reserved.interface
+            else:
+                slot = Slot(interface, client)
+                self.acquire(slot, on_wait)
+        lane = Lane(self, interface, client, large)
+        with self._cond:
+            if large:
+                self._sending[interface] = self._sending.get(interface, 0) + 1
+        try:
+            yield lane
+        finally:
+            with self._cond:
+                if large:
+                    self._sending[interface] -= 1
+            if slot is not None:
+                self.release(slot)
+
+    def share(self, lane):
+        """Bytes per second lane may send now, 0 for unlimited"""
+        with self._cond:
+            rates = []
+            if self.rate and lane.large:
+                rates.append(self.rate / max(1, self._sending.get(lane.interface, 1)))
+            if self.client_rate:
+                rates.append(self.client_rate)
+        return min(rates) if rates else 0
+
+    def snapshot(self):
+        """{interface: {"holding": [Slot dicts], "waiting": [Slot dicts]}}"""
+        with self._cond:
+            interfaces = set(self._holding) | set(self._waiting)
+            return {interface: {"holding": [asdict(s) for s in self._holding.get(interface, [])],
+                                "waiting": [asdict(s) for s in self._waiting.get(interface, [])]}
+                    for interface in sorted(interfaces)
+                    if self._holding.get(interface) or self._waiting.get(interface)}
+
+
+class ArtifactRequestHandler(SimpleHTTPRequestHandler):
+    """SimpleHTTPRequestHandler that serves server.directory with keep-alive and sendfile"""
+
+    protocol_version = "HTTP/1.1"
+    timeout = IDLE_TIMEOUT
+
+    def __init__(self, request, client_address, server):
+        super().__init__(request, client_address, server, directory=server.directory)
+
+    def translate_path(self, path):
+        resolved = self.server.resolve(path)
+        # "" (a name mounts publish with different content) opens nothing: 404
+        return super().translate_path(path) if resolved is None else resolved
+
+    def send_head(self):
+        self.byte_range = None
+        self.file_size = 0
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or path.endswith("/"):
+            return super().send_head()
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        try:
+            fs = os.fstat(f.fileno())
+            size = self.file_size = fs.st_size
+            last_modified = self.date_time_string(fs.st_mtime)
+            byte_range = None
+            if self.headers.get("If-Range", last_modified) == last_modified:
+                byte_range = parse_range(self.headers.get("Range"), size)
+
+            if byte_range is False:
+                f.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+
+            if byte_range is None:
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-Length", str(size))
+            else:
+                offset, length = byte_range
+                self.byte_range = byte_range
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-Range", f"bytes {offset}-{offset + length - 1}/{size}")
+                self.send_header("Content-Length", str(length))
+            self.send_header("Content-type", self.guess_type(path))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Last-Modified", last_modified)
+            digest = object_digest(path)
+            if digest:
+                self.send_header("X-Checksum-Sha256", digest)
+            self.end_headers()
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def copyfile(self, source, outputfile):
+        try:
+            source.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            # Directory listings are built in memory
+            return super().copyfile(source, outputfile)
+        offset, length = self.byte_range or (0, self.file_size)
+        outputfile.flush()
+        client = self.client_address[0]
+        transfer = Transfer(client, unquote(urlsplit(self.path).path), self.file_size, offset, length)
+        interface = self.connection.getsockname()[0]
+        with self.server.scheduler.admit(interface, client, length, posixpath.basename(transfer.path),
+                                         lambda: transfers.queue(transfer)) as lane:
+            transfers.begin(transfer)
+            try:
+                while transfer.sent < length:
+                    sent = self.connection.sendfile(source, offset + transfer.sent,
+                                                    min(lane.chunk(), length - transfer.sent))
+                    if not sent:
+                        break
+                    transfers.advance(transfer, sent)
+                    lane.pace(sent)
+            finally:
+                transfers.end(transfer)
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+    def log_error(self, format, *args):
+        self.server.log(f"HTTP {self.client_address[0]}: {format % args}")
+
+
+class ArtifactServer(ThreadingHTTPServer):
+    """
+    Threaded artifact server for one directory. Further directories or
+    single files can be mounted at the URL root while it runs (see mount),
+    which is how the artifact daemon serves several callers from one port.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def __init__(self, directory, port=80, host="0.0.0.0", callback_output=None):
+        self.directory = os.path.abspath(directory)
+        self.callback_output = callback_output
+        self._thread = None
+        self.tftp = None
+        self.scheduler = BandwidthScheduler()
+        self._mounts = {}
+        self._tokens = itertools.count(1)
+        self._mount_lock = threading.Lock()
+        super().__init__((host, port), ArtifactRequestHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def log(self, message):
+        if self.callback_output:
+            self.callback_output(message)
+
+    def mount(self, path):
+        """
+        Serves a directory's contents, or a single file, under its own
+        prefix (see url_path) and at the URL root next to the served
+        directory. Names another mount already publishes with different
+        content are logged and no longer served at the root. Returns a
+        token for unmount.
+        """
+        path = os.path.abspath(path)
+        with self._mount_lock:
+            token = next(self._tokens)
+            others = list(self._mounts.values())
+            self._mounts[token] = path
+        names = os.listdir(path) if os.path.isdir(path) else [os.path.basename(path)]
+        clashes = sorted(name for name in names
+                         if any(_differs(_mounted(path, [name]), _mounted(other, [name])) for other in others))
+        if clashes:
+            self.log(f"{', '.join(clashes)} also published with different content; serving them only "
+                     f"under each mount's own prefix ({self.url_path(token)} for {path})")
+        return token
+
+    def unmount(self, token):
+        with self._mount_lock:
+            return self._mounts.pop(token, None) is not None
+
+    def mounts(self):
+        """[(token, path)], oldest first"""
+        with self._mount_lock:
+            return list(self._mounts.items())
+
+    def url_path(self, token):
+        """URL path of a mount: /r/<token>/ for a directory, /r/<token>/<name> for a file"""
+        with self._mount_lock:
+            path = self._mounts[token]
+        prefix = f"/{MOUNT_PREFIX}/{token}/"
+        return prefix if os.path.isdir(path) else prefix + quote(os.path.basename(path))
+
+    def resolve(self, url_path):
+        """
+        File a URL path maps to through the mounts, "" if the name is
+        published at the root with conflicting content, or None to use the
+        served directory
+        """
+        path = posixpath.normpath(unquote(urlsplit(url_path).path))
+        words = [word for word in path.split("/") if word not in ("", os.curdir, os.pardir)]
+        if not words:
+            return None
+        mounts = dict(self.mounts())
+        if len(words) > 2 and words[0] == MOUNT_PREFIX and words[1].isdigit():
+            root = mounts.get(int(words[1]))
+            return _mounted(root, words[2:]) if root else None
+        found = [candidate for candidate in (_mounted(root, words) for root in reversed(mounts.values()))
+                 if candidate]
+        if any(_differs(found[0], candidate) for candidate in found[1:]):
+            return ""
+        return found[0] if found else None
+
+    def locate(self, url_path):
+        """File a URL path maps to, through the mounts or under the served directory, or None"""
+        path = self.resolve(url_path)
+        if path is None:
+            path = os.path.normpath(os.path.join(self.directory, unquote(url_path).lstrip("/")))
+            if not path.startswith(self.directory + os.sep):
+                return None
+        return path if os.path.isfile(path) else None
+
+    def start_tftp(self, port=69):
+        """Serves the same files over TFTP (for U-Boot tftpboot); returns the TFTP port"""
+        if self.tftp is None:
+            from tftp_server import TftpServer
+            self.tftp = TftpServer(self.locate, port, self.server_address[0], self.callback_output).start()
+        return self.tftp.port
+
+    def server_bind(self):
+        super().server_bind()
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def url(self, path, host):
+        """URL of a file under the served directory as seen from host"""
+        relative = os.path.relpath(os.path.abspath(os.path.join(self.directory, path)), self.directory)
+        port = "" if self.port == 80 else f":{self.port}"
+        return f"http://{host}{port}/{quote(relative.replace(os.sep, '/'))}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=f"artifact-server-{self.port}",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.tftp is not None:
+            self.tftp.stop()
+        self.shutdown()
+        self.server_close()
+
+
+def _mounted(root, words):
+    """File words name under a mounted directory or single file, or None"""
+    if os.path.isdir(root):
+        candidate = os.path.join(root, *words)
+    elif words == [os.path.basename(root)]:
+        candidate = root
+    else:
+        return None
+    return candidate if os.path.exists(candidate) else None
+
+
+def _differs(path, other):
+    """Both exist and are not the same content (store links to one object are the same)"""
+    return bool(path and other) and os.path.realpath(path) != os.path.realpath(other)
+
+
+@dataclass
+class Mount:
+    """A path mounted on a running ArtifactServer, see ArtifactServer.mount"""
+    server: ArtifactServer
+    token: int
+
+    @property
+    def url_path(self):
+        return self.server.url_path(self.token)
+
+    def stop(self):
+        self.server.unmount(self.token)
+
+
+def serve(directory, port=80, callback_output=None, host="0.0.0.0"):
+    """Starts an ArtifactServer for directory in the background and returns it"""
+    return ArtifactServer(directory, port, host, callback_output).start()
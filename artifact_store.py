@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Content-addressed store for flash artifacts.
+
+Restore images, bmaps, rescue images, FIPs and FRU blobs are imported once
+into ~/.local/platypus/store: the file is copied while its SHA-256 is
+computed in the same streaming pass and kept as objects/<sha256>. An index
+remembers each source file's size and mtime, so importing it again on the
+next run is a stat, not a re-hash. The digest is then available to
+on-BMC verification without touching the image.
+
+stage(path) builds a view directory of links named like the source
+files (artifacts point into the store, anything else at the original) that
+the artifact server publishes in place of the operator's directory.
+Objects are served with sendfile straight from the page cache; the server
+sends the digest of a store object as X-Checksum-Sha256.
+
+Every finished transfer of a store object is appended to served.jsonl
+(time, client IP, name, digest), so there is a record of what each unit
+was given.
+
+Nothing is removed on its own: prune deletes the views not staged for
+PRUNE_DAYS, then every object neither linked from a remaining view nor
+served in that time, with the index records and the derived caches
+(mapped, chunks, delta: see bmap_image and partition_delta) built from
+them.
+
+Usage:
+    python artifact_store.py import PATH...
+    python artifact_store.py list
+    python artifact_store.py served [--client IP]
+    python artifact_store.py prune [--days N] [--dry-run]
+"""
+
+import argparse
+import contextlib
+import fcntl
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+STORE_DIR = os.path.expanduser("~/.local/platypus/store")
+# Files imported into the store; anything else in a staged directory is linked as is
+ARTIFACT_PATTERNS = ("*.wic.xz", "*.bmap", "*.itb", "fip-snuc-*.bin", "fru.bin")
+HASH_CHUNK = 4 * 1024 * 1024
+# Derived caches under the store root, keyed <image digest[:16]>-<bmap digest[:16]>...
+CACHE_KINDS = ("mapped", "chunks", "delta")
+# How long prune keeps what was staged or served
+PRUNE_DAYS = 30
+
+_DIGEST = re.compile(r"[0-9a-f]{64}$")
+
+
+def is_artifact(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in ARTIFACT_PATTERNS)
+
+
+def object_digest(path):
+    """The SHA-256 of path if it is (a link to) a store object, else None"""
+    name = os.path.basename(os.path.realpath(path))
+    return name if _DIGEST.match(name) else None
+
+
+def hash_file(path):
+    """Streaming SHA-256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class Artifact:
+    """One imported file"""
+    name: str
+    digest: str
+    size: int
+    source: str
+    mtime: float
+    imported: float
+
+    def matches(self, stat):
+        """True if the source file still looks like what was imported"""
+        return stat.st_size == self.size and stat.st_mtime == self.mtime
+
+
+class ArtifactStore:
+    """The object directory plus an index of imported source files"""
+
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.views = os.path.join(root, "views")
+        self.index_path = os.path.join(root, "index.json")
+        self.served_path = os.path.join(root, "served.jsonl")
+        self._lock = threading.Lock()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """The index, locked against other threads and processes; saved on exit"""
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock, open(os.path.join(self.root, "index.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.index_path) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+            before = dict(index)
+            yield index
+            if index != before:
+                fd, temp = tempfile.mkstemp(dir=self.root, prefix=".index-")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(index, f, indent=1)
+                os.replace(temp, self.index_path)
+
+    def lookup(self, path):
+        """The Artifact for path if it was imported and has not changed since, else None"""
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._locked_index() as index:
+            record = index.get(path)
+        if record is None:
+            return None
+        artifact = Artifact(**record)
+        if not artifact.matches(stat) or not os.path.exists(self.object_path(artifact.digest)):
+            return None
+        return artifact
+
+    def add(self, path, callback_output=None):
+        """Imports path (copy and hash in one pass) unless it is already in the store; returns its Artifact"""
+        path = os.path.abspath(path)
+        artifact = self.lookup(path)
+        if artifact is not None:
+            return artifact
+
+        stat = os.stat(path)
+        if callback_output:
+            callback_output(f"Importing {os.path.basename(path)} ({stat.st_size / 1024 / 1024:.1f} MB) into the artifact store...")
+        os.makedirs(self.objects, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, temp = tempfile.mkstemp(dir=self.objects, prefix=".import-")
+        try:
+            with open(path, "rb") as source, os.fdopen(fd, "wb") as target:
+                while chunk := source.read(HASH_CHUNK):
+                    digest.update(chunk)
+                    target.write(chunk)
+            target_path = self.object_path(digest.hexdigest())
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            if os.path.exists(target_path):
+                os.unlink(temp)
+            else:
+                os.chmod(temp, 0o444)
+                os.replace(temp, target_path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+
+        artifact = Artifact(os.path.basename(path), digest.hexdigest(), stat.st_size, path,
+                            stat.st_mtime, time.time())
+        with self._locked_index() as index:
+            index[path] = asdict(artifact)
+        return artifact
+
+    def artifacts(self):
+        with self._locked_index() as index:
+            return [Artifact(**record) for record in index.values()]
+
+    def stage(self, path, callback_output=None):
+        """
+        Imports the artifacts found in a directory (or a single file) and
+        returns a view directory with the same file names for the artifact
+        server to publish, plus {name: Artifact} for what was imported.
+        """
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            directory, names = path, sorted(os.listdir(path))
+        else:
+            directory, names = os.path.dirname(path), [os.path.basename(path)]
+        view = os.path.join(self.views, hashlib.sha256(path.encode()).hexdigest()[:16])
+        os.makedirs(view, exist_ok=True)
+        # The view's mtime is when it was last staged (see prune)
+        os.utime(view)
+        staged = {}
+        wanted = set()
+        for name in names:
+            source = os.path.join(directory, name)
+            if not os.path.isfile(source):
+                continue
+            if is_artifact(name):
+                staged[name] = self.add(source, callback_output)
+                target = self.object_path(staged[name].digest)
+            else:
+                target = source
+            _link(target, os.path.join(view, name))
+            wanted.add(name)
+        for name in os.listdir(view):
+            if name not in wanted:
+                os.unlink(os.path.join(view, name))
+        return view, staged
+
+    def record_served(self, client, name, digest, size):
+        os.makedirs(self.root, exist_ok=True)
+        entry = {"time": time.time(), "client": client, "name": name, "digest": digest, "bytes": size}
+        with self._lock, open(self.served_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def served(self, client=None):
+        """Served records, oldest first, optionally for one client IP"""
+        try:
+            with open(self.served_path) as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+        except OSError:
+            return []
+        return [e for e in entries if client is None or e["client"] == client]
+
+    def prune(self, days=PRUNE_DAYS, dry_run=False, callback_output=None):
+        """
+        Deletes the views not staged within days, then the objects no
+        remaining view links to and not served within days, their index
+        records and the caches built from them. Returns the bytes freed
+        (that would be, with dry_run).
+        """
+        cutoff = time.time() - days * 86400
+        removed = []
+
+        keep = set()
+        for name in _listdir(self.views):
+            view = os.path.join(self.views, name)
+            if os.path.getmtime(view) < cutoff:
+                removed.append(view)
+                continue
+            keep.update(filter(None, (object_digest(os.path.join(view, link)) for link in _listdir(view))))
+        keep.update(entry["digest"] for entry in self.served() if entry["time"] >= cutoff)
+        prefixes = {digest[:16] for digest in keep}
+
+        with self._locked_index() as index:
+            for prefix in _listdir(self.objects):
+                for digest in _listdir(os.path.join(self.objects, prefix)):
+                    # Recently imported objects stay too: a stage may be linking them right now
+                    if _DIGEST.match(digest) and digest not in keep \
+                            and os.path.getmtime(self.object_path(digest)) < cutoff:
+                        removed.append(self.object_path(digest))
+            for kind in CACHE_KINDS:
+                cache = os.path.join(self.root, kind)
+                for name in _listdir(cache):
+                    if not name.startswith(".") and not name.endswith(".lock") \
+                            and not set(name.split("-")[:2]) <= prefixes \
+                            and os.path.getmtime(os.path.join(cache, name)) < cutoff:
+                        removed.append(os.path.join(cache, name))
+            freed = sum(_size(path) for path in removed)
+            if not dry_run:
+                gone = {os.path.basename(path) for path in removed}
+                for source, record in list(index.items()):
+                    if record["digest"] in gone:
+                        del index[source]
+                for path in removed:
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        with contextlib.suppress(OSError):
+                            os.unlink(path)
+                    with contextlib.suppress(OSError):
+                        os.unlink(path + ".lock")
+                for prefix in _listdir(self.objects):
+                    with contextlib.suppress(OSError):
+                        os.rmdir(os.path.join(self.objects, prefix))
+        if callback_output:
+            for path in removed:
+                callback_output(f"{'Would remove' if dry_run else 'Removed'} {path}")
+            callback_output(f"{freed / 1024 / 1024:.1f} MB {'to free' if dry_run else 'freed'}, "
+                            f"{len(keep)} objects kept.")
+        return freed
+
+
+def _listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+
+def _size(path):
+    """Bytes under path, without following links"""
+    if os.path.islink(path) or not os.path.isdir(path):
+        return os.lstat(path).st_size if os.path.lexists(path) else 0
+    return sum(os.lstat(os.path.join(root, name)).st_size
+               for root, _, names in os.walk(path) for name in names)
+
+
+def _link(target, link):
+    """Points link at target, replacing whatever link pointed at before"""
+    try:
+        if os.readlink(link) == target:
+            return
+    except OSError:
+        pass
+    temp = f"{link}.{os.getpid()}.{threading.get_ident()}"
+    os.symlink(target, temp)
+    os.replace(temp, link)
+
+
+class ServedLog:
+    """
+    Transfer subscriber (see artifact_server.transfers) that records every
+    completed download of a store object. resolve maps a URL path to the
+    file that was served.
+    """
+
+    def __init__(self, resolve, store=None):
+        self.resolve = resolve
+        self.store = store or default_store
+
+    def __call__(self, event, transfer):
+        if event != "finished":
+            return
+        path = self.resolve(transfer.path)
+        digest = object_digest(path) if path else None
+        if digest:
+            self.store.record_served(transfer.client, os.path.basename(transfer.path), digest, transfer.sent)
+
+
+default_store = ArtifactStore()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Platypus content-addressed artifact store")
+    sub = parser.add_subparsers(dest="mode", required=True)
+    add = sub.add_parser("import", help="import files or every artifact in a directory")
+    add.add_argument("paths", nargs="+")
+    sub.add_parser("list", help="list imported files")
+    served = sub.add_parser("served", help="show what was served to which unit")
+    served.add_argument("--client")
+    prune = sub.add_parser("prune", help="delete what was not staged or served recently")
+    prune.add_argument("--days", type=float, default=PRUNE_DAYS,
+                       help=f"keep what was staged or served within this many days (default: {PRUNE_DAYS})")
+    prune.add_argument("--dry-run", action="store_true", help="only list what would be removed")
+    args = parser.parse_args()
+
+    if args.mode == "import":
+        for path in args.paths:
+            if os.path.isdir(path):
+                _, staged = default_store.stage(path, print)
+                artifacts = staged.values()
+            else:
+                artifacts = [default_store.add(path, print)]
+            for artifact in artifacts:
+                print(f"{artifact.digest}  {artifact.source}")
+    elif args.mode == "prune":
+        default_store.prune(args.days, args.dry_run, print)
+    elif args.mode == "list":
+        for artifact in sorted(default_store.artifacts(), key=lambda a: a.imported):
+            print(f"{artifact.digest}  {artifact.size:>12}  {artifact.source}")
+    else:
+        for entry in default_store.served(args.client):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time']))}  "
+                  f"{entry['client']:<15}  {entry['name']}  {entry['digest'][:16]}")
+
+
+if __name__ == "__main__":
+    main()
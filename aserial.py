@@ -0,0 +1,378 @@
+"""
+Event-driven serial I/O on top of asyncio.
+
+A single background event loop (the reactor) watches every open tty with
+loop.add_reader, so dozens of ports are serviced by one thread instead of
+one busy-polling worker thread per in-flight read. Received bytes land in a
+per-port buffer that both coroutines (on any event loop) and plain threads
+can wait on.
+"""
+
+import asyncio
+import os
+import select
+import termios
+import threading
+import time
+
+from utils import PromptScanner, ExpectResult, DEFAULT_PROMPTS
+
+# Unread output kept per port while no flow is consuming it
+MAX_BUFFER = 4 * 1024 * 1024
+
+
+class SerialReactor:
+    """Background event loop that owns the read side of every open port"""
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None or not self._thread.is_alive():
+                ready = threading.Event()
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run, args=(ready,),
+                                                name="serial-reactor", daemon=True)
+                self._thread.start()
+                ready.wait()
+            return self._loop
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(ready.set)
+        self._loop.run_forever()
+
+    def call(self, func, *args):
+        """Runs func on the reactor loop and waits for it to finish"""
+        loop = self.loop
+        if threading.current_thread() is self._thread:
+            return func(*args)
+        done = threading.Event()
+        result = []
+
+        def _call():
+            try:
+                result.append(func(*args))
+            finally:
+                done.set()
+
+        loop.call_soon_threadsafe(_call)
+        done.wait()
+        return result[0] if result else None
+
+    def add_port(self, port):
+        self.call(self.loop.add_reader, port.fd, port._on_readable)
+
+    def remove_port(self, port):
+        if self._loop is not None and self._thread.is_alive():
+            self.call(self._loop.remove_reader, port.fd)
+
+
+reactor = SerialReactor()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Expectation:
+    """Deadline and prompt-matching state for one expect call"""
+
+    def __init__(self, patterns, timeout, idle_timeout):
+        self.scanner = PromptScanner(patterns)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.start = time.monotonic()
+        self.last_data = self.start
+        self.reason = None
+
+    def wait_time(self):
+        """Seconds to wait for more data, or None once a deadline has passed"""
+        now = time.monotonic()
+        remaining = self.timeout - (now - self.start)
+        if remaining <= 0:
+            self.reason = "timeout"
+            return None
+        if self.idle_timeout is not None:
+            idle_remaining = self.idle_timeout - (now - self.last_data)
+            if idle_remaining <= 0:
+                self.reason = "idle"
+                return None
+            remaining = min(remaining, idle_remaining)
+        return remaining
+
+    def feed(self, port, chunk):
+        """Feeds chunk, returns an ExpectResult on match. Bytes past the match go back to port."""
+        self.last_data = time.monotonic()
+        found = self.scanner.feed(chunk)
+        if not found:
+            return None
+        label, match_start, match_end = found
+        buffer = bytes(self.scanner.buffer)
+        port.unread(buffer[match_end:])
+        return ExpectResult(
+            output=buffer[:match_end].decode("utf-8", errors="ignore"),
+            pattern=label,
+            match=buffer[match_start:match_end].decode("utf-8", errors="ignore"),
+            reason="match",
+            elapsed=self.last_data - self.start,
+        )
+
+    def give_up(self, reason=None):
+        return ExpectResult(
+            output=bytes(self.scanner.buffer).decode("utf-8", errors="ignore"),
+            reason=reason or self.reason or "timeout",
+            elapsed=time.monotonic() - self.start,
+        )
+
+
+class AsyncSerialPort:
+    """
+    Buffered reader for one open pyserial port, fed by the reactor.
+
+    Writes go straight to the port: commands are a few dozen bytes and the
+    tty output queue takes them without blocking.
+
+    Subscribers (see serial_mux) are called on the reactor thread with every
+    received chunk, so consoles and loggers see the same bytes as the flows.
+    Write subscribers are called with every chunk sent, on the writing thread.
+    """
+
+    def __init__(self, ser, reactor=reactor):
+        self.ser = ser
+        self.fd = ser.fileno()
+        self.reactor = reactor
+        self.closed = False
+        self._buffer = bytearray()
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._subscribers = []
+        self._write_subscribers = []
+
+    def start(self):
+        self.reactor.add_port(self)
+        return self
+
+    def stop(self):
+        self.reactor.remove_port(self)
+        self._mark_closed()
+
+    def subscribe(self, callback, sent=False):
+        """Calls callback(data) with every chunk read from the port, or written to it if sent"""
+        if sent:
+            if callback not in self._write_subscribers:
+                self._write_subscribers = self._write_subscribers + [callback]
+        elif callback not in self._subscribers:
+            self._subscribers = self._subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        self._subscribers = [s for s in self._subscribers if s != callback]
+        self._write_subscribers = [s for s in self._write_subscribers if s != callback]
+
+    # ---------- Reactor side ----------
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = None
+        if data == b"" and not self._hung_up():
+            # Woken for input that reset_input_buffer flushed before the read (VMIN=0 reads return nothing)
+            return
+        if not data:
+            # Device unplugged or pty closed
+            self.reactor.loop.remove_reader(self.fd)
+            self._mark_closed()
+            return
+        self._deliver(data)
+
+    def _hung_up(self):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        return any(events & (select.POLLHUP | select.POLLERR | select.POLLNVAL) for _, events in poller.poll(0))
+
+    def _deliver(self, data):
+        for subscriber in self._subscribers:
+            try:
+                subscriber(data)
+            except Exception:
+                pass
+        with self._cond:
+            self._buffer += data
+            if len(self._buffer) > MAX_BUFFER:
+                del self._buffer[:len(self._buffer) - MAX_BUFFER]
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass  # waiter's loop already closed
+
+    def _mark_closed(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass
+
+    # ---------- Buffer access ----------
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def take(self, size=None):
+        """Removes and returns up to size buffered bytes (all if size is None)"""
+        with self._cond:
+            if size is None or size >= len(self._buffer):
+                data = bytes(self._buffer)
+                self._buffer.clear()
+            else:
+                data = bytes(self._buffer[:size])
+                del self._buffer[:size]
+            return data
+
+    def unread(self, data):
+        """Puts data back at the front of the buffer"""
+        if data:
+            with self._cond:
+                self._buffer[:0] = data
+
+    def reset_input_buffer(self):
+        try:
+            termios.tcflush(self.fd, termios.TCIFLUSH)
+        except termios.error:
+            pass
+        with self._cond:
+            self._buffer.clear()
+
+    def write(self, data):
+        written = self.ser.write(data)
+        for subscriber in self._write_subscribers:
+            try:
+                subscriber(data)
+            except Exception:
+                pass
+        return written
+
+    # ---------- Blocking API (threads) ----------
+
+    def wait_data(self, timeout):
+        """Blocks until data is buffered or timeout passes. Returns True if data is there."""
+        with self._cond:
+            if not self._buffer and not self.closed:
+                self._cond.wait(timeout)
+            return bool(self._buffer)
+
+    def read(self, size=1, timeout=1):
+        """pyserial-style read: up to size bytes, waiting at most timeout for them"""
+        deadline = time.monotonic() + (timeout or 0)
+        with self._cond:
+            while len(self._buffer) < size and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        return self.take(size)
+
+    def read_until(self, expected=b'\n', size=None, timeout=1):
+        deadline = time.monotonic() + (timeout or 0)
+        with self._cond:
+            while expected not in self._buffer and not self.closed:
+                if size is not None and len(self._buffer) >= size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            index = self._buffer.find(expected)
+            end = index + len(expected) if index != -1 else len(self._buffer)
+            if size is not None:
+                end = min(end, size)
+        return self.take(end)
+
+    def expect(self, patterns=DEFAULT_PROMPTS, timeout=10, idle_timeout=None):
+        """Blocking expect driven by reactor notifications instead of polling"""
+        expectation = _Expectation(patterns, timeout, idle_timeout)
+        while True:
+            wait = expectation.wait_time()
+            if wait is None:
+                return expectation.give_up()
+            if not self.wait_data(wait):
+                if self.closed:
+                    return expectation.give_up("closed")
+                continue
+            result = expectation.feed(self, self.take())
+            if result:
+                return result
+
+    # ---------- Coroutine API (any event loop) ----------
+
+    async def _await_delivery(self, timeout, size=1):
+        """
+        Waits on the caller's event loop until size bytes are buffered or the
+        reactor delivers the next chunk. The buffer is checked again under the
+        lock so a chunk delivered since the caller looked is not missed.
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.closed or len(self._buffer) >= size:
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    async def await_data(self, timeout):
+        """Waits until data is buffered or timeout passes. Returns True if data is there."""
+        if not self._buffer:
+            await self._await_delivery(timeout)
+        return bool(self._buffer)
+
+    async def aread(self, size=1, timeout=1):
+        """Coroutine version of read"""
+        deadline = time.monotonic() + timeout
+        while len(self._buffer) < size and not self.closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await self._await_delivery(remaining, size)
+        return self.take(size)
+
+    async def aread_until(self, expected=b'\n', timeout=1):
+        result = await self.aexpect((expected,), timeout=timeout)
+        return result.output.encode("utf-8")
+
+    async def aexpect(self, patterns=DEFAULT_PROMPTS, timeout=10, idle_timeout=None):
+        """Coroutine expect: no thread is parked while waiting"""
+        expectation = _Expectation(patterns, timeout, idle_timeout)
+        while True:
+            wait = expectation.wait_time()
+            if wait is None:
+                return expectation.give_up()
+            if not await self.await_data(wait):
+                if self.closed:
+                    return expectation.give_up("closed")
+                continue
+            result = expectation.feed(self, self.take())
+            if result:
+                return result
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Artifact server throughput benchmark.
+
+Serves one restore-image sized file and has several clients download it at
+once, the way Flash All does on a multi-unit bench. Each client reads at a
+fixed rate to stand in for a BMC's 100 Mbit NIC, so a server that handles
+one connection at a time shows up as clients queueing behind each other.
+Compares the old single-threaded HTTPServer with artifact_server, whose
+scheduler admits --max-transfers large downloads at a time and can share
+a --link rate between them.
+
+Usage:
+    python benchmarks/bench_artifact_server.py --clients 8 --size 64 --rate 12
+    python benchmarks/bench_artifact_server.py --clients 16 --rate 0 --link 100 --max-transfers 4
+"""
+
+import argparse
+import http.client
+import os
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifact_server
+
+IMAGE = "obmc-phosphor-image-snuc-nanobmc.wic.xz"
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_legacy(directory):
+    httpd = HTTPServer(("127.0.0.1", 0), partial(_QuietHandler, directory=directory))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def start_artifact(directory, max_transfers, link):
+    httpd = artifact_server.serve(directory, 0, host="127.0.0.1")
+    httpd.scheduler.configure(max_transfers=max_transfers, rate=int(link * 1024 * 1024))
+    return httpd
+
+
+def download(port, rate, results):
+    start = time.perf_counter()
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    connection.request("GET", f"/{IMAGE}")
+    response = connection.getresponse()
+    chunk = 256 * 1024
+    received = 0
+    while True:
+        data = response.read(chunk)
+        if not data:
+            break
+        received += len(data)
+        if rate:
+            # Pace the read so the client never runs faster than rate MB/s
+            behind = received / (rate * 1024 * 1024) - (time.perf_counter() - start)
+            if behind > 0:
+                time.sleep(behind)
+    connection.close()
+    results.append((time.perf_counter() - start, received))
+
+
+def run(name, start_server, directory, clients, rate):
+    httpd = start_server(directory)
+    port = httpd.server_address[1]
+    results = []
+    threads = [threading.Thread(target=download, args=(port, rate, results)) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    httpd.shutdown()
+    httpd.server_close()
+
+    total = sum(size for _, size in results)
+    times = sorted(elapsed for elapsed, _ in results)
+    print(f"{name:<16}{times[0]:9.2f}{times[-1]:9.2f}{wall:9.2f}{total / wall / 1e6:11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=8, help="concurrent downloads (default: 8)")
+    parser.add_argument("--size", type=int, default=64, help="image size in MB (default: 64)")
+    parser.add_argument("--rate", type=float, default=12,
+                        help="per-client read rate in MB/s, 0 = unlimited (default: 12)")
+    parser.add_argument("--max-transfers", type=int, default=artifact_server.MAX_LARGE_TRANSFERS,
+                        help=f"artifact_server concurrent large downloads, 0 = no cap "
+                             f"(default: {artifact_server.MAX_LARGE_TRANSFERS})")
+    parser.add_argument("--link", type=float, default=0,
+                        help="artifact_server rate shared between downloads in MB/s, 0 = unlimited (default: 0)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, IMAGE), "wb") as f:
+            f.write(os.urandom(args.size * 1024 * 1024))
+        print(f"{args.clients} clients, {args.size} MB image, {args.rate or 'unlimited'} MB/s per client")
+        print(f"{'server':<16}{'first':>9}{'last':>9}{'wall':>9}{'MB/s':>11}")
+        run("HTTPServer", start_legacy, directory, args.clients, args.rate)
+        run("artifact_server", partial(start_artifact, max_transfers=args.max_transfers, link=args.link),
+            directory, args.clients, args.rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Mapped-blocks restore image benchmark.
+
+Builds a sparse .wic (zero holes between mapped ranges of compressible
+data), its .wic.xz and a bmap, then measures what bmap_image moves from
+the BMC to the host:
+
+- how long the host takes to build the mapped payload, cold and cached
+- bytes on the wire: the .wic.xz against the mapped payload
+- decompression work: xz -dc of the whole image (what bmaptool or the
+  pipe mode does on the BMC) against reading the mapped payload, both on
+  this host, as a proxy for the share of the BMC's CPU that goes away
+
+With --units, flash_emmc then runs in mapped mode against bmc_sim boards
+through an in-process artifact server. Each board's eMMC is checked
+against the payload digest, and its writes against the image where the
+simulator kept the bytes. With --uboot-write the boards are written from
+U-Boot in CRC-checked chunks instead (bmc.flash_emmc_uboot), and the
+chunks the simulator kept are checked against the image.
+
+Usage:
+    python benchmarks/bench_bmap.py --size 256 --mapped 0.15 --units 4
+    python benchmarks/bench_bmap.py --size 64 --units 4 --uboot-write gzwrite
+"""
+
+import argparse
+import asyncio
+import hashlib
+import lzma
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifact_server
+import artifact_store
+import bmap_image
+import bmc
+from bmc_sim import SimTiming, start_fleet, stop_fleet
+from serial_session import SerialSession, registry
+
+BLOCK = 4096
+IMAGE = "obmc-phosphor-image-snuc-nanobmc.wic"
+OTHERS = {"obmc-rescue-image-snuc-nanobmc.itb": 2 * 1024 * 1024}
+# 16 symbols: random, but compresses about 2:1 like a root filesystem
+_SYMBOLS = bytes(range(0x30, 0x40)) * 16
+
+
+def make_image(directory, size, mapped):
+    """Writes IMAGE.xz and IMAGE.bmap; returns the raw image"""
+    blocks = size // BLOCK
+    image = bytearray(blocks * BLOCK)
+    rng = random.Random(1)
+    ranges = []
+    block = 0
+    while block < blocks:
+        run = rng.randint(1, 256)
+        gap = int(run * (1 - mapped) / mapped)
+        first, last = block, min(block + run, blocks) - 1
+        image[first * BLOCK:(last + 1) * BLOCK] = os.urandom((last - first + 1) * BLOCK).translate(_SYMBOLS)
+        ranges.append((first, last))
+        block = last + 1 + rng.randint(gap // 2, gap * 3 // 2 + 1)
+    with open(os.path.join(directory, IMAGE + ".xz"), "wb") as f:
+        f.write(lzma.compress(bytes(image), preset=1))
+    lines = ['<?xml version="1.0" ?>', '<bmap version="2.0">', f"    <ImageSize> {len(image)} </ImageSize>",
+             f"    <BlockSize> {BLOCK} </BlockSize>", f"    <BlocksCount> {blocks} </BlocksCount>",
+             "    <ChecksumType> sha256 </ChecksumType>", "    <BlockMap>"]
+    for first, last in ranges:
+        checksum = hashlib.sha256(image[first * BLOCK:(last + 1) * BLOCK]).hexdigest()
+        lines.append(f'        <Range chksum="{checksum}"> {first}-{last} </Range>')
+    lines += ["    </BlockMap>", "</bmap>", ""]
+    with open(os.path.join(directory, IMAGE + ".bmap"), "w") as f:
+        f.write("\n".join(lines))
+    return bytes(image)
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def host_side(directory, store):
+    xz, bmap = os.path.join(directory, IMAGE + ".xz"), os.path.join(directory, IMAGE + ".bmap")
+    cold, cold_time = timed(lambda: bmap_image.build(xz, bmap, store))
+    _, cached_time = timed(lambda: bmap_image.build(xz, bmap, store))
+    payload = os.path.join(cold.directory, cold.payload_name)
+
+    def decompress():
+        with lzma.open(xz) as f:
+            while f.read(bmap_image.READ_CHUNK):
+                pass
+
+    def read_payload():
+        with open(payload, "rb") as f:
+            while f.read(bmap_image.READ_CHUNK):
+                pass
+
+    _, decompress_time = timed(decompress)
+    _, read_time = timed(read_payload)
+    mb = 1024 * 1024
+    print(f"image {cold.image_size / mb:.0f} MB, {cold.ranges} ranges, {cold.payload_size / mb:.1f} MB mapped")
+    print(f"build on the host     {cold_time:8.2f}s cold {cached_time:8.3f}s cached")
+    print(f"on the wire           {os.path.getsize(xz) / mb:8.1f} MB .wic.xz {cold.payload_size / mb:8.1f} MB mapped")
+    print(f"decoding per unit     {decompress_time:8.2f}s xz -dc {read_time:8.3f}s mapped payload (this host)")
+
+
+async def flash_fleet(directory, units, scale, image, uboot_write=None):
+    httpd = artifact_server.serve(directory, 0, host="127.0.0.1")
+    bmc.serve_artifacts = lambda path, port, callback_output: httpd
+    bmc.stop_server = lambda httpd, callback_output: None
+    fleet = start_fleet(units, state="uboot", timing=SimTiming(scale=scale), link_prefix=None, http_port=httpd.port)
+    mapped = bmap_image.build(os.path.join(directory, IMAGE + ".xz"), os.path.join(directory, IMAGE + ".bmap"))
+    payload_digest = artifact_store.hash_file(os.path.join(mapped.directory, mapped.payload_name))
+
+    async def unit(sim):
+        start = time.perf_counter()
+        if uboot_write:
+            await bmc.flash_emmc_uboot("10.0.0.10", directory, "127.0.0.1", 2, lambda value: None,
+                                       lambda message: None, sim.device, tftpboot=False, mode=uboot_write)
+            # Chunks the simulator kept are compared with the image; each was CRC-checked on load
+            good = all(image[offset:offset + len(data)] == data for offset, data in sim.board.emmc.items())
+            return time.perf_counter() - start, good
+        await bmc.flash_emmc("10.0.0.10", directory, "127.0.0.1", 2, lambda value: None, lambda message: None,
+                             sim.device, stream=bmc.STREAM_MAPPED)
+        # The simulator keeps the bytes of small payloads only; larger ones are checked by digest
+        writes = sim.board.emmc
+        good = sim.board.emmc_image == payload_digest and \
+            all(image[offset:offset + len(data)] == data for offset, data in writes.items())
+        return time.perf_counter() - start, good
+
+    try:
+        return await asyncio.gather(*(unit(sim) for sim in fleet))
+    finally:
+        registry.close_all()
+        stop_fleet(fleet)
+        httpd.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", type=int, default=256, help="image size in MB (default: 256)")
+    parser.add_argument("--mapped", type=float, default=0.15, help="mapped share of the image (default: 0.15)")
+    parser.add_argument("--units", type=int, default=0, help="simulated boards to flash in mapped mode (default: 0)")
+    parser.add_argument("--scale", type=float, default=0.02, help="simulator delay multiplier (default: 0.02)")
+    parser.add_argument("--uboot-write", choices=bmc.UBOOT_WRITE_MODES,
+                        help="flash the units from U-Boot in chunks instead of the mapped stream")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        image = make_image(directory, args.size * 1024 * 1024, args.mapped)
+        for name, size in OTHERS.items():
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(os.urandom(size))
+        host_side(directory, artifact_store.ArtifactStore(os.path.join(directory, ".store")))
+        if args.units:
+            SerialSession.log_dir = None
+            results = asyncio.run(flash_fleet(directory, args.units, args.scale, image, args.uboot_write))
+            ok = "ok" if all(good for _, good in results) else "MISMATCH"
+            flow = f"U-Boot {args.uboot_write} chunks" if args.uboot_write else "mapped flash_emmc"
+            print(f"{args.units} simulated units, {flow} {max(t for t, _ in results):.2f}s  {ok}")
+
+
+if __name__ == "__main__":
+    main()
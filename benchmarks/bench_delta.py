@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Partition delta flashing benchmark.
+
+Builds two releases of a GPT .wic (boot, rofs and rwfs partitions, only
+rofs differs between them) with their .wic.xz and bmap, and compares what
+a flash of the second release sends to a board that holds the first:
+
+- mapped mode: every mapped block of the image
+- delta mode: only the partitions whose digest differs (partition_delta)
+
+With --units, bmc_sim boards are flashed with the first release and then
+the second in delta mode through an in-process artifact server. The
+partitions each board rewrote are printed, and its eMMC is checked against
+the second image over the bmap's mapped ranges.
+
+Usage:
+    python benchmarks/bench_delta.py --size 256 --units 4
+"""
+
+import argparse
+import asyncio
+import hashlib
+import lzma
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifact_server
+import artifact_store
+import bmap_image
+import bmc
+import partition_delta
+import utils
+from bmc_sim import SimTiming, start_fleet, stop_fleet
+from serial_session import SerialSession, registry
+
+BLOCK = 4096
+SECTOR = 512
+MB = 1024 * 1024
+IMAGE = "obmc-phosphor-image-snuc-nanobmc.wic"
+OTHERS = {"obmc-rescue-image-snuc-nanobmc.itb": 2 * MB}
+LINUX_FS = uuid.UUID("0fc63daf-8483-4772-8e79-3d69d8477de4")
+# 16 symbols: random, but compresses about 2:1 like a root filesystem
+_SYMBOLS = bytes(range(0x30, 0x40)) * 16
+
+
+def _fill(image, offset, size, seed, mapped=0.4):
+    rng = random.Random(seed)
+    position, end = offset, offset + size
+    while position < end:
+        run = min(rng.randint(1, 64) * BLOCK, end - position)
+        image[position:position + run] = rng.randbytes(run).translate(_SYMBOLS)
+        position += run + int(run * (1 - mapped) / mapped)
+
+
+def _gpt(image, partitions):
+    """Writes a protective MBR, primary and backup GPT for (label, offset, size) partitions"""
+    last = len(image) // SECTOR - 1
+    entries = bytearray(128 * 128)
+    for index, (label, offset, size) in enumerate(partitions):
+        struct.pack_into("<16s16sQQQ72s", entries, index * 128, LINUX_FS.bytes_le, uuid.UUID(int=index + 1).bytes_le,
+                         offset // SECTOR, (offset + size) // SECTOR - 1, 0, label.encode("utf-16-le"))
+
+    def header(current, backup, entries_lba):
+        data = bytearray(struct.pack("<8sIIIIQQQQ16sQIII", b"EFI PART", 0x10000, 92, 0, 0, current, backup, 34,
+                                     last - 33, uuid.UUID(int=0).bytes_le, entries_lba, 128, 128,
+                                     zlib.crc32(entries)))
+        struct.pack_into("<I", data, 16, zlib.crc32(data))
+        return bytes(data)
+
+    struct.pack_into("<B3sB3sII", image, 446, 0, b"\0\2\0", 0xEE, b"\xff\xff\xff", 1, min(last, 0xFFFFFFFF))
+    image[510:512] = b"\x55\xaa"
+    image[SECTOR:SECTOR + 92] = header(1, last, 2)
+    image[2 * SECTOR:2 * SECTOR + len(entries)] = entries
+    image[(last - 32) * SECTOR:(last - 32) * SECTOR + len(entries)] = entries
+    image[last * SECTOR:last * SECTOR + 92] = header(last, 1, last - 32)
+
+
+def make_release(directory, size, release):
+    """Writes IMAGE, IMAGE.xz and IMAGE.bmap of one release into directory; returns the raw image"""
+    os.makedirs(directory, exist_ok=True)
+    image = bytearray(size)
+    boot, rwfs = 8 * MB, 16 * MB
+    rofs = size - boot - rwfs - 2 * MB
+    partitions = [("boot", MB, boot), ("rofs", MB + boot, rofs), ("rwfs", MB + boot + rofs, rwfs)]
+    _gpt(image, partitions)
+    _fill(image, MB, boot // 2, "boot")
+    _fill(image, MB + boot, rofs // 2, f"rofs-{release}")
+    _fill(image, MB + boot + rofs, MB, "rwfs")
+    with open(os.path.join(directory, IMAGE), "wb") as f:
+        f.write(image)
+    with open(os.path.join(directory, IMAGE + ".xz"), "wb") as f:
+        f.write(lzma.compress(bytes(image), preset=1))
+    ranges = []
+    for block in range(size // BLOCK):
+        if any(image[block * BLOCK:(block + 1) * BLOCK]):
+            if ranges and ranges[-1][1] == block - 1:
+                ranges[-1][1] = block
+            else:
+                ranges.append([block, block])
+    lines = ['<?xml version="1.0" ?>', '<bmap version="2.0">', f"    <ImageSize> {size} </ImageSize>",
+             f"    <BlockSize> {BLOCK} </BlockSize>", f"    <BlocksCount> {size // BLOCK} </BlocksCount>",
+             "    <ChecksumType> sha256 </ChecksumType>", "    <BlockMap>"]
+    for first, last in ranges:
+        checksum = hashlib.sha256(image[first * BLOCK:(last + 1) * BLOCK]).hexdigest()
+        lines.append(f'        <Range chksum="{checksum}"> {first}-{last} </Range>')
+    lines += ["    </BlockMap>", "</bmap>", ""]
+    with open(os.path.join(directory, IMAGE + ".bmap"), "w") as f:
+        f.write("\n".join(lines))
+    for name, length in OTHERS.items():
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(os.urandom(length))
+    return bytes(image)
+
+
+def host_side(releases, store):
+    paths = [(os.path.join(d, IMAGE + ".xz"), os.path.join(d, IMAGE + ".bmap")) for d in releases]
+    start = time.perf_counter()
+    old, new = (partition_delta.build(image, bmap, store) for image, bmap in paths)
+    built = time.perf_counter() - start
+    mapped = bmap_image.build(*paths[1], store)
+    before = {region.name: region.digest for region in old.regions}
+    stale = [region for region in new.regions if before.get(region.name) != region.digest]
+    print(new.describe())
+    print(f"split both releases       {built:8.2f}s")
+    print(f"mapped mode sends         {mapped.payload_size / MB:8.1f} MB")
+    print(f"delta mode sends          {sum(r.mapped for r in stale) / MB:8.1f} MB "
+          f"({', '.join(r.label or r.name for r in stale)})")
+
+
+async def flash_fleet(releases, units, scale, image):
+    httpd = artifact_server.serve(releases[0], 0, host="127.0.0.1")
+    port = httpd.port
+    bmc.stop_server = lambda httpd, callback_output: None
+    fleet = start_fleet(units, state="uboot", timing=SimTiming(scale=scale), link_prefix=None, http_port=port)
+    bmap = bmap_image.parse_bmap(os.path.join(releases[1], IMAGE + ".bmap"))
+
+    async def unit(sim, directory, first):
+        log = []
+        if not first:
+            await utils.login("root", "0penBmc", sim.device, log.append)
+            await bmc.reset_to_uboot(log.append, sim.device)
+        start = time.perf_counter()
+        await bmc.flash_emmc("10.0.0.10", directory, "127.0.0.1", 2, lambda value: None, log.append,
+                             sim.device, stream=bmc.STREAM_DELTA)
+        rewritten = next((line for line in log if line.startswith("Partitions to rewrite")), "no delta")
+        good = all(sim._emmc_read(offset, size) == image[offset:offset + size]
+                   for offset, size in bmap_image.mapped_extents(bmap))
+        return time.perf_counter() - start, rewritten, good
+
+    try:
+        for index, directory in enumerate(releases):
+            httpd.stop()
+            httpd = artifact_server.serve(directory, port, host="127.0.0.1")
+            bmc.serve_artifacts = lambda path, port, callback_output: httpd
+            results = await asyncio.gather(*(unit(sim, directory, index == 0) for sim in fleet))
+        return results
+    finally:
+        registry.close_all()
+        stop_fleet(fleet)
+        httpd.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", type=int, default=256, help="image size in MB (default: 256)")
+    parser.add_argument("--units", type=int, default=0, help="simulated boards to flash (default: 0)")
+    parser.add_argument("--scale", type=float, default=0.02, help="simulator delay multiplier (default: 0.02)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        releases = [os.path.join(directory, name) for name in ("old", "new")]
+        images = [make_release(path, args.size * MB, release) for release, path in enumerate(releases)]
+        host_side(releases, artifact_store.ArtifactStore(os.path.join(directory, ".store")))
+        if args.units:
+            SerialSession.log_dir = None
+            results = asyncio.run(flash_fleet(releases, args.units, args.scale, images[1]))
+            ok = "ok" if all(good for _, _, good in results) else "MISMATCH"
+            print(f"{args.units} simulated units, delta flash_emmc of the new release "
+                  f"{max(t for t, _, _ in results):.2f}s  {ok}")
+            print(results[0][1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Flow latency benchmark against simulated BMCs.
+
+Starts a fleet of bmc_sim boards at the U-Boot prompt and runs the same
+sequence Flash All uses on every unit concurrently: flash_emmc, login,
+flasher (FIP) and flash_eeprom. The restore image is a GPT image with
+its .xz and .bmap, the rest are random files of realistic size, all
+served over HTTP from a temporary directory. Prints per-step latency
+across the fleet and the total wall time. The run fails, without
+timings, if a flow fails, falls back to another path than the one asked
+for, or leaves the eMMC not holding the image.
+
+The flows normally start their own server on port 80 per call; here one
+shared server on a free port stands in for all of them (the simulated
+boards are told to use that port), the same way MultiUnitFlashWindow
+shares one server between units.
+
+--stream runs flash_emmc in one of its streaming modes, writing the
+restore image while it downloads instead of staging it on the board.
+
+--rerun logs in again and repeats flasher and flash_eeprom once the
+sequence is done. The boards then already hold the FIP and the FRU, so
+both flows only hash the region on the board and skip the write.
+
+--per-command sends the FIP, EEPROM and restore image commands one at a
+time over the console instead of running each as one job script on the
+board (bmc_job), for comparing the two.
+
+Usage:
+    python benchmarks/bench_flows.py --units 32 --scale 0.01
+    python benchmarks/bench_flows.py --units 32 --scale 0.01 --stream bmaptool
+    python benchmarks/bench_flows.py --units 8 --rerun
+    python benchmarks/bench_flows.py --units 8 --rerun --per-command
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifact_server
+import artifact_store
+import bmap_image
+import bmc
+import utils
+from bmc_sim import SimTiming, start_fleet, stop_fleet
+from serial_session import SerialSession, aacquire_session, registry
+from bench_delta import IMAGE, MB, make_release
+
+# The restore image is a real GPT image with its .xz and .bmap (see
+# bench_delta.make_release), so every stream mode can use it; the rest
+# are random bytes of realistic size
+IMAGE_SIZE = 320 * MB
+MIN_IMAGE_SIZE = 32 * MB
+ARTIFACTS = {
+    "obmc-rescue-image-snuc-nanobmc.itb": 12 * MB,
+    "fip-snuc-nanobmc.bin": 1536 * 1024,
+    "fru.bin": 256,
+}
+# What the flows log when they give up on the requested path and take another
+FALLBACKS = ("first instead.", "one by one.")
+
+
+class FlowFailed(Exception):
+    """A flow failed or fell back, so its timing does not measure what was asked for"""
+
+
+def make_artifacts(directory, shrink):
+    """Writes the artifacts into directory; returns the raw restore image"""
+    image = make_release(directory, max(int(IMAGE_SIZE * shrink) // MB * MB, MIN_IMAGE_SIZE), 0)
+    os.remove(os.path.join(directory, IMAGE))
+    for name, size in ARTIFACTS.items():
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(os.urandom(max(int(size * shrink), 256)))
+    return image
+
+
+async def run_unit(sim, directory, image, timings, verbose, stream, rerun, job):
+    device = sim.device
+    fallbacks = []
+
+    def output(message):
+        if any(marker in message for marker in FALLBACKS):
+            fallbacks.append(message)
+        if verbose:
+            print(f"[{sim.name}] {message}")
+
+    def progress(value):
+        pass
+
+    async def flash_emmc():
+        if not await bmc.flash_emmc("10.0.0.10", directory, "127.0.0.1", 2, progress, output, device,
+                                    stream=stream, job=job):
+            return False
+        # Staged and piped writes are kept as the digest of the image written, mapped ones byte for byte
+        if sim.board.emmc_image == artifact_store.hash_file(os.path.join(directory, IMAGE + ".xz")):
+            return True
+        bmap = bmap_image.parse_bmap(os.path.join(directory, IMAGE + ".bmap"))
+        return all(sim._emmc_read(offset, size) == image[offset:offset + size]
+                   for offset, size in bmap_image.mapped_extents(bmap))
+
+    async def login():
+        return await utils.login("root", "0penBmc", device, output) == "Login successful."
+
+    async def reboot():
+        # flash_eeprom leaves the board rebooting; log in only once it is back
+        ser = await aacquire_session(device, owner="bench_flows")
+        try:
+            return await bmc.wait_for_boot(ser, output, time.monotonic())
+        finally:
+            ser.release()
+
+    steps = (
+        ("flash_emmc", flash_emmc),
+        ("login", login),
+        ("flasher", lambda: bmc.flasher(os.path.join(directory, "fip-snuc-nanobmc.bin"), "127.0.0.1",
+                                        progress, output, device, job=job)),
+        ("flash_eeprom", lambda: bmc.flash_eeprom(os.path.join(directory, "fru.bin"), "127.0.0.1",
+                                                  progress, output, device, job=job)),
+    )
+    if rerun:
+        steps += (("reboot", reboot), ("login", login), ("flasher rerun", steps[2][1]),
+                  ("flash_eeprom rerun", steps[3][1]))
+    for name, step in steps:
+        start = time.perf_counter()
+        ok = await step()
+        if not ok or fallbacks:
+            raise FlowFailed(f"{sim.name}: {name} " + (f"fell back: {fallbacks[0]}" if ok else "failed"))
+        timings.setdefault(name, []).append(time.perf_counter() - start)
+
+
+async def run(units, scale, shrink, verbose, stream, rerun, job):
+    with tempfile.TemporaryDirectory() as directory:
+        image = make_artifacts(directory, shrink)
+        httpd = artifact_server.serve(directory, 0, host="127.0.0.1")
+
+        # One shared server instead of one per flow call
+        bmc.serve_artifacts = lambda path, port, callback_output: httpd
+        bmc.stop_server = lambda httpd, callback_output: None
+        SerialSession.log_dir = None
+
+        fleet = start_fleet(units, state="uboot", timing=SimTiming(scale=scale),
+                            http_port=httpd.server_address[1], link_prefix=None)
+        timings = {}
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(run_unit(sim, directory, image, timings, verbose, stream, rerun, job) for sim in fleet))
+        finally:
+            wall = time.perf_counter() - start
+            registry.close_all()
+            stop_fleet(fleet)
+            httpd.stop()
+
+    print(f"{units} units, scale {scale}, artifacts x{shrink}, {stream or 'staged'} restore image, "
+          f"{'job scripts' if job else 'per-command'}")
+    print(f"{'step':<20}{'min':>9}{'median':>9}{'max':>9}")
+    for name, values in timings.items():
+        print(f"{name:<20}{min(values):9.2f}{statistics.median(values):9.2f}{max(values):9.2f}")
+    print(f"wall time: {wall:.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--units", type=int, default=4, help="simulated boards (default: 4)")
+    parser.add_argument("--scale", type=float, default=0.01, help="simulator delay multiplier (default: 0.01)")
+    parser.add_argument("--shrink", type=float, default=0.1,
+                        help="artifact size multiplier, 1.0 = realistic sizes (default: 0.1)")
+    parser.add_argument("--stream", choices=bmc.STREAM_MODES, help="flash_emmc stream mode (default: staged)")
+    parser.add_argument("--rerun", action="store_true",
+                        help="repeat flasher and flash_eeprom on the already flashed boards")
+    parser.add_argument("--per-command", action="store_true",
+                        help="send console commands one at a time instead of job scripts")
+    parser.add_argument("--verbose", action="store_true", help="print flow output")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args.units, args.scale, args.shrink, args.verbose, args.stream, args.rerun,
+                        not args.per_command))
+    except FlowFailed as e:
+        sys.exit(f"FAILED {e}")
+
+
+if __name__ == "__main__":
+    main()
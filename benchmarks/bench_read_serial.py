@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Benchmark for utils.read_serial_data_sync.
+
+Feeds a synthetic multi-megabyte boot log (kernel messages, bmaptool
+progress, frugy output) through a fake serial port and reports throughput.
+A byte-at-a-time reference reader with full rescans is timed on a smaller
+slice to show the difference.
+
+Usage:
+    python benchmarks/bench_read_serial.py --size-mb 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import read_serial_data_sync
+
+
+BOOT_LINES = [
+    b"[    1.234567] mmc0: new HS200 MMC card at address 0001\r\n",
+    b"[    2.345678] EXT4-fs (mmcblk0p2): mounted filesystem with ordered data mode\r\n",
+    b"bmaptool: info: copied 123456 blocks (482.3 MiB), 12.5 MiB/sec\r\n",
+    b"frugy: writing board info area, manufacturer=Simply NUC\r\n",
+    b"systemd[1]: Started Phosphor Inventory Manager.\r\n",
+]
+
+
+def synthetic_log(size):
+    """Returns roughly size bytes of boot log ending in a shell prompt."""
+    body = bytearray()
+    i = 0
+    while len(body) < size:
+        body += BOOT_LINES[i % len(BOOT_LINES)]
+        i += 1
+    return bytes(body) + b"root@nanobmc:~# "
+
+
+class FakeSerial:
+    """Minimal pyserial stand-in that hands out the log in UART-sized chunks."""
+
+    def __init__(self, data, chunk=4096):
+        self.data = data
+        self.pos = 0
+        self.chunk = chunk
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk, len(self.data) - self.pos)
+
+    def read(self, size=1):
+        out = self.data[self.pos:self.pos + size]
+        self.pos += len(out)
+        return out
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def bytewise_reference(ser, timeout=600):
+    """The previous algorithm: one byte per read, full rescan after every byte."""
+    full_response = b""
+    prompt_markers = [b'root@', b'# ', b'> ']
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        if ser.in_waiting > 0:
+            full_response += ser.read(1)
+            if any(marker in full_response for marker in prompt_markers):
+                return full_response
+    return full_response
+
+
+def run(size_mb, reference_kb, chunk):
+    data = synthetic_log(int(size_mb * 1024 * 1024))
+    lines = [0]
+
+    def on_line(line):
+        lines[0] += 1
+
+    ser = FakeSerial(data, chunk)
+    start = time.perf_counter()
+    response = read_serial_data_sync(ser, b"bmaptool copy image.wic.xz /dev/mmcblk0\n",
+                                     timeout=600, output_callback=on_line)
+    elapsed = time.perf_counter() - start
+    assert response.endswith("root@nanobmc:~# "), "prompt not detected"
+    print(f"chunked:  {len(data) / 1e6:8.2f} MB in {elapsed:7.3f} s "
+          f"({len(data) / 1e6 / elapsed:8.1f} MB/s, {lines[0]} lines)")
+
+    if reference_kb:
+        # The log has no "# " before the end, so the reference reads it all
+        small = synthetic_log(reference_kb * 1024)
+        ser = FakeSerial(small, chunk)
+        start = time.perf_counter()
+        bytewise_reference(ser)
+        elapsed = time.perf_counter() - start
+        print(f"bytewise: {len(small) / 1e6:8.2f} MB in {elapsed:7.3f} s "
+              f"({len(small) / 1e6 / elapsed:8.3f} MB/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size-mb", type=float, default=8, help="synthetic log size (default: 8)")
+    parser.add_argument("--reference-kb", type=int, default=64,
+                        help="log size for the byte-at-a-time reference, 0 to skip (default: 64)")
+    parser.add_argument("--chunk", type=int, default=4096, help="bytes available per in_waiting poll")
+    args = parser.parse_args()
+    run(args.size_mb, args.reference_kb, args.chunk)
+
+
+if __name__ == "__main__":
+    main()
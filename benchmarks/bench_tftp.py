@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Rescue image load benchmark: HTTP wget against TFTP tftpboot.
+
+Loopback part: downloads a rescue-image sized file from artifact_server
+over HTTP and over its TFTP side with plain RFC 1350 settings (512-byte
+blocks, lock-step), with a larger block size (RFC 2348) and with a window
+(RFC 7440), several clients at once. Shows what the options buy and that
+the server keeps up.
+
+Simulator part: runs flash_emmc against bmc_sim boards once with the
+default wget load and once with tftpboot=True, and prints the time to the
+rescue shell. The simulator charges SimTiming.wget_rate for wget and
+SimTiming.tftp_rate plus a round trip per window for tftpboot, so this
+part checks the flow end to end rather than measuring a real board. At
+small scales the simulator's own Python TFTP client costs more than the
+modelled transfer, which is why the default scale is higher than in
+bench_flows.
+
+Usage:
+    python benchmarks/bench_tftp.py --clients 4 --size 12 --units 4
+"""
+
+import argparse
+import asyncio
+import http.client
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifact_server
+import bmc
+import tftp_server
+from bmc_sim import SimTiming, start_fleet, stop_fleet
+from serial_session import SerialSession, registry
+
+RESCUE = "obmc-rescue-image-snuc-nanobmc.itb"
+ARTIFACTS = {
+    RESCUE: 12 * 1024 * 1024,
+    "obmc-phosphor-image-snuc-nanobmc.wic.xz": 4 * 1024 * 1024,
+    "obmc-phosphor-image-snuc-nanobmc.wic.bmap": 4 * 1024,
+}
+TFTP_SETTINGS = (
+    ("tftp 512", 512, 1),
+    ("tftp 1468", 1468, 1),
+    ("tftp 1468 w16", tftp_server.BLKSIZE, tftp_server.WINDOWSIZE),
+    ("tftp 8192 w16", 8192, 16),
+)
+
+
+def http_get(port):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    connection.request("GET", f"/{RESCUE}")
+    data = connection.getresponse().read()
+    connection.close()
+    return data
+
+
+def measure(name, download, clients, expected):
+    results = []
+
+    def worker():
+        start = time.perf_counter()
+        data = download()
+        results.append((time.perf_counter() - start, data == expected))
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    times = sorted(elapsed for elapsed, _ in results)
+    ok = "ok" if all(good for _, good in results) else "MISMATCH"
+    print(f"{name:<16}{times[0]:9.2f}{times[-1]:9.2f}{len(expected) * clients / wall / 1e6:11.1f}  {ok}")
+
+
+def loopback(directory, clients):
+    httpd = artifact_server.serve(directory, 0, host="127.0.0.1")
+    tftp_port = httpd.start_tftp(0)
+    with open(os.path.join(directory, RESCUE), "rb") as f:
+        expected = f.read()
+    print(f"{clients} clients, {len(expected) / 1024 / 1024:.0f} MB over loopback")
+    print(f"{'path':<16}{'first':>9}{'last':>9}{'MB/s':>11}")
+    try:
+        measure("http", lambda: http_get(httpd.port), clients, expected)
+        for name, blksize, windowsize in TFTP_SETTINGS:
+            measure(name, lambda: tftp_server.fetch("127.0.0.1", RESCUE, tftp_port, blksize, windowsize),
+                    clients, expected)
+    finally:
+        httpd.stop()
+
+
+async def flash_fleet(directory, units, scale, tftpboot):
+    """Runs flash_emmc on every unit; returns per-unit (seconds to the rescue shell, seconds in total)"""
+    httpd = artifact_server.serve(directory, 0, host="127.0.0.1")
+    tftp_port = httpd.start_tftp(0)
+    # One server per run stands in for the artifact daemon
+    bmc.serve_artifacts = lambda path, port, callback_output: httpd
+    bmc.stop_server = lambda httpd, callback_output: None
+    fleet = start_fleet(units, state="uboot", timing=SimTiming(scale=scale), link_prefix=None,
+                        http_port=httpd.port, tftp_port=tftp_port)
+
+    async def unit(sim):
+        start = time.perf_counter()
+        rescued = []
+
+        def progress(value):
+            # flash_emmc reports 0.40 once the rescue image has booted
+            if value >= 0.40 and not rescued:
+                rescued.append(time.perf_counter() - start)
+
+        await bmc.flash_emmc("10.0.0.10", directory, "127.0.0.1", 2, progress, lambda message: None,
+                             sim.device, tftpboot=tftpboot)
+        return rescued[0] if rescued else None, time.perf_counter() - start
+
+    try:
+        return await asyncio.gather(*(unit(sim) for sim in fleet))
+    finally:
+        registry.close_all()
+        stop_fleet(fleet)
+        httpd.stop()
+
+
+def simulated(directory, units, scale):
+    SerialSession.log_dir = None
+    print(f"\n{units} simulated units, scale {scale}")
+    print(f"{'load':<16}{'rescue':>9}{'flash':>9}")
+    for name, tftpboot in (("wget", False), ("tftpboot", True)):
+        results = asyncio.run(flash_fleet(directory, units, scale, tftpboot))
+        if any(rescue is None for rescue, _ in results):
+            print(f"{name:<16}{'failed':>9}")
+            continue
+        print(f"{name:<16}{statistics.median(r for r, _ in results):9.2f}"
+              f"{statistics.median(t for _, t in results):9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=4, help="concurrent loopback downloads (default: 4)")
+    parser.add_argument("--size", type=int, default=12, help="rescue image size in MB (default: 12)")
+    parser.add_argument("--units", type=int, default=4, help="simulated boards, 0 to skip (default: 4)")
+    parser.add_argument("--scale", type=float, default=0.25, help="simulator delay multiplier (default: 0.25)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, size in ARTIFACTS.items():
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(os.urandom(args.size * 1024 * 1024 if name == RESCUE else size))
+        loopback(directory, args.clients)
+        if args.units:
+            simulated(directory, args.units, args.scale)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Host-side bmap handling for restore images.
+
+bmaptool on the rescue system decompresses the whole .wic.xz on the BMC's
+slow ARM core, only to skip most of what comes out: the .bmap lists the
+block ranges of the image that hold data, and on an OpenBMC image that is
+a small part of it. build() does that work on the host instead, once per
+(image, bmap) pair. The image is decompressed in one streaming pass. Each
+mapped range is checked against the bmap's checksum and appended to a
+payload file, and a writer script is generated next to it. The script
+holds one dd per range, which places the next count blocks read from stdin
+at their offset on the device. On the BMC
+
+    curl http://<host>/<image>.mapped | sh <image>.mapped.sh
+
+writes the image without decompressing anything. Results are cached in the
+artifact store under mapped/<image digest>-<bmap digest>/, so later units
+and later runs only check the index.
+
+build_chunks() cuts the same mapped data into files of at most CHUNK_SIZE
+for U-Boot, which loads one at a time into RAM, checks its CRC32 and
+writes it with mmc write (or gzwrite, for gzipped chunks) without booting
+Linux at all. Chunks are cached under chunks/.
+
+The building blocks are public for other splits of the same data (see
+partition_delta): import_pair, mapped_extents, read_extents,
+RangeChecker and cached_build.
+
+Usage:
+    python bmap_image.py IMAGE.wic.xz IMAGE.wic.bmap [--chunks MB [--gzip]]
+"""
+
+import argparse
+import bz2
+import fcntl
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import re
+import shutil
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+import zlib
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional, Tuple
+
+from artifact_store import default_store
+
+# Device the writer script writes to
+DEVICE = "/dev/mmcblk0"
+READ_CHUNK = 4 * 1024 * 1024
+# U-Boot's mmc write counts 512-byte blocks and loads one chunk at a time into RAM
+MMC_BLOCK = 512
+CHUNK_SIZE = 16 * 1024 * 1024
+# Mapped ranges closer than this share a chunk
+MERGE_GAP = 256 * 1024
+
+_OPENERS = {".xz": lzma.open, ".gz": gzip.open, ".bz2": bz2.open}
+
+
+class BmapError(Exception):
+    """The bmap cannot be parsed or does not match the image"""
+
+
+@dataclass
+class Bmap:
+    """The parts of a bmaptool block map that matter for writing"""
+    image_size: int
+    block_size: int
+    blocks: int
+    checksum_type: Optional[str]
+    # (first block, last block, checksum or None), in image order
+    ranges: List[Tuple[int, int, Optional[str]]] = field(default_factory=list)
+
+    @property
+    def mapped_blocks(self):
+        return sum(last - first + 1 for first, last, _ in self.ranges)
+
+    @property
+    def mapped_bytes(self):
+        """Bytes the mapped ranges cover (the last block may be short)"""
+        return sum(min((last + 1) * self.block_size, self.image_size) - first * self.block_size
+                   for first, last, _ in self.ranges)
+
+
+def parse_bmap(path):
+    """Reads a bmap file (format 1.x or 2.x) into a Bmap"""
+    try:
+        root = ElementTree.parse(path).getroot()
+    except (OSError, ElementTree.ParseError) as e:
+        raise BmapError(f"cannot read {path}: {e}") from e
+
+    def number(tag):
+        element = root.find(tag)
+        if element is None or not (element.text or "").strip().isdigit():
+            raise BmapError(f"{os.path.basename(path)} has no {tag}")
+        return int(element.text)
+
+    version = root.get("version", "1.0")
+    checksum_type = (root.findtext("ChecksumType") or "").strip() or ("sha1" if version.startswith("1.") else None)
+    bmap = Bmap(number("ImageSize"), number("BlockSize"), number("BlocksCount"), checksum_type)
+    block_map = root.find("BlockMap")
+    for element in block_map if block_map is not None else ():
+        text = (element.text or "").strip()
+        match = re.fullmatch(r"(\d+)(?:\s*-\s*(\d+))?", text)
+        if element.tag != "Range" or not match:
+            raise BmapError(f"bad range {text!r} in {os.path.basename(path)}")
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if last < first or last >= bmap.blocks:
+            raise BmapError(f"range {text} is outside the image")
+        bmap.ranges.append((first, last, element.get("chksum") or element.get("sha1")))
+    bmap.ranges.sort()
+    return bmap
+
+
+def open_image(path, name=None):
+    """The image decompressed on the fly, by the extension of name (default: path); raw images as they are"""
+    opener = _OPENERS.get(os.path.splitext(name or path)[1], open)
+    return opener(path, "rb")
+
+
+def writer_script(bmap, name, device=DEVICE):
+    """Shell script that writes a payload, read from stdin, range by range to device"""
+    lines = [
+        "#!/bin/sh",
+        f"# {name}: {len(bmap.ranges)} ranges, {bmap.mapped_bytes} of {bmap.image_size} bytes mapped",
+        "set -e",
+    ]
+    for first, last, _ in bmap.ranges:
+        lines.append(f"dd of={device} bs={bmap.block_size} seek={first} count={last - first + 1} "
+                     f"iflag=fullblock conv=notrunc status=none")
+    lines += ["sync", f"echo \"Wrote {bmap.mapped_bytes} bytes in {len(bmap.ranges)} ranges to {device}\"", ""]
+    return "\n".join(lines)
+
+
+@dataclass
+class MappedImage:
+    """A payload of the mapped ranges of an image plus the script that writes it"""
+    directory: str
+    payload_name: str
+    writer_name: str
+    payload_size: int
+    image_size: int
+    ranges: int
+    cached: bool = False
+    elapsed: float = 0.0
+
+    def describe(self):
+        mb = 1024 * 1024
+        how = "cached" if self.cached else f"built in {self.elapsed:.1f}s"
+        return (f"{self.payload_name}: {self.payload_size / mb:.1f} MB in {self.ranges} ranges "
+                f"of a {self.image_size / mb:.1f} MB image ({how})")
+
+
+@dataclass
+class Chunk:
+    """A piece of the image that U-Boot loads into RAM and writes at offset"""
+    name: str
+    offset: int     # bytes into the device
+    size: int       # bytes it covers on the device, a whole number of MMC blocks
+    length: int     # bytes of the file as served (less than size when gzipped)
+    crc32: int      # of the file as served, what U-Boot's crc32 command prints
+
+    @property
+    def block(self):
+        return self.offset // MMC_BLOCK
+
+    @property
+    def blocks(self):
+        return self.size // MMC_BLOCK
+
+
+@dataclass
+class ChunkedImage:
+    """The mapped parts of an image cut into chunk files for U-Boot"""
+    directory: str
+    chunks: List[Chunk]
+    image_size: int
+    compressed: bool
+    cached: bool = False
+    elapsed: float = 0.0
+
+    @property
+    def length(self):
+        return sum(chunk.length for chunk in self.chunks)
+
+    def describe(self):
+        mb = 1024 * 1024
+        how = "cached" if self.cached else f"built in {self.elapsed:.1f}s"
+        kind = "gzipped " if self.compressed else ""
+        return (f"{len(self.chunks)} {kind}chunks, {self.length / mb:.1f} MB to load "
+                f"for a {self.image_size / mb:.1f} MB image ({how})")
+
+
+class RangeChecker:
+    """
+    Checks the bmap's per-range checksums over mapped data fed in image
+    order, in pieces of any size. feed raises BmapError on a mismatch.
+    """
+
+    def __init__(self, bmap):
+        self.bmap = bmap
+        self.index = 0
+        self.digest = None
+
+    def feed(self, offset, data):
+        bmap, end = self.bmap, offset + len(data)
+        while self.index < len(bmap.ranges):
+            first, last, checksum = bmap.ranges[self.index]
+            start, stop = first * bmap.block_size, min((last + 1) * bmap.block_size, bmap.image_size)
+            if start >= end:
+                return
+            if checksum and bmap.checksum_type:
+                if self.digest is None:
+                    self.digest = hashlib.new(bmap.checksum_type)
+                self.digest.update(data[max(start - offset, 0):min(stop, end) - offset])
+                if stop > end:
+                    return
+                if self.digest.hexdigest() != checksum:
+                    raise BmapError(f"checksum mismatch in blocks {first}-{last}: "
+                                    f"the bmap does not belong to the image")
+                self.digest = None
+            elif stop > end:
+                return
+            self.index += 1
+
+
+def read_extents(image, extents):
+    """
+    Yields (index, offset, bytes) pieces of at most READ_CHUNK covering each
+    (offset, size) extent of an open image in order, index being the
+    extent's, so no extent is ever held in memory whole.
+    """
+    position = 0
+    for index, (offset, size) in enumerate(extents):
+        while position < offset:
+            skipped = image.read(min(READ_CHUNK, offset - position))
+            if not skipped:
+                raise BmapError(f"image ends at {position} bytes, before offset {offset}")
+            position += len(skipped)
+        end = offset + size
+        while position < end:
+            piece = image.read(min(READ_CHUNK, end - position))
+            if not piece:
+                raise BmapError(f"image ends at {position} bytes, the bmap expects more")
+            yield index, position, piece
+            position += len(piece)
+
+
+class _CrcWriter:
+    """File wrapper that keeps the length and CRC32 of what is written through it"""
+
+    def __init__(self, file):
+        self.file = file
+        self.length = 0
+        self.crc32 = 0
+
+    def write(self, data):
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.length += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+def mapped_extents(bmap):
+    """(offset, size) in bytes of each mapped range of bmap, in order"""
+    return [(first * bmap.block_size, min((last + 1) * bmap.block_size, bmap.image_size) - first * bmap.block_size)
+            for first, last, _ in bmap.ranges]
+
+
+def _pack(image_path, name, bmap, payload):
+    """Decompresses image_path (a file called name) once and appends its mapped ranges to payload"""
+    checker = RangeChecker(bmap)
+    with open_image(image_path, name) as image:
+        for _, offset, data in read_extents(image, mapped_extents(bmap)):
+            checker.feed(offset, data)
+            payload.write(data)
+
+
+def plan_chunks(bmap, chunk_size=CHUNK_SIZE, merge_gap=MERGE_GAP):
+    """
+    (offset, size) byte extents for U-Boot to load and write one at a time:
+    the mapped ranges, neighbours less than merge_gap apart joined (the
+    hole is written too, which is cheaper than another load), split so
+    none is longer than chunk_size.
+    """
+    joined = []
+    for offset, size in mapped_extents(bmap):
+        if joined and offset - sum(joined[-1]) <= merge_gap:
+            joined[-1] = (joined[-1][0], offset + size - joined[-1][0])
+        else:
+            joined.append((offset, size))
+    return [(offset + start, min(chunk_size, size - start))
+            for offset, size in joined for start in range(0, size, chunk_size)]
+
+
+def cached_build(store, kind, key, fill):
+    """
+    Directory store/<kind>/<key>, made by fill(temporary directory) unless
+    it already exists. Returns (directory, True if it was there). Builds of
+    the same key wait for each other.
+    """
+    cache = os.path.join(store.root, kind)
+    directory = os.path.join(cache, key)
+    os.makedirs(cache, exist_ok=True)
+    with open(directory + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isdir(directory):
+            return directory, True
+        temp = tempfile.mkdtemp(dir=cache, prefix=".build-")
+        try:
+            os.chmod(temp, 0o755)
+            fill(temp)
+            os.rename(temp, directory)
+        except BaseException:
+            shutil.rmtree(temp, ignore_errors=True)
+            raise
+    return directory, False
+
+
+def import_pair(store, image_path, bmap_path):
+    """Imports the pair into store; returns (image Artifact, bmap Artifact, Bmap, image name without .xz)"""
+    image = store.add(image_path)
+    bmap_artifact = store.add(bmap_path)
+    bmap = parse_bmap(store.object_path(bmap_artifact.digest))
+    return image, bmap_artifact, bmap, re.sub(r"\.(xz|gz|bz2)$", "", os.path.basename(image_path))
+
+
+def build(image_path, bmap_path, store=default_store, device=DEVICE):
+    """
+    Returns the MappedImage for an image and its bmap, building it on first
+    use. Both files are imported into store (a stat once they are in).
+    Concurrent callers for the same pair wait for one build.
+    """
+    started = time.monotonic()
+    image, bmap_artifact, bmap, base = import_pair(store, image_path, bmap_path)
+    payload_name, writer_name = f"{base}.mapped", f"{base}.mapped.sh"
+
+    def fill(directory):
+        with open(os.path.join(directory, payload_name), "wb") as payload:
+            _pack(store.object_path(image.digest), image.name, bmap, payload)
+        with open(os.path.join(directory, writer_name), "w") as script:
+            script.write(writer_script(bmap, base, device))
+
+    directory, cached = cached_build(store, "mapped", f"{image.digest[:16]}-{bmap_artifact.digest[:16]}", fill)
+    return MappedImage(directory, payload_name, writer_name, os.path.getsize(os.path.join(directory, payload_name)),
+                       bmap.image_size, len(bmap.ranges), cached, time.monotonic() - started)
+
+
+def build_chunks(image_path, bmap_path, store=default_store, chunk_size=CHUNK_SIZE, compress=False):
+    """
+    Returns the ChunkedImage for an image and its bmap (see plan_chunks),
+    building it on first use. Chunks are padded to whole MMC blocks for
+    mmc write, or gzipped for gzwrite with compress.
+    """
+    if chunk_size % MMC_BLOCK:
+        raise ValueError(f"chunk size must be a multiple of {MMC_BLOCK}")
+    started = time.monotonic()
+    image, bmap_artifact, bmap, base = import_pair(store, image_path, bmap_path)
+    suffix = "gz" if compress else "bin"
+
+    def fill(directory):
+        chunks = []
+        checker = RangeChecker(bmap)
+        plan = plan_chunks(bmap, chunk_size)
+        with open_image(store.object_path(image.digest), image.name) as source:
+            pieces = read_extents(source, plan)
+            for index, (offset, size) in enumerate(plan):
+                name = f"{base}.{index:04d}.{suffix}"
+                with open(os.path.join(directory, name), "wb") as f:
+                    body = _CrcWriter(f)
+                    sink = gzip.GzipFile(fileobj=body, mode="wb", mtime=0) if compress else body
+                    written = 0
+                    while written < size:
+                        _, at, data = next(pieces)
+                        checker.feed(at, data)
+                        sink.write(data)
+                        written += len(data)
+                    padded = size + (-size % MMC_BLOCK)
+                    sink.write(b"\0" * (padded - size))
+                    if compress:
+                        sink.close()
+                chunks.append(asdict(Chunk(name, offset, padded, body.length, body.crc32)))
+        with open(os.path.join(directory, "chunks.json"), "w") as f:
+            json.dump({"image_size": bmap.image_size, "chunks": chunks}, f, indent=1)
+
+    key = f"{image.digest[:16]}-{bmap_artifact.digest[:16]}-{chunk_size:x}-{suffix}"
+    directory, cached = cached_build(store, "chunks", key, fill)
+    with open(os.path.join(directory, "chunks.json")) as f:
+        manifest = json.load(f)
+    return ChunkedImage(directory, [Chunk(**chunk) for chunk in manifest["chunks"]], manifest["image_size"],
+                        compress, cached, time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the mapped-blocks payload of a restore image")
+    parser.add_argument("image")
+    parser.add_argument("bmap")
+    parser.add_argument("--device", default=DEVICE, help=f"device the writer script targets (default: {DEVICE})")
+    parser.add_argument("--chunks", type=int, metavar="MB",
+                        help="cut U-Boot chunks of at most MB megabytes instead of a payload")
+    parser.add_argument("--gzip", action="store_true", help="gzip the chunks for gzwrite")
+    args = parser.parse_args()
+    if args.chunks:
+        built = build_chunks(args.image, args.bmap, chunk_size=args.chunks * 1024 * 1024, compress=args.gzip)
+    else:
+        built = build(args.image, args.bmap, device=args.device)
+    print(built.describe())
+    print(built.directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,16 +5,686 @@ import redfish
 import serial 
 import os 
 import threading 
+import re
+import time
+import urllib.parse
+import contextlib
+import shutil
+import tempfile
+
+
+from utils import monitor_task, UBOOT_PROMPT, SHELL_PROMPT, LOGIN_PROMPT, AUTOBOOT_BANNERS
+from network import stop_server, serve_artifacts, start_tftp, download_slot, publish, artifact_path
+import artifact_server
+import artifact_store
+import bmap_image
+import bmc_job
+import partition_delta
+import tftp_server
+from serial_session import aacquire_session, CommandError
+from bmc_job import JobError
+import pipeline
+from pipeline import Flow, Step, StepError, Prompt, Stage, ExitCode, PortOpen, FileHash, send, shell
+from serial_mux import AutoResponder
+from boot_stage import LOGIN, ROOT_SHELL
 
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-from utils import monitor_task, read_serial_data
-from network import stop_server, start_server
+# Longest a reboot is allowed to take before a flow gives up waiting for it
+BOOT_TIMEOUT = 180
+# Loading the rescue image over the network, then booting it like any reboot
+RESCUE_BOOT_TIMEOUT = 60 + BOOT_TIMEOUT
+# Longest writing the restore image may take, from the rescue shell or U-Boot
+EMMC_WRITE_TIMEOUT = 3600
+# Longest the BMC's web server may take to accept connections for Redfish
+REDFISH_TIMEOUT = 120
+
+# curl aborts a transfer that stays under 1 KB/s for this long so it can be resumed
+STALL_TIME = 30
+FETCH_ATTEMPTS = 4
+# curl exit codes worth resuming after: connect failure, partial file,
+# timeout/stall, empty reply, receive error
+RESUMABLE_CURL_EXITS = (7, 18, 28, 52, 56)
+# Downloads slower than this (bytes/s) after SLOW_AFTER seconds are reported
+SLOW_TRANSFER = 2 * 1024 * 1024
+SLOW_AFTER = 5
+
+# flash_emmc stream modes: the restore image goes from the artifact server
+# to the eMMC without being staged in the rescue system's RAM first
+STREAM_BMAPTOOL = "bmaptool"    # bmaptool copy reads the image URL itself
+STREAM_PIPE = "pipe"            # curl | xz -dc | dd, for a bmaptool that cannot open URLs
+STREAM_MAPPED = "mapped"        # only the bmap's blocks, decompressed on the host (see bmap_image)
+STREAM_DELTA = "delta"          # only the partitions that differ from the eMMC (see partition_delta)
+STREAM_MODES = (STREAM_BMAPTOOL, STREAM_PIPE, STREAM_MAPPED, STREAM_DELTA)
+
+# flash_emmc_uboot write modes: the restore image goes onto the eMMC from
+# U-Boot in chunks, without booting the rescue image
+UBOOT_MMC_WRITE = "mmc"         # raw chunks, mmc write
+UBOOT_GZWRITE = "gzwrite"       # gzipped chunks, inflated onto the eMMC by gzwrite
+UBOOT_WRITE_MODES = (UBOOT_MMC_WRITE, UBOOT_GZWRITE)
+# Tries per chunk before a load that keeps failing its CRC check gives up
+CHUNK_ATTEMPTS = 3
+
+# Where flasher writes the FIP (seek in 512-byte blocks) and flash_eeprom the FRU
+FIP_DEVICE = "/dev/mmcblk0boot0"
+FIP_SEEK = 256
+EEPROM_DEVICE = "/sys/bus/i2c/devices/1-0050/eeprom"
+
+
+class FlashVerifyError(Exception):
+    """A region read back after a write does not hold what was written"""
+
+
+async def wait_for_boot(ser, callback_output, since, timeout=BOOT_TIMEOUT):
+    """Waits until the BMC is back at a login prompt or shell after a reboot sent at since"""
+    callback_output("Waiting for the BMC to boot...")
+    stage = await ser.await_stage((LOGIN, ROOT_SHELL), timeout, since=since)
+    if stage is None:
+        callback_output(f"BMC did not reach a login prompt within {timeout}s (stage: {ser.stages.label}).")
+        return False
+    callback_output(f"BMC reached {ser.stages.label} {time.monotonic() - since:.1f}s after reboot.")
+    return True
+
+
+def _url_path(url):
+    """Path of a URL as the artifact server sees it, with or without a scheme"""
+    if "://" not in url:
+        url = "http://" + url
+    return urllib.parse.unquote(urllib.parse.urlsplit(url).path) or "/"
+
+
+def uboot_load_command(my_ip, name, tftp_port=None):
+    """
+    U-Boot command that loads name (a path on the artifact server, see
+    network.artifact_path) from the host to ${loadaddr}: HTTP wget by
+    default, tftpboot with large blocks and a window when given a TFTP
+    port.
+    """
+    if tftp_port is None:
+        return f'wget ${{loadaddr}} {my_ip}:/{name}'
+    port = "" if tftp_port == tftp_server.TFTP_PORT else f"setenv tftpdstp {tftp_port}; "
+    return (f'setenv serverip {my_ip}; setenv tftpblocksize {tftp_server.BLKSIZE}; '
+            f'setenv tftpwindowsize {tftp_server.WINDOWSIZE}; {port}tftpboot ${{loadaddr}} {name}')
+
+
+def rescue_boot_command(my_ip, rescue, tftp_port=None):
+    """U-Boot command that loads the rescue image and boots it"""
+    return f'{uboot_load_command(my_ip, rescue, tftp_port)}; bootm\n'
+
+
+class TransferProgress:
+    """
+    Follows one download on the artifact server and maps it onto a slice
+    (span) of a flow's progress bar. Use as a context manager around the
+    command that fetches url; client narrows it to one BMC's IP address.
+    """
+
+    def __init__(self, url, callback_progress=None, span=(0.0, 1.0), client=None, callback_output=None):
+        self.path = _url_path(url)
+        self.callback_progress = callback_progress
+        self.span = span
+        self.client = client
+        self.callback_output = callback_output
+        self.latest = None
+        self._warned = False
+        self._loop = None
+
+    def __enter__(self):
+        self._loop = asyncio.get_running_loop()
+        artifact_server.transfers.subscribe(self)
+        return self
+
+    def __exit__(self, *exc):
+        artifact_server.transfers.unsubscribe(self)
+
+    def __call__(self, event, transfer):
+        if transfer.path != self.path or (self.client and transfer.client != self.client):
+            return
+        self.latest = transfer
+        if self.callback_progress:
+            low, high = self.span
+            self._loop.call_soon_threadsafe(self.callback_progress, low + (high - low) * transfer.fraction)
+        if self.callback_output and event == artifact_server.QUEUED:
+            self._loop.call_soon_threadsafe(self.callback_output, f"Queued on the artifact server: {transfer.describe()}")
+        if (self.callback_output and not self._warned and event == artifact_server.PROGRESS
+                and transfer.elapsed > SLOW_AFTER and transfer.throughput < SLOW_TRANSFER):
+            self._warned = True
+            self._loop.call_soon_threadsafe(self.callback_output,
+                                            f"Slow transfer, check the link: {transfer.describe()}")
+
+    def summary(self):
+        """One line on the last transfer seen, or None if the server never sent the file"""
+        return self.latest.describe() if self.latest else None
+
+
+async def fetch_to_bmc(ser, url, file_name, callback_output, timeout=600, attempts=FETCH_ATTEMPTS,
+                       callback_progress=None, span=(0.0, 1.0), client=None):
+    """
+    Downloads url to file_name on the BMC with curl. A transfer that breaks
+    off or stalls is resumed with curl -C -, so a retry only fetches the
+    missing bytes. With callback_progress, the artifact server's progress
+    for the file is mapped onto span. Returns the CommandResult with elapsed
+    covering every attempt; raises CommandError when the download cannot be
+    completed.
+    """
+    await ser.arun(f"rm -f {file_name}")
+    command = f"curl -fsS -C - --speed-limit 1024 --speed-time {STALL_TIME} -o {file_name} {url}"
+    started = time.monotonic()
+    for attempt in range(1, attempts + 1):
+        with TransferProgress(url, callback_progress, span, client, callback_output) as progress:
+            result = await ser.arun(command, timeout=timeout)
+        if progress.summary():
+            callback_output(progress.summary())
+        # 416 on a retry: the previous attempt had already fetched every byte
+        if result.ok or (attempt > 1 and result.exit_code == 22 and "416" in result.output):
+            result.elapsed = time.monotonic() - started
+            return result
+        if result.exit_code is None:
+            # curl is still running on the BMC; stop it before resuming
+            await ser.asend_and_expect("\x03", (SHELL_PROMPT,), 5)
+        elif result.exit_code not in RESUMABLE_CURL_EXITS:
+            break
+        if attempt < attempts:
+            callback_output(f"Download of {file_name} interrupted, resuming (attempt {attempt + 1}/{attempts})...")
+    raise CommandError(result)
+
+async def region_digest(ser, device, size, seek=0, timeout=60):
+    """
+    SHA-256 of the size bytes at seek (512-byte blocks) on device, hashed
+    on the BMC with dd | sha256sum. None when the region cannot be read.
+    """
+    return await pipeline.digest_on_bmc(ser, device, size, seek, timeout)
+
+async def region_matches(ser, flash_file, device, callback_output, seek=0):
+    """
+    Compares flash_file with what device holds at seek, so a write that
+    would change nothing can be skipped. Returns (matches, digest, size)
+    with the host-side digest and size for the verify step (FileHash).
+    """
+    digest, size = artifact_store.hash_file(flash_file), os.path.getsize(flash_file)
+    current = await region_digest(ser, device, size, seek)
+    if current == digest:
+        callback_output(f"{device} already holds {os.path.basename(flash_file)} (sha256 {digest[:16]}), "
+                        f"skipping the write.")
+        return True, digest, size
+    return False, digest, size
+
+async def region_matches_script(ser, reader, digest, timeout=300):
+    """True when sh reader | sha256sum on the BMC prints digest"""
+    result = await ser.arun(f"sh {reader} | sha256sum", timeout=timeout)
+    match = re.search(r"\b([0-9a-f]{64})\b", result.output)
+    return bool(result.ok and match and match.group(1) == digest)
+
+async def _stale_regions(ser, mount, my_ip, bmc_ip, regions, callback_output, callback_progress=None,
+                         span=(0.0, 1.0)):
+    """
+    Fetches the reader script of each of regions (partition_delta) from
+    mount and returns the regions whose mapped data on the eMMC does not
+    hash to their digest. With callback_progress, the regions are mapped
+    onto span.
+    """
+    stale = []
+    low, high = span
+    for index, region in enumerate(regions):
+        if callback_progress:
+            callback_progress(low + (high - low) * index / len(regions))
+        await fetch_to_bmc(ser, f"{my_ip}/{artifact_path(mount, region.reader)}", region.reader, callback_output, timeout=60,
+                           client=bmc_ip)
+        if not await region_matches_script(ser, region.reader, region.digest):
+            stale.append(region)
+    return stale
+
+async def write_delta(ser, server, my_ip, bmc_ip, directory, image, bmap, callback_output, callback_progress):
+    """
+    Rewrites only the partitions of the restore image whose mapped data
+    differs from what the eMMC holds (see partition_delta), then reads each
+    rewritten one back. Covers 0.50-0.90 of the flow's progress. Returns
+    the CommandResult of the last write, None if nothing needed writing;
+    raises CommandError or FlashVerifyError.
+    """
+    callback_output("Splitting the restore image by partition on the host...")
+    delta = await asyncio.to_thread(partition_delta.build, os.path.join(directory, image),
+                                    os.path.join(directory, bmap))
+    callback_output(delta.describe())
+    mount = publish(server, delta.directory)
+    try:
+        stale = await _stale_regions(ser, mount, my_ip, bmc_ip, delta.regions, callback_output, callback_progress,
+                                     (0.50, 0.60))
+        callback_progress(0.60)
+        names = ", ".join(region.label or region.name for region in stale) or "none"
+        callback_output(f"Partitions to rewrite: {names} ({len(stale)} of {len(delta.regions)}).")
+
+        mb = 1024 * 1024
+        total = sum(region.mapped for region in stale) or 1
+        done = 0
+        result = None
+        for region in stale:
+            await fetch_to_bmc(ser, f"{my_ip}/{artifact_path(mount, region.writer)}", region.writer, callback_output, timeout=60,
+                               client=bmc_ip)
+            url = f"{my_ip}/{artifact_path(mount, region.payload)}"
+            low, high = 0.60 + 0.30 * done / total, 0.60 + 0.30 * (done + region.mapped) / total
+            callback_output(f"Writing {region.label or region.name} ({region.mapped / mb:.1f} MB)...")
+            async with download_slot(server, my_ip, bmc_ip, region.payload, callback_output):
+                with TransferProgress(url, callback_progress, (low, high), bmc_ip, callback_output) as progress:
+                    result = await ser.arun(f"set -o pipefail; curl -fsS --speed-limit 1024 --speed-time "
+                                            f"{STALL_TIME} http://{url} | sh {region.writer}", timeout=900)
+            if progress.summary():
+                callback_output(progress.summary())
+            if not result.ok:
+                if result.exit_code is None:
+                    await ser.asend_and_expect("\x03", (SHELL_PROMPT,), 5)
+                raise CommandError(result)
+            callback_output(result.output)
+            done += region.mapped
+
+        if stale:
+            await ser.arun("sync; echo 3 > /proc/sys/vm/drop_caches")
+        for region in stale:
+            if not await region_matches_script(ser, region.reader, region.digest):
+                raise FlashVerifyError(f"{region.label or region.name} does not read back as written")
+        if stale:
+            callback_output(f"Verified {len(stale)} rewritten partitions.")
+        await ser.arun(f"rm -f {' '.join(region.reader for region in delta.regions)} "
+                       f"{' '.join(region.writer for region in stale)}")
+        callback_progress(0.90)
+        return result
+    finally:
+        mount.stop()
+
+async def install_restore_image(ser, server, my_ip, bmc_ip, image, bmap, callback_output, callback_progress,
+                                stream=None, directory=None):
+    """
+    Writes the restore image to /dev/mmcblk0 from the rescue shell,
+    covering 0.50-0.90 of the flow's progress. By default the image and its
+    bmap are downloaded to the BMC and then copied; with a stream mode the
+    download and the write overlap and nothing is staged. STREAM_DELTA
+    only rewrites the partitions that differ (write_delta). STREAM_MAPPED
+    and STREAM_DELTA need the local directory holding image and bmap. A
+    stream that fails falls back to the staged download. Returns the CommandResult of the
+    write; raises CommandError.
+    """
+    url = f"{my_ip}/{artifact_path(server, image)}"
+    if stream in STREAM_MODES:
+        mount = None
+        try:
+            if stream == STREAM_DELTA:
+                return await write_delta(ser, server, my_ip, bmc_ip, directory, image, bmap, callback_output,
+                                         callback_progress)
+            if stream == STREAM_MAPPED:
+                callback_output("Decompressing the mapped blocks of the restore image on the host...")
+                mapped = await asyncio.to_thread(bmap_image.build, os.path.join(directory, image),
+                                                 os.path.join(directory, bmap))
+                callback_output(mapped.describe())
+                mount = publish(server, mapped.directory)
+                callback_output("Grabbing the writer script...")
+                await fetch_to_bmc(ser, f"{my_ip}/{artifact_path(mount, mapped.writer_name)}", mapped.writer_name, callback_output,
+                                   timeout=60, callback_progress=callback_progress, span=(0.50, 0.52),
+                                   client=bmc_ip)
+                url = f"{my_ip}/{artifact_path(mount, mapped.payload_name)}"
+                command = (f"set -o pipefail; curl -fsS --speed-limit 1024 --speed-time {STALL_TIME} http://{url}"
+                           f" | sh {mapped.writer_name}")
+            else:
+                callback_output("Grabbing the mapping file...")
+                await fetch_to_bmc(ser, f"{my_ip}/{artifact_path(server, bmap)}", bmap, callback_output, timeout=60,
+                                   callback_progress=callback_progress, span=(0.50, 0.52), client=bmc_ip)
+                if stream == STREAM_BMAPTOOL:
+                    command = f"bmaptool copy --bmap {bmap} http://{url} /dev/mmcblk0"
+                else:
+                    # Writes every block: plain dd cannot skip the holes the bmap describes
+                    command = (f"set -o pipefail; curl -fsS --speed-limit 1024 --speed-time {STALL_TIME} "
+                               f"http://{url} | xz -dc | dd of=/dev/mmcblk0 bs=4M conv=fsync")
+            callback_output(f"Streaming the restore image onto the eMMC ({stream})...")
+            async with download_slot(server, my_ip, bmc_ip, image, callback_output):
+                with TransferProgress(url, callback_progress, (0.52, 0.90), bmc_ip, callback_output) as progress:
+                    result = await ser.arun(command, timeout=900)
+            if progress.summary():
+                callback_output(progress.summary())
+            if result.ok:
+                callback_output(result.output)
+                callback_output(f"Image streamed and written in {result.elapsed:.1f}s.")
+                callback_progress(0.90)
+                return result
+            callback_output(result.output)
+            callback_output(f"Streaming failed ({CommandError(result)}), downloading the image first instead.")
+            if result.exit_code is None:
+                await ser.asend_and_expect("\x03", (SHELL_PROMPT,), 5)
+        except Exception as e:
+            callback_output(f"Cannot stream the restore image ({e}), downloading it first instead.")
+        finally:
+            if mount is not None:
+                mount.stop()
+        url = f"{my_ip}/{artifact_path(server, image)}"
+
+    callback_output("Grabbing restore image to your system...")
+    async with download_slot(server, my_ip, bmc_ip, image, callback_output):
+        result = await fetch_to_bmc(ser, url, image, callback_output, timeout=600,
+                                    callback_progress=callback_progress, span=(0.50, 0.85), client=bmc_ip)
+    callback_output(f"Image downloaded in {result.elapsed:.1f}s.")
+    callback_progress(0.85)
+
+    callback_output("Grabbing the mapping file...")
+    await fetch_to_bmc(ser, f"{my_ip}/{artifact_path(server, bmap)}", bmap, callback_output, timeout=60,
+                       callback_progress=callback_progress, span=(0.85, 0.90), client=bmc_ip)
+    callback_progress(0.90)
+
+    callback_output("Flashing the restore image to your system...")
+    result = await ser.arun(f"bmaptool copy {image} /dev/mmcblk0", timeout=900, check=True)
+    callback_output(result.output)
+    return result
+
+async def write_emmc_from_uboot(ser, server, my_ip, directory, image, bmap, callback_output, callback_progress,
+                                tftp_port=None, mode=UBOOT_MMC_WRITE, span=(0.20, 0.90)):
+    """
+    Writes the restore image to eMMC device 0 from the U-Boot prompt. The
+    host cuts the bmap's mapped ranges into chunks (bmap_image.build_chunks)
+    and U-Boot loads each one into RAM, checks its CRC32 against the host's
+    and writes it with mmc write, or gzwrite in UBOOT_GZWRITE mode. A chunk
+    that arrives damaged is loaded again. Progress covers span. Raises
+    Exception when a chunk cannot be loaded intact or written.
+    """
+    callback_output("Cutting the restore image into chunks for U-Boot on the host...")
+    chunked = await asyncio.to_thread(bmap_image.build_chunks, os.path.join(directory, image),
+                                      os.path.join(directory, bmap), compress=mode == UBOOT_GZWRITE)
+    callback_output(chunked.describe())
+    mount = publish(server, chunked.directory)
+    try:
+        await ser.arun_uboot("mmc dev 0 0", timeout=10, check=True)
+        low, high = span
+        written = 0
+        started = time.monotonic()
+        for index, chunk in enumerate(chunked.chunks, 1):
+            for attempt in range(1, CHUNK_ATTEMPTS + 1):
+                loaded = await ser.arun_uboot(uboot_load_command(my_ip, artifact_path(mount, chunk.name), tftp_port), timeout=120)
+                crc = None
+                if loaded.ok:
+                    result = await ser.arun_uboot("crc32 ${loadaddr} ${filesize}", timeout=10)
+                    match = re.search(r"==>\s*([0-9a-fA-F]{8})", result.output)
+                    crc = int(match.group(1), 16) if match else None
+                elif loaded.exit_code is None:
+                    # Still loading: stop it before trying again
+                    await ser.asend_and_expect("\x03", (UBOOT_PROMPT,), 5)
+                if crc == chunk.crc32:
+                    break
+                if not loaded.ok:
+                    problem = "did not load"
+                elif crc is None:
+                    problem = "gave no CRC"
+                else:
+                    problem = f"has CRC {crc:08x}, expected {chunk.crc32:08x}"
+                callback_output(f"Chunk {index}/{len(chunked.chunks)} {problem} (attempt {attempt}/{CHUNK_ATTEMPTS}).")
+            else:
+                raise Exception(f"Chunk {chunk.name} could not be loaded intact")
+            if mode == UBOOT_GZWRITE:
+                command = f"gzwrite mmc 0 ${{loadaddr}} ${{filesize}} 100000 {chunk.offset:x}"
+            else:
+                command = f"mmc write ${{loadaddr}} {chunk.block:x} {chunk.blocks:x}"
+            result = await ser.arun_uboot(command, timeout=300)
+            if not result.ok:
+                raise Exception(f"Writing chunk {chunk.name} failed ({CommandError(result)}): {result.output}")
+            written += chunk.length
+            callback_progress(low + (high - low) * written / max(chunked.length, 1))
+        callback_output(f"Wrote {len(chunked.chunks)} chunks from U-Boot in {time.monotonic() - started:.1f}s.")
+    finally:
+        mount.stop()
+
+# ---------- Step definitions ----------
+# The flows below, and through them Flash All and the multi-unit window,
+# run these sequences with pipeline.run on a Flow holding their values.
+
+def _writing(flow):
+    """False once the check step found the region already holding the file"""
+    return not flow.skip
+
+
+def _check(device, seek=0):
+    async def action(flow):
+        flow.skip, flow.digest, flow.size = await region_matches(flow.ser, flow.flash_file, device,
+                                                                 flow.callback_output, seek)
+    return action
+
+
+def _fetch(span, timeout):
+    async def action(flow):
+        result = await fetch_to_bmc(flow.ser, flow.url, flow.file_name, flow.callback_output, timeout=timeout,
+                                    callback_progress=flow.callback_progress, span=span)
+        flow.callback_output(f"Downloaded {flow.file_name} in {result.elapsed:.1f}s.")
+    return action
+
+
+def _write_region_steps(label, device, seek, span, timeout):
+    """dd the fetched file onto device, read it back after dropping the page cache, remove the file"""
+    return (
+        Step(f"Write {label}", shell(lambda flow: f"dd if={flow.file_name} of={device} bs=512 seek={seek}"),
+             ExitCode(), timeout, f"Flashing {label}...", span, when=_writing),
+        Step(f"Verify {label}", shell("sync; echo 3 > /proc/sys/vm/drop_caches"),
+             FileHash(device, lambda flow: flow.digest, lambda flow: flow.size, seek), 60, when=_writing),
+        Step(f"Remove {label} file", shell(lambda flow: f"rm -f {flow.file_name}"), ExitCode(log=False), 10,
+             when=_writing),
+    )
+
+
+async def _register_eeprom(flow):
+    # Fails harmlessly if the device was already added
+    result = await flow.ser.arun("echo 24c02 0x50 > /sys/class/i2c-adapter/i2c-1/new_device", timeout=10)
+    if not result.ok:
+        flow.callback_output("EEPROM device already registered, continuing.")
+
+
+async def _write_from_uboot(flow):
+    await write_emmc_from_uboot(flow.ser, flow.server, flow.my_ip, flow.directory, flow.image, flow.bmap,
+                                flow.callback_output, flow.callback_progress, flow.tftp_port, flow.uboot_write)
+
+
+async def _install_restore_image(flow):
+    return await install_restore_image(flow.ser, flow.server, flow.my_ip, flow.bmc_ip, flow.image, flow.bmap,
+                                       flow.callback_output, flow.callback_progress, flow.stream, flow.directory)
+
+
+def _from_uboot(flow):
+    return bool(flow.uboot_write)
+
+
+def _from_rescue(flow):
+    return not flow.uboot_write
+
+
+def _digest(path):
+    # serve_artifacts has already put the file in the store, so this is a stat check
+    return artifact_store.default_store.add(path).digest
+
+
+async def run_job(flow, job, timeout):
+    """
+    Publishes job's script on flow.server and runs it on the BMC (see
+    bmc_job.follow), following its downloads on the artifact server. Its
+    large download holds a transfer slot from before the job starts until
+    that step is done. Returns the job's end status. Raises JobError, with
+    started False only if nothing ran on the BMC; a job that fails once
+    launched is interrupted first.
+    """
+    directory = tempfile.mkdtemp(prefix="platypus-job-")
+    client = getattr(flow, "bmc_ip", None)
+    large = [transfer for transfer in job.transfers if transfer.large]
+    with contextlib.ExitStack() as cleanup:
+        cleanup.callback(shutil.rmtree, directory, ignore_errors=True)
+        slots = contextlib.AsyncExitStack()
+        try:
+            path = os.path.join(directory, job.script_name)
+            with open(path, "w") as f:
+                f.write(job.render())
+            mount = publish(flow.server, path)
+            cleanup.callback(mount.stop)
+            for transfer in large:
+                await slots.enter_async_context(download_slot(flow.server, flow.my_ip, client,
+                                                              os.path.basename(_url_path(transfer.url)),
+                                                              flow.callback_output))
+            for transfer in job.transfers:
+                cleanup.enter_context(TransferProgress(transfer.url, flow.callback_progress, transfer.span,
+                                                       client, flow.callback_output))
+        except Exception as e:
+            await slots.aclose()
+            raise JobError(f"cannot publish job script {job.script_name} ({e})") from e
+
+        async def release_slots(event):
+            if large and event.get("event") == "done" and event.get("step") == large[-1].step:
+                await slots.aclose()
+
+        try:
+            url = f"{flow.my_ip}:{flow.port}/{artifact_path(mount, job.script_name)}"
+            return await bmc_job.follow(flow.ser, job, url, flow.callback_output, flow.callback_progress, timeout,
+                                        release_slots)
+        except JobError:
+            raise
+        except Exception as e:
+            # The script may still be writing: stop it before anything else touches the target
+            with contextlib.suppress(Exception):
+                await bmc_job.interrupt(flow.ser)
+            raise JobError(f"job {job.id} stopped: {e}", started=True) from e
+        finally:
+            await slots.aclose()
+
+
+def _job_step(name, build, fallback, timeout, when=None):
+    """
+    A Step that runs the Job build(flow) returns as one script on the BMC
+    and sets flow.skip if it found nothing to write. If the script cannot
+    be built, published or fetched, or flow.job is False, the fallback
+    steps run instead, one console command at a time. A job that fails
+    once it has started is not retried that way.
+    """
+    async def action(flow):
+        if flow.job:
+            try:
+                try:
+                    job = await asyncio.to_thread(build, flow)
+                except Exception as e:
+                    raise JobError(f"cannot build the job script ({e})") from e
+                status = await run_job(flow, job, timeout)
+                flow.skip = status == bmc_job.UNCHANGED
+                return status
+            except JobError as e:
+                if e.started:
+                    raise
+                flow.callback_output(f"{e}, sending the commands one by one.")
+        await pipeline.run(fallback, flow)
+    return Step(name, action, timeout=timeout + sum(step.timeout for step in fallback), when=when)
+
+
+def _restore_job(flow):
+    job = bmc_job.Job(f"write {flow.image} to /dev/mmcblk0")
+    job.fetch("image", f"{flow.my_ip}/{artifact_path(flow.server, flow.image)}", flow.image, _digest(os.path.join(flow.directory, flow.image)),
+              (0.50, 0.85), FETCH_ATTEMPTS, STALL_TIME, large=True, message="Grabbing restore image to your system...")
+    job.fetch("bmap", f"{flow.my_ip}/{artifact_path(flow.server, flow.bmap)}", flow.bmap, _digest(os.path.join(flow.directory, flow.bmap)),
+              (0.85, 0.90), FETCH_ATTEMPTS, STALL_TIME, message="Grabbing the mapping file...")
+    job.step("write", 0.90, [f"bmaptool copy {flow.image} /dev/mmcblk0"],
+             "Flashing the restore image to your system...")
+    job.step("cleanup", 0.90, [f"rm -f {flow.image} {flow.bmap}"])
+    return job
+
+
+def _region_job(flow, title, device, seek, prepare, fetch_span):
+    """Job for FIP and EEPROM: prepare steps, skip if unchanged, fetch, write, verify, clean up"""
+    digest, size = _digest(flow.flash_file), os.path.getsize(flow.flash_file)
+    job = bmc_job.Job(f"write {flow.file_name} to {device}")
+    for name, progress, line, message in prepare:
+        job.step(name, progress, [line], message)
+    job.unchanged_if("check", device, digest, size, seek,
+                     f"{device} already holds {flow.file_name} (sha256 {digest[:16]}), skipping the write.")
+    job.fetch("fetch", flow.url, flow.file_name, digest, fetch_span, FETCH_ATTEMPTS, STALL_TIME)
+    job.step("write", 0.9, [f"dd if={flow.file_name} of={device} bs=512 seek={seek}"], f"Flashing {title}...")
+    job.verify("verify", device, digest, size, seek, 1.0)
+    job.step("cleanup", 1.0, [f"rm -f {flow.file_name}"])
+    return job
+
+
+def _fip_job(flow):
+    return _region_job(flow, "FIP", FIP_DEVICE, FIP_SEEK,
+                       [("unlock", 0.2, "echo 0 > /sys/block/mmcblk0boot0/force_ro", "Changing MMC to RW...")],
+                       (0.2, 0.8))
+
+
+def _eeprom_job(flow):
+    return _region_job(flow, "EEPROM", EEPROM_DEVICE, 0,
+                       [("power", 0.4, "obmcutil poweron", "Powering on..."),
+                        # Fails harmlessly if the device was already added
+                        ("register", 0.6, "echo 24c02 0x50 > /sys/class/i2c-adapter/i2c-1/new_device || true",
+                         "Configuring EEPROM...")],
+                       (0.6, 0.8))
+
+
+# The restore image from the rescue shell, one console command at a time
+RESTORE_COMMAND_STEPS = (
+    Step("Write restore image", _install_restore_image, timeout=EMMC_WRITE_TIMEOUT, span=(0.50, 0.90)),
+)
+
+# eMMC from the U-Boot prompt: through the rescue image, or written by
+# U-Boot itself with uboot_write. Values: bmc_ip, my_ip, port, directory,
+# server, tftp_port, image, bmap, rescue, stream, uboot_write, reboot, job
+# (the staged restore image as one job script; streams run their commands).
+EMMC_STEPS = (
+    Step("Set IP (bootloader)", send(lambda flow: f"setenv ipaddr {flow.bmc_ip}\n"), Prompt((UBOOT_PROMPT,)), 5,
+         "Setting IP Address (bootloader)...", (0.10, 0.20)),
+    Step("Write from U-Boot", _write_from_uboot, timeout=EMMC_WRITE_TIMEOUT, span=(0.20, 0.90), when=_from_uboot),
+    Step("Boot rescue image", send(lambda flow: rescue_boot_command(flow.my_ip, artifact_path(flow.server, flow.rescue), flow.tftp_port)),
+         Prompt((SHELL_PROMPT,), fail=(UBOOT_PROMPT,)), RESCUE_BOOT_TIMEOUT, "Grabbing virtual restore image...", (0.20, 0.40),
+         when=_from_rescue,
+         watch=lambda flow: TransferProgress(f"{flow.my_ip}/{artifact_path(flow.server, flow.rescue)}", flow.callback_progress, (0.20, 0.40),
+                                             flow.bmc_ip)),
+    # Before the job: the rescue shell has no address to fetch its script with
+    Step("Set IP (BMC)", shell(lambda flow: f"ifconfig eth0 up {flow.bmc_ip}"), ExitCode(), 10,
+         "Setting IP Address (BMC)...", (0.40, 0.50), when=_from_rescue),
+    _job_step("Restore image", _restore_job, RESTORE_COMMAND_STEPS, EMMC_WRITE_TIMEOUT, when=_from_rescue),
+    Step("Reboot", send(lambda flow: "reset\n" if flow.uboot_write else "reboot\n", leaves_shell=True),
+         Stage((LOGIN, ROOT_SHELL)), BOOT_TIMEOUT, "Factory Reset Complete. Please let the BMC reboot.",
+         (1.00, 1.00), when=lambda flow: flow.reboot),
+)
+
+# FIP (U-Boot) from a root shell, one console command at a time, skipped
+# if FIP_DEVICE already holds it. Values: flash_file, file_name, url.
+FIP_COMMAND_STEPS = (
+    Step("Check FIP", _check(FIP_DEVICE, FIP_SEEK), timeout=60),
+    Step("Fetch FIP", _fetch((0.2, 0.6), 120), timeout=120 * FETCH_ATTEMPTS, span=(0.2, 0.6), when=_writing),
+    Step("Make FIP writable", shell("echo 0 > /sys/block/mmcblk0boot0/force_ro"), ExitCode(), 10,
+         "Changing MMC to RW...", (0.6, 0.8), when=_writing),
+) + _write_region_steps("FIP", FIP_DEVICE, FIP_SEEK, (0.8, 1.0), 120)
+
+# The same as one job script. More values: my_ip, port, server, job.
+FIP_STEPS = (
+    _job_step("Flash FIP", _fip_job, FIP_COMMAND_STEPS, 120 * FETCH_ATTEMPTS + 300),
+)
+
+# FRU into the EEPROM from a root shell, one console command at a time;
+# nothing is written if EEPROM_DEVICE already holds it. Values as FIP_STEPS.
+EEPROM_COMMAND_STEPS = (
+    Step("Power on", shell("obmcutil poweron"), ExitCode(), 30, "Powering on...", (0.2, 0.4)),
+    Step("Register EEPROM", _register_eeprom, timeout=10, message="Configuring EEPROM...", span=(0.4, 0.6)),
+    Step("Check EEPROM", _check(EEPROM_DEVICE), timeout=60),
+    Step("Fetch FRU", _fetch((0.6, 0.8), 60), timeout=60 * FETCH_ATTEMPTS, message="Fetching FRU binary...",
+         span=(0.6, 0.8), when=_writing),
+) + _write_region_steps("EEPROM", EEPROM_DEVICE, 0, (0.8, 1.0), 60)
+
+# The same as one job script, then a reboot if anything was written
+EEPROM_STEPS = (
+    _job_step("Flash EEPROM", _eeprom_job, EEPROM_COMMAND_STEPS, 60 * FETCH_ATTEMPTS + 300),
+    Step("Reboot", send("obmcutil poweroff && reboot\n", leaves_shell=True), message="Rebooting system...",
+         when=_writing),
+)
+
+# The BMC's web server accepts connections, before a Redfish login. Values: bmc_ip.
+REDFISH_STEPS = (
+    Step("Redfish", probe=PortOpen(lambda flow: flow.bmc_ip, 443), timeout=REDFISH_TIMEOUT,
+         message="Waiting for the BMC's Redfish service..."),
+)
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Updates the BMC firmware through redfish 
 async def bmc_update(bmc_user, bmc_pass, bmc_ip, fw_content, callback_progress, callback_output):
     callback_output("Initializing Red Fish client...")
+    try:
+        await pipeline.run(REDFISH_STEPS, Flow(None, callback_output, callback_progress, bmc_ip=bmc_ip))
+    except StepError as e:
+        callback_output(f"Error: {e}")
+        return
     redfish_client = redfish.redfish_client(base_url=f"https://{bmc_ip}", username=bmc_user, password=bmc_pass)
     callback_progress(0.25)
     
@@ -52,34 +722,147 @@ async def bmc_update(bmc_user, bmc_pass, bmc_ip, fw_content, callback_progress,
 
 # Power on the host through serial
 async def power_host(callback_output, serial_device):
-    ser = serial.Serial(serial_device, 115200, timeout=1)
-    ser.dtr = True
-    command = f"obmcutil poweron\n"
+    ser = await aacquire_session(serial_device, owner="power_host")
 
     callback_output("Running...")
 
-    try:            
-        ser.write(command.encode('utf-8'))
-
-        response = ser.read_until(b'\n')
-        callback_output(response.decode('utf-8'))
-
+    try:
+        # Done when obmcutil exits, rather than after a fixed wait
+        await pipeline.run((Step("Power on", shell("obmcutil poweron"), ExitCode(), 30),),
+                           Flow(ser, callback_output, lambda value: None))
     except Exception as e:
-        if "device reports readiness to read but returned no data" in str(e):
-            callback_output(f"Error: {e}")
-            callback_output("Host powered on.")
-        else: 
-            callback_output(f"Error: {e}")
-            callback_output("Exiting Process. Host not powered on.")
-        return 
+        callback_output(f"Error: {e}")
+        callback_output("Exiting Process. Host not powered on.")
+        return
+    finally:
+        ser.release()
     callback_output("Host powered on.")
-    await asyncio.sleep(5)
 
 
+# Boots the BMC from its eMMC through serial
+async def boot_from_uboot(callback_output, serial_device):
+    """
+    Boots the BMC from its eMMC if it sits at the U-Boot prompt. Returns
+    True once it is at a login prompt or shell, whether it was already
+    there or got there by booting.
+    """
+    ser = await aacquire_session(serial_device, owner="boot_from_uboot")
+    try:
+        probe = await ser.asend_and_expect("\n", (UBOOT_PROMPT, SHELL_PROMPT, LOGIN_PROMPT), 2)
+        if probe.pattern in (SHELL_PROMPT, LOGIN_PROMPT):
+            return True
+        if probe.pattern != UBOOT_PROMPT:
+            callback_output("BMC does not answer on the console.")
+            return False
+        callback_output("Booting the BMC from its eMMC...")
+        booted_at = time.monotonic()
+        ser.write(b"boot\n")
+        ser.prompt = None
+        return await wait_for_boot(ser, callback_output, booted_at)
+    except Exception as e:
+        callback_output(f"Error: {e}")
+        return False
+    finally:
+        ser.release()
+
+# Reads which unit hangs off the serial console
+async def unit_identity(callback_output, serial_device):
+    """
+    The unit's MAC address: U-Boot's ethaddr at the U-Boot prompt, eth0's
+    at a root shell. It tells units apart where the console path does not
+    (boards swapped on the same adapter). None at a login prompt or when it
+    cannot be read.
+    """
+    ser = await aacquire_session(serial_device, owner="unit_identity")
+    try:
+        probe = await ser.asend_and_expect("\n", (UBOOT_PROMPT, SHELL_PROMPT, LOGIN_PROMPT), 2)
+        if probe.pattern == UBOOT_PROMPT:
+            result = await ser.arun_uboot("printenv ethaddr", timeout=5)
+        elif probe.pattern == SHELL_PROMPT:
+            result = await ser.arun("cat /sys/class/net/eth0/address", timeout=5)
+        else:
+            return None
+        # The prompt follows the end marker; take it so the next command does not see it as its own
+        await ser.aexpect((probe.pattern,), 2)
+        match = re.search(r"\b[0-9a-f]{2}(?::[0-9a-f]{2}){5}\b", result.output.lower())
+        return match.group(0) if match else None
+    except Exception as e:
+        callback_output(f"Error: {e}")
+        return None
+    finally:
+        ser.release()
+
+# Tells the rescue image from the one on the eMMC
+async def in_rescue_image(callback_output, serial_device):
+    """
+    True when the BMC runs the rescue image, as its /etc/os-release says;
+    False for the eMMC's image, including at its login prompt (the rescue
+    image logs root in by itself). None at U-Boot or without an answer.
+    """
+    ser = await aacquire_session(serial_device, owner="in_rescue_image")
+    try:
+        probe = await ser.asend_and_expect("\n", (UBOOT_PROMPT, SHELL_PROMPT, LOGIN_PROMPT), 2)
+        if probe.pattern == LOGIN_PROMPT:
+            return False
+        if probe.pattern != SHELL_PROMPT:
+            return None
+        result = await ser.arun("cat /etc/os-release", timeout=5)
+        await ser.aexpect((SHELL_PROMPT,), 2)
+        if not result.ok:
+            return None
+        return "rescue" in result.output.lower()
+    except Exception as e:
+        callback_output(f"Error: {e}")
+        return None
+    finally:
+        ser.release()
+
+# Checks the eMMC against the restore image through serial
+async def emmc_holds(bmc_ip, directory, my_ip, dd_value, callback_output, serial_device):
+    """
+    True when every partition of the restore image in directory reads back
+    from the eMMC as partition_delta expects. Partitions the running image
+    has mounted read-write are left out: booting changes them. Needs a root
+    shell with the BMC's IP set.
+    """
+    type = 'mos-bmc' if dd_value == 1 else 'nanobmc'
+    image, bmap = f"obmc-phosphor-image-snuc-{type}.wic.xz", f"obmc-phosphor-image-snuc-{type}.wic.bmap"
+    httpd = mount = ser = None
+    try:
+        delta = await asyncio.to_thread(partition_delta.build, os.path.join(directory, image),
+                                        os.path.join(directory, bmap))
+        httpd = serve_artifacts(directory, 80, callback_output)
+        mount = publish(httpd, delta.directory)
+        ser = await aacquire_session(serial_device, owner="emmc_holds")
+
+        mounts = await ser.arun("cat /proc/mounts", timeout=10)
+        writable = set(re.findall(r"^/dev/mmcblk0(p\d+) \S+ \S+ rw\b", mounts.output, re.M))
+        regions = [region for region in delta.regions if region.name not in writable]
+        if writable:
+            callback_output(f"Not checking {', '.join(sorted(writable))}: mounted read-write.")
+        stale = await _stale_regions(ser, mount, my_ip, bmc_ip, regions, callback_output)
+        await ser.arun(f"rm -f {' '.join(region.reader for region in regions)}")
+        await ser.aexpect((SHELL_PROMPT,), 2)
+        if stale:
+            names = ", ".join(region.label or region.name for region in stale)
+            callback_output(f"eMMC does not hold {image}: {names} differ.")
+            return False
+        callback_output(f"eMMC holds {image} ({len(regions)} of {len(delta.regions)} partitions checked).")
+        return True
+    except Exception as e:
+        callback_output(f"Error: {e}")
+        return False
+    finally:
+        if ser:
+            ser.release()
+        if mount:
+            mount.stop()
+        if httpd:
+            stop_server(httpd, callback_output)
+
 # Reboots the BMC through serial
 async def reboot_bmc(callback_output, serial_device):
-    ser = serial.Serial(serial_device, 115200, timeout=1)
-    ser.dtr = True
+    ser = await aacquire_session(serial_device, owner="reboot_bmc")
     command = f"reboot\n"
 
     callback_output("Running...")
@@ -87,7 +870,7 @@ async def reboot_bmc(callback_output, serial_device):
     try: 
         ser.write(command.encode('utf-8'))
 
-        response = ser.read_until(b'\n')
+        response = await ser.aread_until(b'\n')
         callback_output(response.decode('utf-8'))
             
 
@@ -100,140 +883,129 @@ async def reboot_bmc(callback_output, serial_device):
             callback_output(f"Error: {e}")
             callback_output("Exiting Process.")
         return 
+    finally:
+        # The BMC leaves the shell, so the tracked prompt is no longer valid
+        ser.prompt = None
+        ser.logged_in = False
+        ser.release()
     callback_output("Rebooting...")
     callback_output("Please give the BMC time to finish rebooting")
 
 # Flashes the U-Boot of the BMC through serial
-async def flasher(flash_file, my_ip, callback_progress, callback_output, serial_device):
-    directory = os.path.dirname(flash_file)
+async def flasher(flash_file, my_ip, callback_progress, callback_output, serial_device, server=None, job=True):
+    """
+    Runs FIP_STEPS. server is an artifact server already running (the
+    multi-unit window's shared one), on which flash_file is published for
+    the flash; without it one is started. Without job the console commands are sent one
+    at a time instead of as one job script.
+    """
     file_name = os.path.basename(flash_file)
     port = 80
 
-    httpd = start_server(directory, port, callback_output)
+    httpd = server or serve_artifacts(flash_file, port, callback_output)
+    # A shared server publishes a directory that need not hold flash_file
+    published = publish(server, flash_file) if server else httpd
     callback_progress(0.2)
 
-    ser = serial.Serial(serial_device, 115200, timeout=1)
-    ser.dtr = True
+    ser = await aacquire_session(serial_device, owner="flasher")
 
     try:
-        url = f"http://{my_ip}:{port}/{file_name}"
-        curl_command = f"curl -o {file_name} {url}\n"
-        ser.write(curl_command.encode('utf-8'))
-        await asyncio.sleep(5)
-        callback_output('Curl command sent.')
-
-        callback_progress(0.6)
-
-        command = "echo 0 > /sys/block/mmcblk0boot0/force_ro\n"
-        ser.write(command.encode('utf-8'))
-        await asyncio.sleep(4)
-        callback_output('Changed MMC to RW')
-
-        callback_progress(0.8)
-
-        command = f'dd if={file_name} of=/dev/mmcblk0boot0 bs=512 seek=256\n'
-        ser.write(command.encode('utf-8'))
-        await asyncio.sleep(7)
+        flow = Flow(ser, callback_output, callback_progress, flash_file=flash_file, file_name=file_name,
+                    url=f"http://{my_ip}:{port}/{artifact_path(published, file_name)}", my_ip=my_ip, port=port,
+                    server=httpd, job=job)
+        await pipeline.run(FIP_STEPS, flow)
         callback_output("Flashing complete")
         callback_progress(1)
-
-        # Remove fip.bin after flashing
-        remove_command = "rm -f fip.bin\n"
-        ser.write(remove_command.encode('utf-8'))
-        await asyncio.sleep(2)
-        callback_output("fip.bin removed successfully.")
+        return True
+    except CommandError as e:
+        callback_output(f"Error: {e}")
+        if e.result.output:
+            callback_output(e.result.output)
+        callback_output("Flash unsuccessful.")
+    except (StepError, JobError) as e:
+        callback_output(f"Error: {e}")
+        callback_output("Flash unsuccessful.")
     except serial.SerialException as e:
         callback_output(f"Serial Error: {e}")
     finally:
-        ser.close()
-        stop_server(httpd, callback_output)
+        ser.release()
+        if server is None:
+            stop_server(httpd, callback_output)
+        else:
+            published.stop()
         callback_progress(0)
 
 
 
 # Flash EEPROM through serial
-async def flash_eeprom(flash_file, my_ip, callback_progress, callback_output, serial_device):
-    directory = os.path.dirname(flash_file)
+async def flash_eeprom(flash_file, my_ip, callback_progress, callback_output, serial_device, server=None,
+                       job=True):
+    """Runs EEPROM_STEPS; server and job as for flasher"""
     file_name = os.path.basename(flash_file)
     port = 80
 
     # Start HTTP server
-    httpd = start_server(directory, port, callback_output)
+    httpd = server or serve_artifacts(flash_file, port, callback_output)
+    published = publish(server, flash_file) if server else httpd
     callback_progress(0.2)
 
-    ser = serial.Serial(serial_device, 115200, timeout=1)
-    ser.dtr = True
+    ser = await aacquire_session(serial_device, owner="flash_eeprom")
 
     try:
-        # Power on
-        callback_output("Powering on...")
-        ser.write(b"obmcutil poweron\n")
-        await asyncio.sleep(8)
-        callback_progress(0.4)
-
-        # Configure EEPROM
-        callback_output("Configuring EEPROM...")
-        ser.write(b"echo 24c02 0x50 > /sys/class/i2c-adapter/i2c-1/new_device\n")
-        await asyncio.sleep(8)
-        callback_progress(0.6)
-
-        # Fetch FRU binary
-        url = f"http://{my_ip}:{port}/{file_name}"
-        curl_command = f"curl -o {file_name} {url}\n"
-        ser.write(curl_command.encode('utf-8'))
-        await asyncio.sleep(8)
-        callback_output(f"Fetching FRU binary from {url}")
-
-        callback_progress(0.8)
-
-        # Flash EEPROM
-        callback_output("Flashing EEPROM...")
-        flash_command = f"dd if={file_name} of=/sys/bus/i2c/devices/1-0050/eeprom\n"
-        ser.write(flash_command.encode('utf-8'))
-        await asyncio.sleep(8)
+        flow = Flow(ser, callback_output, callback_progress, flash_file=flash_file, file_name=file_name,
+                    url=f"http://{my_ip}:{port}/{artifact_path(published, file_name)}", my_ip=my_ip, port=port,
+                    server=httpd, job=job)
+        await pipeline.run(EEPROM_STEPS, flow)
         callback_output("Flashing complete.")
         callback_progress(1.0)
+        return True
 
-        # Remove FRU binary
-        callback_output("Removing FRU binary...")
-        remove_command = f"rm -f {file_name}\n"
-        ser.write(remove_command.encode('utf-8'))
-        await asyncio.sleep(5)
-        callback_output("FRU binary removed successfully.")
-
-        # Reboot
-        callback_output("Rebooting system...")
-        ser.write(b"obmcutil poweroff && reboot\n")
-        await asyncio.sleep(5)
-        callback_output("System reboot initiated.")
-        
+    except CommandError as e:
+        callback_output(f"Error: {e}")
+        if e.result.output:
+            callback_output(e.result.output)
+        callback_output("EEPROM flash unsuccessful.")
+    except (StepError, JobError) as e:
+        callback_output(f"Error: {e}")
+        callback_output("EEPROM flash unsuccessful.")
     except serial.SerialException as e:
         callback_output(f"Serial Error: {e}")
     finally:
-        ser.close()
-        stop_server(httpd, callback_output)
+        ser.release()
+        if server is None:
+            stop_server(httpd, callback_output)
+        else:
+            published.stop()
         callback_progress(0)
 
         
         
 async def bmc_factory_reset(callback_output, serial_device):
-    ser = serial.Serial(serial_device, 115200, timeout=1)
-    ser.dtr = True
+    ser = await aacquire_session(serial_device, owner="bmc_factory_reset")
     command = "bmc_factory_reset manual\n"
     callback_output("Executing factory reset...")
 
     try:
-        ser.write(command.encode('utf-8'))
-        await asyncio.sleep(5)
-        response = ser.read_all().decode('utf-8')
+        # Whatever it prints until the shell prompt returns or the console goes quiet
+        response = (await ser.asend_and_expect(command, (SHELL_PROMPT,), 10, idle_timeout=2)).output
         callback_output(f"Factory reset response: {response}")
     except Exception as e:
         callback_output(f"Error: {e}")
     finally:
-        ser.close()
-
-async def flash_emmc(bmc_ip, directory, my_ip, dd_value, callback_progress, callback_output, serial_device):
-    """Flash the eMMC storage on the BMC."""
+        ser.release()
+
+async def flash_emmc(bmc_ip, directory, my_ip, dd_value, callback_progress, callback_output, serial_device,
+                     tftpboot=False, stream=None, uboot_write=None, reboot=True, server=None, job=True):
+    """
+    Flash the eMMC storage on the BMC from the U-Boot prompt (EMMC_STEPS).
+    With tftpboot the rescue image (or the uboot_write chunks) is loaded
+    over TFTP instead of wget; stream is one of STREAM_MODES to write the
+    restore image without staging it on the BMC; uboot_write, one of
+    UBOOT_WRITE_MODES, writes it from U-Boot without the rescue image.
+    Without reboot the BMC is left at the rescue shell. server and job
+    as for flasher; streams always send their commands one by one. Returns
+    True once flashed, None on failure.
+    """
     port = 80
 
     if dd_value == 1:
@@ -241,242 +1013,143 @@ async def flash_emmc(bmc_ip, directory, my_ip, dd_value, callback_progress, call
     else:
         type = 'nanobmc'
 
-    httpd = None
+    httpd = server
     ser = None  # Initialize serial connection variable
 
     try:
-        httpd = start_server(directory, port, callback_output)
+        if httpd is None:
+            httpd = serve_artifacts(directory, port, callback_output)
+        else:
+            callback_output("Using shared HTTP server for eMMC flash...")
+        tftp_port = start_tftp(httpd, callback_output) if tftpboot else None
         callback_progress(0.10)
 
-        ser = serial.Serial(serial_device, 115200, timeout=0.1)
-
-        # Setting IP Address (bootloader)
-        callback_output("Setting IP Address (bootloader)...")
-        command = f'setenv ipaddr {bmc_ip}\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-        callback_output(response)
-        callback_progress(0.20)
-
-        # Grabbing virtual restore image
-        callback_output("Grabbing virtual restore image...")
-        command = f'wget ${{loadaddr}} {my_ip}:/obmc-rescue-image-snuc-{type}.itb; bootm\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-        callback_output(response)
-        callback_progress(0.40)
-
-        # Setting IP Address (BMC)
-        callback_output("Setting IP Address (BMC)...")
-        await asyncio.sleep(20)
-        command = f'ifconfig eth0 up {bmc_ip}\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-        callback_output(response)
-        callback_progress(0.50)
-
-        # Grabbing restore image
-        callback_output("Grabbing restore image to your system...")
-        command = f"curl -o obmc-phosphor-image-snuc-{type}.wic.xz {my_ip}/obmc-phosphor-image-snuc-{type}.wic.xz\n"
-        response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-        callback_output(response)
-        callback_progress(0.60)
-
-        # Grabbing the mapping file
-        callback_output("Grabbing the mapping file...")
-        command = f'curl -o obmc-phosphor-image-snuc-{type}.wic.bmap {my_ip}/obmc-phosphor-image-snuc-{type}.wic.bmap\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 5)
-        callback_output(response)
-        callback_progress(0.90)
-
-        # Flashing the restore image
-        callback_output("Flashing the restore image to your system...")
-        command = f'bmaptool copy obmc-phosphor-image-snuc-{type}.wic.xz /dev/mmcblk0\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 5)
-        callback_output(response)
+        ser = await aacquire_session(serial_device, owner="flash_emmc")
 
-        await asyncio.sleep(55)
-        callback_output("Factory Reset Complete. Please let the BMC reboot.")
-        ser.write(b'reboot\n')
-        ser.close()
-        callback_progress(1.00)
-        await asyncio.sleep(60)
+        flow = Flow(ser, callback_output, callback_progress, bmc_ip=bmc_ip, my_ip=my_ip, port=port,
+                    directory=directory, server=httpd, job=job and not stream, tftp_port=tftp_port, stream=stream, uboot_write=uboot_write, reboot=reboot,
+                    rescue=f"obmc-rescue-image-snuc-{type}.itb",
+                    image=f"obmc-phosphor-image-snuc-{type}.wic.xz",
+                    bmap=f"obmc-phosphor-image-snuc-{type}.wic.bmap")
+        await pipeline.run(EMMC_STEPS, flow)
+        return True
 
     except Exception as e:
         callback_output(f"Error: {e}")
         callback_output("Flash unsuccessful.")
         return None
     finally:
-        if ser and ser.is_open:
-            ser.write(b'\n')  # Send newline to reset state
-            ser.close()
-        if httpd:
+        if ser:
+            if ser.is_open:
+                ser.write(b'\n')  # Send newline to reset state
+            ser.release()
+        if httpd and server is None:
             stop_server(httpd, callback_output)
         callback_progress(0)
 
-async def flash_emmc2(bmc_ip, directory, my_ip, dd_value, callback_progress, callback_output, serial_device):
-    """Flash the eMMC storage on the BMC."""
-    port = 80
-
-    if dd_value == 1:
-        type = 'mos-bmc'
-    else:
-        type = 'nanobmc'
-
-    httpd = None
-    ser = None  # Initialize serial connection variable
-
-    try:
-        httpd = start_server(directory, port, callback_output)
-        callback_progress(0.10)
-
-        ser = serial.Serial(serial_device, 115200, timeout=0.1)
-
-        # Setting IP Address (bootloader)
-        callback_output("Setting IP Address (bootloader)...")
-        command = f'setenv ipaddr {bmc_ip}\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-        callback_output(response)
-        callback_progress(0.20)
+async def flash_emmc_uboot(bmc_ip, directory, my_ip, dd_value, callback_progress, callback_output, serial_device,
+                           tftpboot=True, mode=UBOOT_MMC_WRITE):
+    """
+    Flash the eMMC storage on the BMC without leaving U-Boot: no rescue
+    image is booted. Chunks are loaded over TFTP (or wget without
+    tftpboot) and written with mode, one of UBOOT_WRITE_MODES.
+    """
+    return await flash_emmc(bmc_ip, directory, my_ip, dd_value, callback_progress, callback_output, serial_device,
+                            tftpboot=tftpboot, uboot_write=mode)
 
-        # Grabbing virtual restore image
-        callback_output("Grabbing virtual restore image...")
-        command = f'wget ${{loadaddr}} {my_ip}:/obmc-rescue-image-snuc-{type}.itb; bootm\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-        callback_output(response)
-        callback_progress(0.40)
-
-        # Setting IP Address (BMC)
-        callback_output("Setting IP Address (BMC)...")
-        await asyncio.sleep(20)
-        command = f'ifconfig eth0 up {bmc_ip}\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-        callback_output(response)
-        callback_progress(0.50)
+async def flash_emmc2(bmc_ip, directory, my_ip, dd_value, callback_progress, callback_output, serial_device):
+    """Flash the eMMC storage on the BMC and stay in the rescue shell (Flash All goes on to the FIP)."""
+    return await flash_emmc(bmc_ip, directory, my_ip, dd_value, callback_progress, callback_output, serial_device,
+                            reboot=False)
 
-        # Grabbing restore image
-        callback_output("Grabbing restore image to your system...")
-        command = f"curl -o obmc-phosphor-image-snuc-{type}.wic.xz {my_ip}/obmc-phosphor-image-snuc-{type}.wic.xz\n"
-        response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-        callback_output(response)
-        callback_progress(0.60)
 
-        # Grabbing the mapping file
-        callback_output("Grabbing the mapping file...")
-        command = f'curl -o obmc-phosphor-image-snuc-{type}.wic.bmap {my_ip}/obmc-phosphor-image-snuc-{type}.wic.bmap\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 5)
-        callback_output(response)
-        callback_progress(0.90)
+class AutobootInterceptor(AutoResponder):
+    """Sends a space as soon as U-Boot prints its autoboot countdown"""
 
-        # Flashing the restore image
-        callback_output("Flashing the restore image to your system...")
-        command = f'bmaptool copy obmc-phosphor-image-snuc-{type}.wic.xz /dev/mmcblk0\n'
-        response = await asyncio.to_thread(read_serial_data, ser, command, 5)
-        callback_output(response)
+    def __init__(self, port):
+        super().__init__(port, AUTOBOOT_BANNERS, b" ")
 
-    except Exception as e:
-        callback_output(f"Error: {e}")
-        callback_output("Flash unsuccessful.")
-        return None
-    finally:
-        if ser and ser.is_open:
-            ser.write(b'\n')  # Send newline to reset state
-            ser.close()
-        if httpd:
-            stop_server(httpd, callback_output)
-        callback_progress(0)
 
+async def reset_to_uboot(callback_output, serial_device, timeout=120):
+    """
+    Reboots the BMC and stops autoboot at the U-Boot prompt.
 
-async def reset_to_uboot(callback_output, serial_device):
-    """Resets the OpenBMC to U-Boot using the serial connection and emulates keyboard interaction."""
+    The interrupt key is written by an AutobootInterceptor on the serial
+    reactor the instant the banner arrives, so even a bootdelay of 1 s is
+    caught. Returns the interrupt latency in seconds, or None on failure.
+    """
     ser = None
+    interceptor = None
     try:
         callback_output("Opening serial connection...")
-        # FIX: Use the passed serial_device parameter instead of hardcoded serial_device
-        ser = serial.Serial(serial_device, baudrate=115200, timeout=1)
-        ser.dtr = True
-
-        # First, attempt to interrupt any boot process by sending a few returns
-        callback_output("Attempting to interrupt boot process...")
-        for _ in range(3):
-            ser.write(b'\n')
-            await asyncio.sleep(0.5)
-        
-        # For OpenBMC, we need to send specific commands to drop to U-Boot
-        callback_output("Sending OpenBMC commands to reboot to U-Boot...")
-        
-        
-        # Send the reboot command
-        command = "reboot\n"
-        ser.write(command.encode('utf-8'))
-        callback_output("Rebooting system...")
-        
-        # Wait for U-Boot to start
-        callback_output("Waiting for U-Boot to initialize...")
-        await asyncio.sleep(2)
-        
-        # Look for the autoboot message and interrupt it
-        callback_output("Monitoring for autoboot countdown and interrupting...")
-        
-        # Set up a task to periodically send a key to interrupt autoboot
-        interrupt_count = 0
-        max_interrupts = 30  # Try for about 15 seconds (0.5s intervals)
-        autoboot_detected = False
-        
-        while interrupt_count < max_interrupts:
-            # Read any available data
-            if ser.in_waiting:
-                data = ser.read(ser.in_waiting).decode('utf-8', errors='ignore')
-                if "autoboot" in data.lower() or "Hit any key" in data:
-                    autoboot_detected = True
-                    callback_output("Autoboot detected! Sending interrupt key...")
-                    # Send a space to interrupt
-                    ser.write(b' ')
-                    await asyncio.sleep(0.1)
-                    # Also send Enter to ensure it's caught
-                    ser.write(b'\n')
-                    break
-            
-            # Even if not detected yet, periodically send interrupt keys
-            if interrupt_count % 4 == 0:  # Every ~2 seconds
-                ser.write(b' ')  # Send space
-                await asyncio.sleep(0.1)
-                ser.write(b'\n')  # Send enter
-            
-            await asyncio.sleep(0.5)
-            interrupt_count += 1
-        
-        if autoboot_detected:
-            callback_output("Successfully interrupted autoboot!")
-            
-            # Wait a moment to read any response
-            await asyncio.sleep(1)
-            response = ser.read(ser.in_waiting).decode('utf-8', errors='ignore')
-            if response:
-                callback_output(f"U-Boot response: {response.strip()}")
-            
-            # Set bootdelay to 15 seconds for future boots
-            callback_output("Setting bootdelay to 15 seconds for future boots...")
-            ser.write(b"setenv bootdelay 15\n")
-            await asyncio.sleep(0.5)
-            ser.write(b"saveenv\n")
-            await asyncio.sleep(1)
-            
-            callback_output("System is now at U-Boot prompt. You can interact with it via the serial console.")
+        ser = await aacquire_session(serial_device, owner="reset_to_uboot")
+
+        # Find out where the BMC is so the right reset command is used
+        probe = await ser.asend_and_expect("\n", (UBOOT_PROMPT, SHELL_PROMPT, LOGIN_PROMPT), 2)
+
+        # Arm the interceptor before anything can print the banner
+        interceptor = AutobootInterceptor(ser.port).start()
+        if probe.pattern == UBOOT_PROMPT:
+            callback_output("Already at U-Boot, resetting to catch a fresh autoboot...")
+            ser.write(b"reset\n")
+        elif probe.pattern == SHELL_PROMPT:
+            callback_output("Rebooting system...")
+            ser.write(b"reboot\n")
         else:
+            callback_output("BMC is not at a root shell. Power-cycle it now; watching for the autoboot countdown...")
+        rebooted_at = time.monotonic()
+
+        callback_output("Monitoring for autoboot countdown...")
+        banner = await ser.aexpect(AUTOBOOT_BANNERS, timeout)
+        if not banner.matched or not interceptor.fired.is_set():
             callback_output("Could not detect autoboot sequence. System may still be booting.")
             callback_output("If needed, open the console and press a key when you see the autoboot countdown.")
+            return None
+        callback_output(f"Autoboot detected {interceptor.seen_at - rebooted_at:.1f}s after reset, "
+                        f"interrupted in {interceptor.latency * 1000:.2f} ms.")
+
+        # Confirm the prompt, nudging U-Boot if the key was swallowed
+        for attempt in range(3):
+            result = await ser.aexpect((UBOOT_PROMPT,), 3)
+            if result.matched:
+                break
+            ser.write(b"\n")
+        else:
+            callback_output("Autoboot was interrupted but the U-Boot prompt did not appear.")
+            return None
+        callback_output(f"U-Boot prompt confirmed {time.monotonic() - interceptor.seen_at:.2f}s after the banner.")
+
+        # Set bootdelay to 15 seconds for future boots
+        callback_output("Setting bootdelay to 15 seconds for future boots...")
+        await ser.asend_and_expect("setenv bootdelay 15\n", (UBOOT_PROMPT,), 5)
+        await ser.asend_and_expect("saveenv\n", (UBOOT_PROMPT,), 10)
+
+        ser.prompt = "uboot"
+        ser.logged_in = False
+        callback_output("System is now at U-Boot prompt. You can interact with it via the serial console.")
+        return interceptor.latency
 
     except serial.SerialException as e:
         callback_output(f"Serial error: {e}")
     except Exception as e:
         callback_output(f"Error during reset to U-Boot: {e}")
     finally:
-        # Don't close the serial connection so that it can be used by the console
-        # Just report status
-        if ser and ser.is_open:
-            callback_output("Serial connection remains open for console interaction.")
+        if interceptor:
+            interceptor.stop()
+        # The session keeps the port open so it can be used by the console
+        if ser:
+            if ser.is_open:
+                callback_output("Serial connection remains open for console interaction.")
+            ser.release()
 
 
 async def bios_update(bmc_user, bmc_pass, bmc_ip, fw_content, callback_progress, callback_output):
     callback_output("Initializing Red Fish client for BIOS update...")
+    try:
+        await pipeline.run(REDFISH_STEPS, Flow(None, callback_output, callback_progress, bmc_ip=bmc_ip))
+    except StepError as e:
+        callback_output(f"Error: {e}")
+        return
     redfish_client = redfish.redfish_client(base_url=f"https://{bmc_ip}", username=bmc_user, password=bmc_pass)
     callback_progress(0.10)
     
@@ -553,96 +1226,6 @@ async def bios_update(bmc_user, bmc_pass, bmc_ip, fw_content, callback_progress,
     await asyncio.sleep(5)
     callback_progress(0)
 
-async def reset_to_uboot(callback_output, serial_device):
-    """Resets the OpenBMC to U-Boot using the serial connection and emulates keyboard interaction."""
-    ser = None
-    try:
-        callback_output("Opening serial connection...")
-        ser = serial.Serial(serial_device, baudrate=115200, timeout=1)
-        ser.dtr = True
-
-        # First, attempt to interrupt any boot process by sending a few returns
-        callback_output("Attempting to interrupt boot process...")
-        for _ in range(3):
-            ser.write(b'\n')
-            await asyncio.sleep(0.5)
-        
-        # For OpenBMC, we need to send specific commands to drop to U-Boot
-        callback_output("Sending OpenBMC commands to reboot to U-Boot...")
-        
-        
-        # Send the reboot command
-        command = "reboot\n"
-        ser.write(command.encode('utf-8'))
-        callback_output("Rebooting system...")
-        
-        # Wait for U-Boot to start
-        callback_output("Waiting for U-Boot to initialize...")
-        await asyncio.sleep(2)
-        
-        # Look for the autoboot message and interrupt it
-        callback_output("Monitoring for autoboot countdown and interrupting...")
-        
-        # Set up a task to periodically send a key to interrupt autoboot
-        interrupt_count = 0
-        max_interrupts = 30  # Try for about 15 seconds (0.5s intervals)
-        autoboot_detected = False
-        
-        while interrupt_count < max_interrupts:
-            # Read any available data
-            if ser.in_waiting:
-                data = ser.read(ser.in_waiting).decode('utf-8', errors='ignore')
-                if "autoboot" in data.lower() or "Hit any key" in data:
-                    autoboot_detected = True
-                    callback_output("Autoboot detected! Sending interrupt key...")
-                    # Send a space to interrupt
-                    ser.write(b' ')
-                    await asyncio.sleep(0.1)
-                    # Also send Enter to ensure it's caught
-                    ser.write(b'\n')
-                    break
-            
-            # Even if not detected yet, periodically send interrupt keys
-            if interrupt_count % 4 == 0:  # Every ~2 seconds
-                ser.write(b' ')  # Send space
-                await asyncio.sleep(0.1)
-                ser.write(b'\n')  # Send enter
-            
-            await asyncio.sleep(0.5)
-            interrupt_count += 1
-        
-        if autoboot_detected:
-            callback_output("Successfully interrupted autoboot!")
-            
-            # Wait a moment to read any response
-            await asyncio.sleep(1)
-            response = ser.read(ser.in_waiting).decode('utf-8', errors='ignore')
-            if response:
-                callback_output(f"U-Boot response: {response.strip()}")
-            
-            # Set bootdelay to 15 seconds for future boots
-            callback_output("Setting bootdelay to 15 seconds for future boots...")
-            ser.write(b"setenv bootdelay 15\n")
-            await asyncio.sleep(0.5)
-            ser.write(b"saveenv\n")
-            await asyncio.sleep(1)
-            
-            callback_output("System is now at U-Boot prompt. You can interact with it via the serial console.")
-        else:
-            callback_output("Could not detect autoboot sequence. System may still be booting.")
-            callback_output("If needed, open the console and press a key when you see the autoboot countdown.")
-
-    except serial.SerialException as e:
-        callback_output(f"Serial error: {e}")
-    except Exception as e:
-        callback_output(f"Error during reset to U-Boot: {e}")
-    finally:
-        # Don't close the serial connection so that it can be used by the console
-        # Just report status
-        if ser and ser.is_open:
-            callback_output("Serial connection remains open for console interaction.")
-
-
 async def reset_uboot(callback_output, serial_device):
  
 
@@ -650,24 +1233,19 @@ async def reset_uboot(callback_output, serial_device):
     ser = None
     try:
         callback_output("Opening serial connection...")
-        ser = serial.Serial(serial_device, baudrate=115200, timeout=1)
-        ser.dtr = True
+        ser = await aacquire_session(serial_device, owner="reset_uboot")
 
         callback_output("Sending reset command to U-Boot...")
-        command = 'reset\n'
-        ser.write(command.encode('utf-8'))
-        await asyncio.sleep(2)
-
-        # Read response
-        response = ser.read(1024).decode('utf-8').strip()
+        # Done once U-Boot is back and counting down to autoboot
+        response = (await ser.asend_and_expect('reset\n', AUTOBOOT_BANNERS, 10)).output.strip()
         callback_output(f"Response: {response}")
 
-        ser.close()
+        ser.prompt = None
         callback_output("Reset to U-Boot completed.")
     except serial.SerialException as e:
         callback_output(f"Serial error: {e}")
     except Exception as e:
         callback_output(f"Error during reset: {e}")
     finally:
-        if 'ser' in locals() and ser.is_open:
-            ser.close()
+        if ser:
+            ser.release()
@@ -0,0 +1,177 @@
+"""
+Single-shot job scripts run on the BMC.
+
+Sent one at a time, a FIP or EEPROM flash is 5 to 10 console commands at
+115200 baud, each one echoed, wrapped in an exit-code marker and waited
+for. A Job describes the same work as steps of shell lines: fetch with
+resume and a sha256 check, write, verify, clean up. render() turns it
+into one POSIX sh script with set -e. The host publishes the script on
+the artifact server, as transfer_and_run_script does for FRU_flash_v2.sh,
+and starts it with a single command. While it runs, the script prints one
+JSON line per step on the console:
+
+    @@PLATYPUS {"job":"3f2a9c1d","step":"fetch","event":"start"}
+    @@PLATYPUS {"job":"3f2a9c1d","step":"fetch","event":"done","progress":0.6}
+    @@PLATYPUS {"job":"3f2a9c1d","event":"end","status":"ok"}
+    @@PLATYPUS {"job":"3f2a9c1d","event":"exit","code":0}
+
+follow() reads these lines back. It logs each step, moves the progress
+bar and returns the job's end status. The first failing command ends
+the script. The exit line then carries that command's code, and the
+last start line names the step that failed.
+"""
+
+import json
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from pipeline import digest_command
+from utils import SHELL_PROMPT
+
+PREFIX = "@@PLATYPUS"
+# A job's JSON line. The echo of the command that starts the job quotes
+# its exit line with ' and $?, which this leaves out.
+EVENT = re.compile(PREFIX + r" (\{[^'$\r\n]*\})\r?\n")
+OK = "ok"
+UNCHANGED = "unchanged"
+
+
+class JobError(Exception):
+    """A job failed, or never started (started is False) when its script could not be fetched"""
+
+    def __init__(self, message, step=None, code=None, started=False):
+        self.step = step
+        self.code = code
+        self.started = started
+        super().__init__(message)
+
+
+@dataclass
+class JobStep:
+    name: str
+    lines: List[str]
+    progress: float                 # flow progress once the step is done
+    message: Optional[str] = None   # logged on the host when the step starts
+
+
+@dataclass
+class Transfer:
+    """A download the job makes, for following it on the artifact server"""
+    url: str
+    span: Tuple[float, float]
+    step: str
+    large: bool = False             # takes a transfer slot (network.download_slot)
+
+
+@dataclass
+class Job:
+    title: str
+    id: str = field(default_factory=lambda: uuid.uuid4().hex[:8])
+    steps: List[JobStep] = field(default_factory=list)
+    transfers: List[Transfer] = field(default_factory=list)
+
+    @property
+    def script_name(self):
+        return f"platypus-job-{self.id}.sh"
+
+    def event(self, **fields):
+        """echo line printing one JSON event of this job"""
+        text = json.dumps({"job": self.id, **fields}, separators=(",", ":"))
+        return "echo '{} {}'".format(PREFIX, re.sub(r"['$\r\n]", "", text))
+
+    def step(self, name, progress, lines, message=None):
+        self.steps.append(JobStep(name, list(lines), progress, message))
+        return self
+
+    def fetch(self, name, url, path, digest, span, attempts=4, stall_time=30, large=False, message=None):
+        """Downloads url to path, resuming up to attempts times, and checks its sha256"""
+        curl = f"curl -fsS -C - --speed-limit 1024 --speed-time {stall_time} -o {path} {url}"
+        self.transfers.append(Transfer(url, span, name, large))
+        return self.step(name, span[1], [f"rm -f {path}", " || ".join([curl] * attempts),
+                                         f"sha256sum {path} | grep -q {digest}"], message)
+
+    def unchanged_if(self, name, device, digest, size, seek=0, message=None):
+        """Ends the job with status UNCHANGED if device already holds digest at seek"""
+        end = self.event(event="end", status=UNCHANGED, message=message or f"{device} is unchanged")
+        return self.step(name, self.steps[-1].progress if self.steps else 0.0,
+                         [f"{digest_command(device, size, seek)} | grep -q {digest} && {end} && exit 0 || true"])
+
+    def verify(self, name, device, digest, size, seek=0, progress=1.0):
+        """Drops the page cache and checks what device holds at seek against digest"""
+        return self.step(name, progress, ["sync; echo 3 > /proc/sys/vm/drop_caches",
+                                          f"{digest_command(device, size, seek)} | grep -q {digest}"])
+
+    def render(self):
+        lines = ["#!/bin/sh", f"# Platypus job {self.id}: {self.title}", "set -e"]
+        for step in self.steps:
+            lines.append(self.event(step=step.name, event="start"))
+            lines += step.lines
+            lines.append(self.event(step=step.name, event="done", progress=step.progress))
+        lines += [self.event(event="end", status=OK), ""]
+        return "\n".join(lines)
+
+    def command(self, url):
+        """Console command that fetches the script from url (host[:port]/path), runs it and prints its exit line"""
+        script = f"/tmp/{self.script_name}"
+        exit_line = "echo '{} {{\"job\":\"{}\",\"event\":\"exit\",\"code\":'$?'}}'".format(PREFIX, self.id)
+        return (f"curl -fsS -o {script} http://{url} && sh {script}; {exit_line}; "
+                f"rm -f {script}\n")
+
+
+async def interrupt(ser, timeout=10):
+    """Stops whatever runs at the BMC console with Ctrl-C and waits for the shell prompt; True once it is back"""
+    ser.write(b"\x03")
+    return (await ser.aexpect((SHELL_PROMPT,), timeout)).matched
+
+
+async def follow(ser, job, url, callback_output, callback_progress, timeout, on_event=None):
+    """
+    Starts job on the BMC from its script at url (see Job.command) and
+    follows its JSON lines until its exit line, awaiting on_event(event)
+    for each. Returns the end status, OK or UNCHANGED. Raises JobError if
+    the script fails, cannot be fetched or does not finish within timeout
+    seconds.
+    """
+    messages = {step.name: step.message for step in job.steps}
+    deadline = time.monotonic() + timeout
+    ser.reset_input_buffer()
+    ser.write(job.command(url))
+    step, status, started, step_started = None, None, False, time.monotonic()
+    while True:
+        result = await ser.aexpect((EVENT,), max(0.0, deadline - time.monotonic()))
+        output = result.output[:len(result.output) - len(result.match)] if result.matched else result.output
+        # What the commands printed, without the echo of the command that started the job
+        output = "\n".join(line for line in output.strip().splitlines() if job.script_name not in line)
+        if output.strip():
+            callback_output(output)
+        if not result.matched:
+            await interrupt(ser)
+            raise JobError(f"job {job.id} did not finish within {timeout:.0f}s", step, None, started)
+        event = json.loads(EVENT.search(result.match).group(1))
+        if event.get("job") != job.id:
+            continue
+        kind = event.get("event")
+        if kind == "start":
+            started, step, step_started = True, event.get("step"), time.monotonic()
+            if messages.get(step):
+                callback_output(messages[step])
+        elif kind == "done":
+            callback_progress(event.get("progress", 0.0))
+            callback_output(f"Job step {step} done in {time.monotonic() - step_started:.1f}s.")
+        elif kind == "end":
+            status = event.get("status")
+            if status == UNCHANGED and event.get("message"):
+                callback_output(event["message"])
+        elif kind == "exit":
+            code = event.get("code")
+            if code == 0 and status:
+                return status
+            if not started:
+                raise JobError(f"job script {job.script_name} could not be fetched (exit code {code})",
+                               code=code)
+            raise JobError(f"job {job.id} failed in step {step} with exit code {code}", step, code, True)
+        if on_event is not None:
+            await on_event(event)
@@ -0,0 +1,1164 @@
+#!/usr/bin/env python3
+"""
+Pseudo-terminal BMC simulator.
+
+Each SimulatedBMC owns a pty pair and plays the serial console of a
+NanoBMC/MOS-BMC: U-Boot banner and autoboot countdown, the "=>" prompt,
+kernel boot, OpenBMC login and a root shell that understands the commands
+Platypus sends (wget/tftpboot/crc32/mmc/gzwrite/bootm in U-Boot; curl, bmaptool, dd, sh,
+sha256sum, ifconfig, obmcutil, reboot ... in Linux). Transfers really go over HTTP
+or TFTP to the host so the artifact server is exercised too, and every
+delay is multiplied by SimTiming.scale so a full flash can be replayed in
+seconds.
+
+Usage:
+    python bmc_sim.py --units 32 --scale 0.01 --state uboot
+
+prints one device path per unit (also linked as /tmp/bmc-sim-<n>) that
+can be selected in Platypus or passed to the flows directly.
+"""
+
+import argparse
+import gzip
+import hashlib
+import lzma
+import os
+import pty
+import re
+import select
+import shlex
+import tempfile
+import threading
+import time
+import tty
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import bmap_image
+import tftp_server
+
+LINK_PREFIX = "/tmp/bmc-sim-"
+KEEP_LIMIT = 8 * 1024 * 1024      # files up to this size are kept in memory
+BOOT0_SIZE = 4 * 1024 * 1024
+EEPROM_SIZE = 256
+
+FORCE_RO = "/sys/block/mmcblk0boot0/force_ro"
+NEW_DEVICE = "/sys/class/i2c-adapter/i2c-1/new_device"
+EEPROM = "/sys/bus/i2c/devices/1-0050/eeprom"
+
+
+@dataclass
+class SimTiming:
+    """Delays in seconds and rates in MB/s, all multiplied by scale"""
+    scale: float = 1.0
+    uboot_banner: float = 1.0
+    bootdelay: int = 3
+    kernel_boot: float = 25.0
+    rescue_boot: float = 15.0
+    shutdown: float = 3.0
+    login: float = 0.5
+    command: float = 0.02
+    wget_rate: float = 5.0
+    tftp_rate: float = 11.0
+    tftp_rtt: float = 0.0005        # per acknowledged window
+    curl_rate: float = 11.0
+    bmaptool_rate: float = 25.0
+    dd_rate: float = 8.0
+
+    def sleep(self, seconds):
+        if seconds > 0 and self.scale > 0:
+            time.sleep(seconds * self.scale)
+
+    def transfer(self, size, rate, started):
+        """Sleeps until a transfer of size bytes at rate MB/s would be done"""
+        wanted = size / (rate * 1024 * 1024) * self.scale
+        remaining = wanted - (time.monotonic() - started)
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+@dataclass
+class SimFile:
+    size: int
+    sha256: str
+    data: Optional[bytes] = None
+    partial: Optional[object] = None    # sha256 state of a cut-off download, for curl -C -
+    crc32: Optional[int] = None         # for U-Boot's crc32 command
+
+
+@dataclass
+class SimState:
+    """What the simulated board remembers across commands and reboots"""
+    ip: str = "0.0.0.0"
+    env: Dict[str, str] = field(default_factory=lambda: {"loadaddr": "0x83000000", "bootdelay": "3"})
+    files: Dict[str, SimFile] = field(default_factory=dict)
+    boot0: bytearray = field(default_factory=lambda: bytearray(BOOT0_SIZE))
+    eeprom: bytearray = field(default_factory=lambda: bytearray(b"\xff" * EEPROM_SIZE))
+    emmc_image: Optional[str] = None    # sha256 of the last image written with bmaptool or dd
+    # offset -> bytes written at an offset by dd in a script or by U-Boot mmc write/gzwrite (small writes)
+    emmc: Dict[int, bytes] = field(default_factory=dict)
+    force_ro: bool = True
+    eeprom_registered: bool = False
+    host_on: bool = False
+    loaded: Optional[SimFile] = None    # last file fetched by U-Boot wget or tftpboot
+    loaded_name: str = ""
+    cut_downloads: int = 0              # the next n curl downloads stop halfway (exit 18)
+
+
+class _Stream(bytes):
+    """
+    A download piped to the next command (curl URL | ...). Its bytes are
+    only there for small files; sim_file always is, and the reader charges
+    the transfer time at the slower of rate and its own.
+    """
+
+    def __new__(cls, sim_file, rate, started):
+        stream = super().__new__(cls, sim_file.data or b"")
+        stream.sim_file = sim_file
+        stream.rate = rate
+        stream.started = started
+        return stream
+
+
+class _Reader:
+    """stdin of a script run with sh: each command consumes the next bytes of it"""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size=None):
+        """Returns (bytes, length); bytes is None when the stream is too large to keep"""
+        total = self.size
+        end = total if size is None else min(self.offset + size, total)
+        start, self.offset = self.offset, end
+        if isinstance(self.data, _Stream) and self.data.sim_file.data is None:
+            return None, end - start
+        return bytes(self.data[start:end]), end - start
+
+    @property
+    def size(self):
+        return self.data.sim_file.size if isinstance(self.data, _Stream) else len(self.data)
+
+
+class _Reboot(Exception):
+    """Raised by a command that takes the board through a reset"""
+
+
+class _ScriptExit(Exception):
+    """Raised by exit inside a script run with sh"""
+
+    def __init__(self, status):
+        self.status = status
+
+
+class _Stopped(Exception):
+    """Raised when the simulator is stopped or its pty goes away"""
+
+
+class SimulatedBMC:
+    """One simulated board behind a pseudo-terminal"""
+
+    def __init__(self, name="bmc", state="shell", timing=None, hostname="nanobmc",
+                 password=None, http_port=None, link=None, tftp_port=None, mac=None):
+        self.name = name
+        self.hostname = hostname
+        self.password = password          # None accepts any password
+        self.http_port = http_port        # used instead of port 80 in URLs
+        self.tftp_port = tftp_port        # used instead of port 69 for tftpboot
+        self.timing = timing or SimTiming()
+        self.board = SimState()
+        self.board.env["bootdelay"] = str(self.timing.bootdelay)
+        # Locally administered and random, so every simulated board is another unit
+        self.board.env["ethaddr"] = mac or "02:" + ":".join(f"{b:02x}" for b in os.urandom(5))
+        self.initial_state = state
+        self.stage = None
+        self.rescue = False               # running the rescue image rather than the eMMC's
+        self.commands = []                # (stage, command line) log for tests/benchmarks
+        self.pipefail = False
+        self._script_input = b""          # a _Reader while sh runs a script
+        self._script_output = None        # what a script's commands print, while sh runs it
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self.link = link
+        if link:
+            try:
+                if os.path.islink(link):
+                    os.unlink(link)
+                os.symlink(self.device, link)
+            except OSError:
+                self.link = None
+        self.path = self.link or self.device
+
+        self._pending = bytearray()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return f"<SimulatedBMC {self.name} {self.path} stage={self.stage}>"
+
+    # ---------- Lifecycle ----------
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"sim-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        if self.link:
+            try:
+                os.unlink(self.link)
+            except OSError:
+                pass
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _run(self):
+        stage = self.initial_state
+        try:
+            while not self._stop.is_set():
+                if stage == "boot":
+                    stage = self._boot()
+                elif stage == "uboot":
+                    stage = self._uboot()
+                elif stage == "kernel":
+                    stage = self._kernel(self.timing.kernel_boot, rescue=False)
+                elif stage == "login":
+                    stage = self._login()
+                else:
+                    stage = self._shell()
+        except _Stopped:
+            pass
+
+    # ---------- Console I/O ----------
+
+    def _out(self, text):
+        data = text.replace("\r\n", "\n").replace("\n", "\r\n").encode()
+        try:
+            os.write(self.master, data)
+        except OSError:
+            pass
+
+    def _fill(self, timeout):
+        """Reads whatever the host sent, waiting at most timeout. Returns True if anything came."""
+        if self._stop.is_set():
+            raise _Stopped()
+        ready, _, _ = select.select([self.master], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            raise _Stopped()
+        self._pending += data
+        return bool(data)
+
+    def _drain(self):
+        """Discards input typed while the board was busy booting"""
+        while self._fill(0):
+            pass
+        self._pending.clear()
+
+    def _readline(self, echo=True):
+        """Line editor of a serial console: echoes, handles backspace, returns on CR or LF"""
+        line = bytearray()
+        while True:
+            while not self._pending:
+                self._fill(0.2)
+            byte = self._pending[0]
+            del self._pending[0]
+            if byte in (0x0d, 0x0a):
+                # Swallow the LF of a CRLF pair
+                if byte == 0x0d and self._pending[:1] == b"\n":
+                    del self._pending[0]
+                if echo:
+                    self._out("\n")
+                return line.decode("utf-8", errors="replace")
+            if byte in (0x08, 0x7f):
+                if line:
+                    line.pop()
+                    if echo:
+                        self._out("\b \b")
+                continue
+            if byte == 0x03:
+                line.clear()
+                if echo:
+                    self._out("^C\n")
+                return ""
+            line.append(byte)
+            if echo:
+                self._out(chr(byte))
+
+    # ---------- Boot stages ----------
+
+    def _boot(self):
+        self.stage = "boot"
+        self._drain()
+        self._out("\nU-Boot 2023.01 (Simply NUC)\n\nSoC:   AST2600-A3\nDRAM:  512 MiB\n")
+        self.timing.sleep(self.timing.uboot_banner)
+        self._out("MMC:   emmc_slot0@100: 0\nIn:    serial@1e784000\nOut:   serial@1e784000\n"
+                  "Err:   serial@1e784000\nNet:   ftgmac@1e660000\n")
+        self._drain()
+        try:
+            delay = int(self.board.env.get("bootdelay", "3"))
+        except ValueError:
+            delay = 3
+        self._out(f"Hit any key to stop autoboot: {delay:2d} ")
+        for remaining in range(delay, 0, -1):
+            deadline = time.monotonic() + self.timing.scale
+            while True:
+                left = deadline - time.monotonic()
+                if self._fill(max(left, 0)):
+                    self._pending.clear()
+                    self._out(f"\b\b\b{0:2d} \n")
+                    return "uboot"
+                if left <= 0:
+                    break
+            self._out(f"\b\b\b{remaining - 1:2d} ")
+        self._out("\n")
+        return "kernel"
+
+    def _kernel(self, duration, rescue):
+        self.stage = "kernel"
+        self.rescue = rescue
+        if rescue:
+            # Unlike the eMMC's image, the rescue image brings eth0 up without an address
+            self.board.ip = "0.0.0.0"
+        self._out("## Loading kernel from FIT Image at 83000000 ...\nStarting kernel ...\n\n")
+        steps = ("[    0.000000] Booting Linux on physical CPU 0xf00\n",
+                 "[    1.120000] mmc0: new HS200 MMC card at address 0001\n",
+                 "[    3.400000] systemd[1]: Detected architecture arm.\n",
+                 "[    9.800000] ftgmac100 1e660000.ethernet eth0: Link is Up - 1Gbps/Full\n")
+        for line in steps:
+            self._out(line)
+            self.timing.sleep(duration / len(steps))
+        self._drain()
+        if rescue:
+            # The rescue image logs root in automatically
+            self._out("\nPhosphor OpenBMC rescue\n\n")
+            return "shell"
+        self._out(f"\nPhosphor OpenBMC (Phosphor OpenBMC Project Reference Distro) nodistro.0 {self.hostname} ttyS4\n\n")
+        return "login"
+
+    def _login(self):
+        self.stage = "login"
+        while True:
+            self._out(f"{self.hostname} login: ")
+            user = self._readline().strip()
+            if not user:
+                continue
+            self._out("Password: ")
+            password = self._readline(echo=False)
+            self._out("\n")
+            self.timing.sleep(self.timing.login)
+            if user == "root" and (self.password is None or password == self.password):
+                return "shell"
+            self._out("\nLogin incorrect\n")
+
+    def _uboot(self):
+        self.stage = "uboot"
+        self.board.host_on = False
+        while True:
+            self._out("=> ")
+            line = self._readline()
+            self.commands.append(("uboot", line))
+            try:
+                next_stage = self._uboot_line(line)
+            except _Reboot:
+                self.timing.sleep(self.timing.shutdown / 3)
+                return "boot"
+            if next_stage:
+                return next_stage
+
+    def _shell(self):
+        self.stage = "shell"
+        while True:
+            self._out(f"root@{self.hostname}:~# ")
+            line = self._readline()
+            self.commands.append(("shell", line))
+            try:
+                self._shell_line(line)
+            except _Reboot:
+                self._out("\nreboot: Restarting system\n")
+                self.timing.sleep(self.timing.shutdown)
+                return "boot"
+
+    # ---------- U-Boot ----------
+
+    def _expand(self, text, status=0):
+        env = self.board.env
+        text = text.replace("$?", str(status))
+        text = re.sub(r"\$\{(\w+)\}", lambda m: env.get(m.group(1), ""), text)
+        return re.sub(r"\$(\w+)", lambda m: env.get(m.group(1), ""), text)
+
+    def _uboot_line(self, line):
+        status = 0
+        parts = re.split(r"(;|&&)", line)
+        for index in range(0, len(parts), 2):
+            if index and parts[index - 1] == "&&" and status:
+                continue
+            args = self._expand(parts[index], status).split()
+            if not args:
+                continue
+            self.timing.sleep(self.timing.command)
+            status, next_stage = self._uboot_command(args)
+            if next_stage:
+                return next_stage
+        return None
+
+    def _uboot_command(self, args):
+        """Runs one U-Boot command. Returns (exit status, next stage or None)."""
+        name = args[0]
+        if name == "setenv":
+            if len(args) > 2:
+                self.board.env[args[1]] = " ".join(args[2:])
+            elif len(args) == 2:
+                self.board.env.pop(args[1], None)
+        elif name == "saveenv":
+            self._out("Saving Environment to MMC... Writing to MMC(0)... OK\n")
+        elif name == "printenv":
+            for key, value in sorted(self.board.env.items()):
+                if len(args) == 1 or key in args[1:]:
+                    self._out(f"{key}={value}\n")
+        elif name == "echo":
+            self._out(" ".join(args[1:]) + "\n")
+        elif name in ("wget", "tftpboot", "tftp"):
+            loader = self._uboot_wget if name == "wget" else self._uboot_tftpboot
+            if not loader(args):
+                # Whatever was in RAM has been overwritten by the broken load
+                self.board.loaded = None
+                return 1, None
+        elif name in ("crc32", "mmc", "gzwrite"):
+            if not getattr(self, f"_uboot_{name}")(args):
+                return 1, None
+        elif name == "bootm":
+            if self.board.loaded is None:
+                self._out("Wrong Image Format for bootm command\nERROR: can't get kernel image!\n")
+                return 1, None
+            return 0, self._kernel(self.timing.rescue_boot, rescue=True)
+        elif name == "boot":
+            return 0, self._kernel(self.timing.kernel_boot, rescue=False)
+        elif name == "reset":
+            self._out("resetting ...\n")
+            raise _Reboot()
+        else:
+            self._out(f"Unknown command '{name}' - try 'help'\n")
+            return 1, None
+        return 0, None
+
+    def _uboot_wget(self, args):
+        target = args[-1]
+        if ":" not in target:
+            self._out("wget: missing server address\n")
+            return False
+        host, path = target.split(":", 1)
+        url = f"http://{host}/{path.lstrip('/')}"
+        self._out(f"HTTP from {host}; our IP address is {self.board.env.get('ipaddr', '0.0.0.0')}\n")
+        started = time.monotonic()
+        try:
+            sim_file, _, _ = self._fetch(url)
+        except (urllib.error.URLError, OSError) as e:
+            self._out(f"wget: failed ({e})\n")
+            return False
+        self.timing.transfer(sim_file.size, self.timing.wget_rate, started)
+        self._out("#" * 20 + f"\nBytes transferred = {sim_file.size} ({sim_file.size:x} hex)\n")
+        self.board.loaded = sim_file
+        self.board.loaded_name = os.path.basename(path)
+        self.board.env["filesize"] = f"{sim_file.size:x}"
+        return True
+
+    def _uboot_tftpboot(self, args):
+        env = self.board.env
+        target = args[-1] if len(args) > 1 else ""
+        host, _, filename = target.rpartition(":")
+        host = host or env.get("serverip", "")
+        if not host or not filename:
+            self._out("*** ERROR: `serverip' not set\n")
+            return False
+        port = int(env.get("tftpdstp", tftp_server.TFTP_PORT))
+        if self.tftp_port and port == tftp_server.TFTP_PORT:
+            port = self.tftp_port
+        blksize = int(env.get("tftpblocksize", tftp_server.DEFAULT_BLKSIZE))
+        windowsize = int(env.get("tftpwindowsize", 1))
+        self._out(f"TFTP from server {host}; our IP address is {env.get('ipaddr', '0.0.0.0')}\n"
+                  f"Filename '{filename}'.\nLoad address: {env.get('loadaddr')}\nLoading: ")
+        started = time.monotonic()
+        try:
+            data = tftp_server.fetch(host, filename, port, blksize, windowsize)
+        except (tftp_server.TftpError, OSError) as e:
+            self._out(f"\nTFTP error: '{e}'\nNot retrying...\n")
+            return False
+        # Lock-step TFTP pays a round trip per window of blocks
+        windows = len(data) // (blksize * windowsize) + 1
+        self.timing.transfer(len(data), self.timing.tftp_rate, started)
+        self.timing.sleep(windows * self.timing.tftp_rtt)
+        self._out("#" * 20 + f"\n\t done\nBytes transferred = {len(data)} ({len(data):x} hex)\n")
+        self.board.loaded = _sim_file(data)
+        self.board.loaded_name = filename
+        self.board.env["filesize"] = f"{len(data):x}"
+        return True
+
+    def _loaded(self, address, size):
+        """The loaded file if address/size (hex) cover it, as U-Boot commands name it"""
+        loaded = self.board.loaded
+        try:
+            if loaded is None or int(address, 16) != int(self.board.env["loadaddr"], 16) or int(size, 16) > loaded.size:
+                return None
+        except (KeyError, ValueError):
+            return None
+        return loaded
+
+    def _uboot_crc32(self, args):
+        loaded = self._loaded(*args[1:3]) if len(args) >= 3 else None
+        if loaded is None:
+            self._out("Usage:\ncrc32 address count [addr]\n")
+            return False
+        size = int(args[2], 16)
+        crc = loaded.crc32 if size == loaded.size else zlib.crc32(loaded.data[:size]) if loaded.data else None
+        if crc is None:
+            self._out("crc32: data not available\n")
+            return False
+        start = int(args[1], 16)
+        self._out(f"crc32 for {start:08x} ... {start + size - 1:08x} ==> {crc:08x}\n")
+        return True
+
+    def _uboot_mmc(self, args):
+        if args[1:2] == ["dev"]:
+            self._out("switch to partitions #0, OK\nmmc0(part 0) is current device\n")
+            return True
+        if args[1:2] != ["write"] or len(args) != 5:
+            self._out("Usage:\nmmc write addr blk# cnt\n")
+            return False
+        block, count = int(args[3], 16), int(args[4], 16)
+        loaded = self._loaded(args[2], f"{count * 512:x}")
+        if loaded is None:
+            self._out(f"\nMMC write: dev # 0, block # {block}, count {count} ... 0 blocks written: ERROR\n")
+            return False
+        started = time.monotonic()
+        if loaded.data is not None:
+            self.board.emmc[block * 512] = loaded.data[:count * 512]
+        self.timing.transfer(count * 512, self.timing.dd_rate, started)
+        self._out(f"\nMMC write: dev # 0, block # {block}, count {count} ... {count} blocks written: OK\n")
+        return True
+
+    def _uboot_gzwrite(self, args):
+        if len(args) < 5 or args[1] != "mmc":
+            self._out("Usage:\ngzwrite <interface> <dev> <addr> length [wbuf=1M [offs=0]]\n")
+            return False
+        loaded = self._loaded(args[3], args[4])
+        offset = int(args[6], 16) if len(args) > 6 else 0
+        if loaded is None:
+            self._out("gzwrite: nothing loaded at that address\n")
+            return False
+        started = time.monotonic()
+        size = loaded.size
+        if loaded.data is not None:
+            try:
+                data = gzip.decompress(loaded.data[:int(args[4], 16)])
+            except (OSError, EOFError, zlib.error) as e:
+                self._out(f"Error: inflate() returned {e}\n")
+                return False
+            self.board.emmc[offset] = data
+            size = len(data)
+        self.timing.transfer(size, self.timing.dd_rate, started)
+        self._out(f"\t{size} bytes, crc 0x{zlib.crc32(loaded.data or b''):08x}, total 0x{size:x}\n")
+        return True
+
+    # ---------- Linux shell ----------
+
+    def _shell_line(self, line):
+        tokens = self._tokenize(line)
+        status = 0
+        skip = None
+        command = []
+        for token in tokens + [";"]:
+            if token in (";", "&&", "||"):
+                if command:
+                    if skip is None:
+                        status = self._pipeline(command, status)
+                    command = []
+                if token == "&&":
+                    skip = None if status == 0 else token
+                elif token == "||":
+                    skip = None if status != 0 else token
+                else:
+                    skip = None
+            else:
+                command.append(token)
+        return status
+
+    def _tokenize(self, line):
+        lexer = shlex.shlex(line, posix=True, punctuation_chars=";&|>")
+        lexer.whitespace_split = True
+        try:
+            return list(lexer)
+        except ValueError:
+            return line.split()
+
+    def _pipeline(self, tokens, last_status):
+        tokens = [t.replace("$?", str(last_status)) for t in tokens]
+        stages = [[]]
+        for token in tokens:
+            if token == "|":
+                stages.append([])
+            else:
+                stages[-1].append(token)
+        data = self._script_input
+        status = 0
+        failed = 0
+        for index, stage in enumerate(stages):
+            redirect = None
+            if ">" in stage:
+                at = stage.index(">")
+                redirect = stage[at + 1] if at + 1 < len(stage) else None
+                stage = stage[:at]
+            if not stage:
+                continue
+            self.timing.sleep(self.timing.command)
+            data, status = self._exec(stage, data)
+            if redirect:
+                status = self._redirect(redirect, data) if status == 0 else status
+                data = b""
+            failed = status or failed
+        if data and not isinstance(data, _Reader):
+            if self._script_output is not None:
+                self._script_output.append(data)
+            else:
+                self._out(data.decode("utf-8", errors="replace"))
+        return failed if self.pipefail else status
+
+    def _redirect(self, path, data):
+        text = data.decode(errors="ignore").strip()
+        if path == FORCE_RO:
+            self.board.force_ro = text != "0"
+        elif path == NEW_DEVICE:
+            if self.board.eeprom_registered:
+                self._out("-sh: echo: write error: Invalid argument\n")
+                return 1
+            self.board.eeprom_registered = True
+        else:
+            self.board.files[path] = _sim_file(data)
+        return 0
+
+    def _exec(self, args, stdin):
+        """Runs one command. Returns (stdout bytes, exit status)."""
+        handler = getattr(self, "_cmd_" + args[0].rsplit("/", 1)[-1].replace("-", "_"), None)
+        if handler is None:
+            self._out(f"-sh: {args[0]}: not found\n")
+            return b"", 127
+        return handler(args[1:], stdin)
+
+    def _cmd_true(self, args, stdin):
+        return b"", 0
+
+    def _cmd_false(self, args, stdin):
+        return b"", 1
+
+    def _cmd_echo(self, args, stdin):
+        return (" ".join(args) + "\n").encode(), 0
+
+    def _cmd_set(self, args, stdin):
+        if args[:2] in (["-o", "pipefail"], ["+o", "pipefail"]):
+            self.pipefail = args[0] == "-o"
+        return b"", 0
+
+    def _cmd_sh(self, args, stdin):
+        script = self.board.files.get(args[0]) if args else None
+        if script is None or script.data is None:
+            self._out(f"sh: can't open '{args[0] if args else ''}': No such file or directory\n")
+            return b"", 2
+        errexit = False
+        status = 0
+        self._script_input = _Reader(stdin)
+        self._script_output = output = []
+        try:
+            for line in script.data.decode(errors="replace").splitlines():
+                if not line.strip() or line.lstrip().startswith("#"):
+                    continue
+                if line.split() == ["set", "-e"]:
+                    errexit = True
+                    continue
+                status = self._shell_line(line)
+                if status and errexit:
+                    break
+        except _ScriptExit as e:
+            status = e.status
+        finally:
+            self._script_input = b""
+            self._script_output = None
+        return b"".join(output), status
+
+    def _cmd_exit(self, args, stdin):
+        status = int(args[0]) if args else 0
+        if self._script_output is None:
+            return b"", status
+        raise _ScriptExit(status)
+
+    def _cmd_xz(self, args, stdin):
+        # Simulated images are opaque stand-ins, so decompressing passes them through
+        if not any(a.startswith("-") and "d" in a for a in args):
+            self._out("xz: compression is not supported here\n")
+            return b"", 1
+        return stdin, 0
+
+    def _cmd_sync(self, args, stdin):
+        return b"", 0
+
+    def _cmd_sleep(self, args, stdin):
+        self.timing.sleep(float(args[0]) if args else 0)
+        return b"", 0
+
+    def _cmd_rm(self, args, stdin):
+        status = 0
+        for path in (a for a in args if not a.startswith("-")):
+            if self.board.files.pop(path, None) is None and "-f" not in args:
+                self._out(f"rm: can't remove '{path}': No such file or directory\n")
+                status = 1
+        return b"", status
+
+    def _cmd_ls(self, args, stdin):
+        names = [a for a in args if not a.startswith("-")] or sorted(self.board.files)
+        out = []
+        for name in names:
+            if name in self.board.files:
+                out.append(name)
+            else:
+                self._out(f"ls: {name}: No such file or directory\n")
+                return "\n".join(out).encode(), 1
+        return ("\n".join(out) + "\n").encode() if out else b"", 0
+
+    def _cmd_cat(self, args, stdin):
+        if not args:
+            return stdin, 0
+        if args[0] in self._system_files():
+            return self._system_files()[args[0]], 0
+        sim_file = self.board.files.get(args[0])
+        if sim_file is None or sim_file.data is None:
+            self._out(f"cat: can't open '{args[0]}': No such file or directory\n")
+            return b"", 1
+        return sim_file.data, 0
+
+    def _system_files(self):
+        """Files the running image provides rather than ones written to the board"""
+        name = "Phosphor OpenBMC rescue" if self.rescue else "Phosphor OpenBMC (Phosphor OpenBMC Project Reference Distro)"
+        return {
+            "/etc/os-release": f'ID=openbmc-phosphor\nNAME="{name}"\nVERSION_ID=nodistro.0\n'.encode(),
+            "/sys/class/net/eth0/address": f"{self.board.env['ethaddr']}\n".encode(),
+        }
+
+    def _cmd_head(self, args, stdin):
+        count = next((int(args[i + 1]) for i, a in enumerate(args[:-1]) if a == "-c"), None)
+        if count is None:
+            return b"".join(stdin.splitlines(keepends=True)[:10]), 0
+        return stdin[:count], 0
+
+    def _cmd_sha256sum(self, args, stdin):
+        if not args or args[0] == "-":
+            return f"{hashlib.sha256(stdin).hexdigest()}  -\n".encode(), 0
+        sim_file = self.board.files.get(args[0])
+        if sim_file is None:
+            self._out(f"sha256sum: {args[0]}: No such file or directory\n")
+            return b"", 1
+        return f"{sim_file.sha256}  {args[0]}\n".encode(), 0
+
+    def _cmd_grep(self, args, stdin):
+        pattern = args[-1] if args else ""
+        lines = [l for l in stdin.decode(errors="ignore").splitlines() if pattern in l]
+        if "-q" in args:
+            return b"", 0 if lines else 1
+        return ("\n".join(lines) + "\n").encode() if lines else b"", 0 if lines else 1
+
+    def _cmd_cut(self, args, stdin):
+        delimiter, fields = "\t", 1
+        for arg in args:
+            if arg.startswith("-d"):
+                delimiter = arg[2:]
+            elif arg.startswith("-f"):
+                fields = int(arg[2:])
+        out = []
+        for line in stdin.decode(errors="ignore").splitlines():
+            parts = line.split(delimiter)
+            out.append(parts[fields - 1] if len(parts) >= fields else line)
+        return ("\n".join(out) + "\n").encode() if out else b"", 0
+
+    def _cmd_awk(self, args, stdin):
+        match = re.search(r"print \$(\d+)", " ".join(args))
+        column = int(match.group(1)) if match else 0
+        out = []
+        for line in stdin.decode(errors="ignore").splitlines():
+            parts = line.split()
+            out.append(" ".join(parts) if column == 0 else (parts[column - 1] if len(parts) >= column else ""))
+        return ("\n".join(out) + "\n").encode() if out else b"", 0
+
+    def _cmd_ifconfig(self, args, stdin):
+        addresses = [a for a in args[1:] if re.match(r"^\d+\.\d+\.\d+\.\d+$", a)]
+        if addresses:
+            self.board.ip = addresses[0]
+            return b"", 0
+        if "up" in args or "down" in args:
+            return b"", 0
+        return (f"eth0      Link encap:Ethernet  HWaddr {self.board.env['ethaddr'].upper()}\n"
+                f"          inet addr:{self.board.ip}  Bcast:0.0.0.0  Mask:255.255.255.0\n"
+                f"          UP BROADCAST RUNNING MULTICAST  MTU:1500  Metric:1\n").encode(), 0
+
+    def _cmd_obmcutil(self, args, stdin):
+        action = args[0] if args else "state"
+        if action in ("poweron", "chassison"):
+            self.board.host_on = True
+        elif action in ("poweroff", "chassisoff"):
+            self.board.host_on = False
+        elif action == "state":
+            state = "On" if self.board.host_on else "Off"
+            return f"CurrentHostState    : xyz.openbmc_project.State.Host.HostState.{state}\n".encode(), 0
+        else:
+            self._out(f"obmcutil: invalid choice: '{action}'\n")
+            return b"", 2
+        return b"", 0
+
+    def _cmd_reboot(self, args, stdin):
+        raise _Reboot()
+
+    def _cmd_bmc_factory_reset(self, args, stdin):
+        self.board.files.clear()
+        return b"Factory reset scheduled, rebooting...\n", 0
+
+    def _cmd_curl(self, args, stdin):
+        output, url, resume = None, None, False
+        fail = "-f" in args or any(a.startswith("-") and not a.startswith("--") and "f" in a for a in args)
+        index = 0
+        while index < len(args):
+            arg = args[index]
+            if arg == "-o" and index + 1 < len(args):
+                output = args[index + 1]
+                index += 1
+            elif arg == "-C" and index + 1 < len(args):
+                resume = args[index + 1] == "-"
+                index += 1
+            elif arg in ("--retry", "--connect-timeout", "-m", "--speed-limit", "--speed-time") \
+                    and index + 1 < len(args):
+                index += 1
+            elif not arg.startswith("-"):
+                url = arg
+            index += 1
+        if url is None:
+            self._out("curl: no URL specified!\n")
+            return b"", 2
+        if "://" not in url:
+            url = "http://" + url
+        if self.board.ip == "0.0.0.0":
+            self._out(f"curl: (7) Failed to connect to {urllib.parse.urlsplit(url).netloc}: Network is unreachable\n")
+            return b"", 7
+        previous = self.board.files.get(output) if resume and output else None
+        cut = bool(output) and self.board.cut_downloads > 0
+        if cut:
+            self.board.cut_downloads -= 1
+        started = time.monotonic()
+        try:
+            sim_file, fetched, remaining = self._fetch(url, previous, cut, fail)
+        except urllib.error.HTTPError as e:
+            if fail:
+                self._out(f"curl: (22) The requested URL returned error: {e.code}\n")
+                return b"", 22
+            sim_file, fetched, remaining = _sim_file(e.read()), 0, 0
+        except (urllib.error.URLError, OSError):
+            host = urllib.parse.urlsplit(url).netloc
+            self._out(f"curl: (7) Failed to connect to {host}: Connection refused\n")
+            return b"", 7
+        if output is None:
+            # Whoever reads the pipe pays for the transfer
+            return _Stream(sim_file, self.timing.curl_rate, started), 0
+        self.timing.transfer(fetched, self.timing.curl_rate, started)
+        self.board.files[output] = sim_file
+        if remaining:
+            self._out(f"curl: (18) transfer closed with {remaining} bytes remaining to read\n")
+            return b"", 18
+        return b"", 0
+
+    def _cmd_bmaptool(self, args, stdin):
+        paths, bmap, index = [], None, 1
+        while index < len(args):
+            if args[index] == "--bmap" and index + 1 < len(args):
+                bmap = args[index + 1]
+                index += 1
+            elif not args[index].startswith("-"):
+                paths.append(args[index])
+            index += 1
+        if not args or args[0] != "copy" or len(paths) != 2:
+            self._out("usage: bmaptool copy [--nobmap] [--bmap BMAP] IMAGE DEST\n")
+            return b"", 2
+        image, dest = paths
+        bmap = bmap or re.sub(r"\.(xz|gz|bz2)$", "", image) + ".bmap"
+        if "--nobmap" not in args and bmap not in self.board.files:
+            self._out(f"bmaptool: ERROR: no bmap file found for '{image}', use --nobmap\n")
+            return b"", 1
+        started = time.monotonic()
+        rate = self.timing.bmaptool_rate
+        if "://" in image:
+            # Read while writing: the slower of the network and the eMMC sets the pace
+            if self.board.ip == "0.0.0.0":
+                self._out(f"bmaptool: ERROR: cannot open image file '{image}': Network is unreachable\n")
+                return b"", 1
+            try:
+                sim_file, _, _ = self._fetch(image)
+            except (urllib.error.URLError, OSError) as e:
+                self._out(f"bmaptool: ERROR: cannot open image file '{image}': {e}\n")
+                return b"", 1
+            rate = min(rate, self.timing.curl_rate)
+        else:
+            sim_file = self.board.files.get(image)
+            if sim_file is None:
+                self._out(f"bmaptool: ERROR: cannot open image file '{image}'\n")
+                return b"", 1
+        self._out(f"bmaptool: info: block map format version 2.0\n"
+                  f"bmaptool: info: copying image '{image}' to block device '{dest}' using bmap file '{bmap}'\n")
+        self.timing.transfer(sim_file.size, rate, started)
+        elapsed = max(time.monotonic() - started, 1e-6) / (self.timing.scale or 1)
+        rate = sim_file.size / elapsed / (1024 * 1024)
+        self._out(f"bmaptool: info: 100% copied\n"
+                  f"bmaptool: info: synchronizing '{dest}'\n"
+                  f"bmaptool: info: copying time: {elapsed:.1f}s, copying speed {rate:.1f} MiB/sec\n")
+        if dest == "/dev/mmcblk0":
+            self.board.emmc_image = sim_file.sha256
+            self._write_mapped(image, sim_file, self.board.files.get(bmap))
+        return b"", 0
+
+    def _write_mapped(self, name, image, bmap):
+        """
+        Keeps the mapped ranges bmaptool wrote when the simulator has the
+        bytes of both the image (decompressed if .xz) and its bmap, so the
+        eMMC reads back what was written; opaque images only leave their digest.
+        """
+        if image.data is None or bmap is None or bmap.data is None:
+            return
+        try:
+            data = lzma.decompress(image.data) if name.endswith(".xz") else image.data
+            with tempfile.NamedTemporaryFile(suffix=".bmap") as f:
+                f.write(bmap.data)
+                f.flush()
+                parsed = bmap_image.parse_bmap(f.name)
+        except (lzma.LZMAError, bmap_image.BmapError):
+            return
+        for offset, size in bmap_image.mapped_extents(parsed):
+            self.board.emmc[offset] = data[offset:offset + size]
+
+    def _cmd_dd(self, args, stdin):
+        options = dict(a.split("=", 1) for a in args if "=" in a)
+        bs = _size(options.get("bs", "512"))
+        seek = int(options.get("seek", "0"))
+        skip = int(options.get("skip", "0"))
+        count = int(options["count"]) if "count" in options else None
+
+        source = options.get("if")
+        stream = stdin if isinstance(stdin, _Stream) else None
+        reader = stdin if isinstance(stdin, _Reader) else None
+        if reader is not None and source is None:
+            # Inside a script: this dd takes its share of the script's stdin
+            stream = reader.data if isinstance(reader.data, _Stream) else None
+            data, length = reader.read(count * bs if count is not None else None)
+            return self._dd_from_script(options.get("of"), seek * bs, data, length, reader, stream, bs, options)
+        if source is None:
+            data = stdin
+        elif source in self.board.files:
+            data = self.board.files[source].data
+            if data is None:
+                data = b"\0" * self.board.files[source].size
+        elif source == "/dev/mmcblk0" and count is not None:
+            data = self._emmc_read(skip * bs, count * bs)
+            skip = 0
+        elif source == "/dev/mmcblk0boot0":
+            data = bytes(self.board.boot0)
+        elif source == EEPROM and self.board.eeprom_registered:
+            data = bytes(self.board.eeprom)
+        else:
+            self._out(f"dd: can't open '{source}': No such file or directory\n")
+            return b"", 1
+        data = data[skip * bs:]
+        if count is not None:
+            data = data[:count * bs]
+
+        started = time.monotonic()
+        target = options.get("of")
+        if target == "/dev/mmcblk0boot0":
+            if self.board.force_ro:
+                self._out("dd: error writing '/dev/mmcblk0boot0': Operation not permitted\n")
+                return b"", 1
+            _write_into(self.board.boot0, seek * bs, data)
+        elif target == EEPROM:
+            if not self.board.eeprom_registered:
+                self._out(f"dd: can't open '{EEPROM}': No such file or directory\n")
+                return b"", 1
+            _write_into(self.board.eeprom, seek * bs, data[:EEPROM_SIZE - seek * bs])
+        elif target == "/dev/mmcblk0":
+            self.board.emmc_image = stream.sim_file.sha256 if stream is not None else hashlib.sha256(data).hexdigest()
+        elif target is not None:
+            self.board.files[target] = _sim_file(data)
+        size = len(data)
+        if stream is not None:
+            started = stream.started
+            size = stream.sim_file.size if stream.sim_file.data is None else size
+            self.timing.transfer(size, min(stream.rate, self.timing.dd_rate), started)
+        else:
+            self.timing.transfer(size, self.timing.dd_rate, started)
+
+        records = size // bs
+        partial = 1 if size % bs else 0
+        elapsed = max(time.monotonic() - started, 1e-6)
+        report = (f"{records}+{partial} records in\n{records}+{partial} records out\n"
+                  f"{size} bytes ({size / 1024:.1f}KB) copied, {elapsed:.6f} seconds, "
+                  f"{size / elapsed / 1024:.1f}KB/s\n")
+        if options.get("status") != "none":
+            self._out(report)
+        return (data if target is None else b""), 0
+
+    def _emmc_read(self, offset, length):
+        """What the eMMC holds at offset: the writes the simulator kept, zeros elsewhere"""
+        data = bytearray(length)
+        for start, written in self.board.emmc.items():
+            low, high = max(start, offset), min(start + len(written), offset + length)
+            if low < high:
+                data[low - offset:high - offset] = written[low - start:high - start]
+        return bytes(data)
+
+    def _dd_from_script(self, target, offset, data, length, reader, stream, bs, options):
+        if target != "/dev/mmcblk0":
+            self._out(f"dd: can't open '{target}': not simulated for piped scripts\n")
+            return b"", 1
+        if data is not None:
+            self.board.emmc[offset] = data
+        self.board.emmc_image = stream.sim_file.sha256 if stream is not None else hashlib.sha256(reader.data).hexdigest()
+        # The pipe and the eMMC run together: charge everything read so far from when the stream started
+        if stream is not None:
+            self.timing.transfer(reader.offset, min(stream.rate, self.timing.dd_rate), stream.started)
+        if options.get("status") != "none":
+            self._out(f"{length // bs}+{1 if length % bs else 0} records in\n"
+                      f"{length // bs}+{1 if length % bs else 0} records out\n")
+        return b"", 0
+
+    # ---------- Host side ----------
+
+    def _fetch(self, url, resume=None, cut=False, fail=False):
+        """
+        Fetches url. With resume (a SimFile already on the board) only the
+        missing bytes are requested, as curl -C - does; with cut the transfer
+        stops halfway. Returns (file, bytes transferred, bytes left unread).
+        """
+        parts = urllib.parse.urlsplit(url)
+        if self.http_port and (parts.port in (None, 80)):
+            parts = parts._replace(netloc=f"{parts.hostname}:{self.http_port}")
+        request = urllib.request.Request(urllib.parse.urlunsplit(parts))
+
+        digest, kept, offset, crc = hashlib.sha256(), bytearray(), 0, 0
+        if resume is not None and (resume.partial is not None or resume.data is not None):
+            offset = resume.size
+            request.add_header("Range", f"bytes={offset}-")
+        try:
+            response = urllib.request.urlopen(request, timeout=30)
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset and not fail:
+                # Nothing left to fetch: curl without -f keeps the file as it is
+                return resume, 0, 0
+            raise
+        with response:
+            if response.status == 206:
+                digest = resume.partial.copy() if resume.partial is not None else hashlib.sha256(resume.data)
+                kept += resume.data or b""
+                crc = zlib.crc32(resume.data) if resume.data is not None else None
+            else:
+                offset = 0
+            length = int(response.headers.get("Content-Length") or 0)
+            limit = length // 2 if cut else None
+            fetched = 0
+            while limit is None or fetched < limit:
+                chunk = response.read(min(1024 * 1024, limit - fetched) if limit else 1024 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                if crc is not None:
+                    crc = zlib.crc32(chunk, crc)
+                fetched += len(chunk)
+                if offset + fetched <= KEEP_LIMIT:
+                    kept += chunk
+        size = offset + fetched
+        remaining = length - fetched if cut else 0
+        sim_file = SimFile(size, digest.hexdigest(), bytes(kept) if size <= KEEP_LIMIT else None,
+                           digest.copy() if remaining else None, crc)
+        return sim_file, fetched, remaining
+
+
+def _sim_file(data):
+    data = bytes(data)
+    return SimFile(len(data), hashlib.sha256(data).hexdigest(), data if len(data) <= KEEP_LIMIT else None,
+                   crc32=zlib.crc32(data))
+
+
+def _write_into(target, offset, data):
+    end = min(offset + len(data), len(target))
+    target[offset:end] = data[:end - offset]
+
+
+def _size(text):
+    units = {"k": 1024, "K": 1024, "M": 1024 * 1024, "G": 1024 ** 3}
+    if text and text[-1] in units:
+        return int(text[:-1]) * units[text[-1]]
+    return int(text)
+
+
+def start_fleet(count, state="shell", timing=None, link_prefix=LINK_PREFIX, **kwargs):
+    """Starts count simulated boards. Returns the list of SimulatedBMC."""
+    timing = timing or SimTiming()
+    fleet = []
+    for index in range(count):
+        link = f"{link_prefix}{index}" if link_prefix else None
+        fleet.append(SimulatedBMC(name=f"bmc{index}", state=state, timing=timing,
+                                  link=link, **kwargs).start())
+    return fleet
+
+
+def stop_fleet(fleet):
+    for bmc in fleet:
+        bmc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate NanoBMC/MOS-BMC serial consoles on local ptys")
+    parser.add_argument("--units", type=int, default=1, help="number of boards to simulate")
+    parser.add_argument("--state", default="shell", choices=("boot", "uboot", "login", "shell"),
+                        help="stage each board starts in")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for every delay (0.01 = 100x faster)")
+    parser.add_argument("--hostname", default="nanobmc")
+    parser.add_argument("--password", default=None, help="root password to require (default: accept any)")
+    parser.add_argument("--http-port", type=int, default=None,
+                        help="port to fetch from when commands ask for port 80")
+    parser.add_argument("--tftp-port", type=int, default=None,
+                        help="port to tftpboot from when U-Boot asks for port 69")
+    args = parser.parse_args()
+
+    fleet = start_fleet(args.units, state=args.state, timing=SimTiming(scale=args.scale),
+                        hostname=args.hostname, password=args.password, http_port=args.http_port,
+                        tftp_port=args.tftp_port)
+    for bmc in fleet:
+        print(f"{bmc.name}: {bmc.path} -> {bmc.device}")
+    print("Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_fleet(fleet)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Boot stage tracking for a serial port.
+
+A BootStageTracker subscribes to a port (see serial_mux) and classifies the
+console stream as it arrives: U-Boot, kernel boot, login prompt or root
+shell. Flows wait for a stage instead of sleeping for a fixed time, and the
+GUI shows the current stage of every unit.
+"""
+
+import asyncio
+import re
+import threading
+import time
+from collections import deque
+
+UNKNOWN = "unknown"
+RESET = "reset"
+UBOOT = "uboot"
+KERNEL = "kernel"
+LOGIN = "login"
+ROOT_SHELL = "root_shell"
+
+# Stage a match moves the port into. Later matches in a chunk win.
+STAGE_PATTERNS = (
+    (RESET, re.compile(rb"reboot: Restarting system|resetting \.\.\.")),
+    (UBOOT, re.compile(rb"U-Boot \d{4}\.\d+|Hit any key to stop autoboot|(?:^|[\r\n])=> ")),
+    (KERNEL, re.compile(rb"Starting kernel|Booting Linux on|## Loading kernel")),
+    (LOGIN, re.compile(rb"[\w.-]+ login: ")),
+    (ROOT_SHELL, re.compile(rb"root@[\w.-]+:[^\r\n#]*# ")),
+)
+
+STAGE_LABELS = {
+    UNKNOWN: "Unknown",
+    RESET: "Resetting",
+    UBOOT: "U-Boot",
+    KERNEL: "Kernel boot",
+    LOGIN: "Login prompt",
+    ROOT_SHELL: "Root shell",
+}
+
+_OVERLAP = 128
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class BootStageTracker:
+    """Classifies a console stream into boot stages and records when each was entered"""
+
+    def __init__(self, history=64):
+        self.stage = UNKNOWN
+        self.entered_at = time.monotonic()
+        self.history = deque([(UNKNOWN, self.entered_at)], maxlen=history)
+        self._tail = b""
+        self._cond = threading.Condition()
+        self._waiters = []
+
+    def __repr__(self):
+        return f"<BootStageTracker {self.stage}>"
+
+    @property
+    def label(self):
+        return STAGE_LABELS.get(self.stage, self.stage)
+
+    def since(self):
+        """Seconds spent in the current stage"""
+        return time.monotonic() - self.entered_at
+
+    def __call__(self, data):
+        """Subscriber entry point: scans a received chunk"""
+        window = self._tail + data
+        fresh_from = len(self._tail)
+        best_end, best_stage = -1, None
+        for stage, pattern in STAGE_PATTERNS:
+            for match in pattern.finditer(window):
+                if match.end() > fresh_from and match.end() > best_end:
+                    best_end, best_stage = match.end(), stage
+        self._tail = window[-_OVERLAP:]
+        if best_stage is not None:
+            self.set_stage(best_stage)
+
+    def set_stage(self, stage):
+        """Records a transition (also used when a flow learns the stage some other way)"""
+        with self._cond:
+            if stage == self.stage:
+                return
+            self.stage = stage
+            self.entered_at = time.monotonic()
+            self.history.append((stage, self.entered_at))
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass
+
+    def _reached(self, stages, since):
+        return self.stage in stages and (since is None or self.entered_at >= since)
+
+    def wait(self, stages, timeout, since=None):
+        """
+        Blocks until the port is in one of stages, entered at or after since
+        (a time.monotonic() value). Returns the stage, or None on timeout.
+        """
+        if isinstance(stages, str):
+            stages = (stages,)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._reached(stages, since):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self.stage
+
+    async def await_stage(self, stages, timeout, since=None):
+        """Coroutine version of wait"""
+        if isinstance(stages, str):
+            stages = (stages,)
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                if self._reached(stages, since):
+                    return self.stage
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                future = loop.create_future()
+                waiter = (loop, future)
+                self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._cond:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+
+    def timeline(self):
+        """Returns [(stage, seconds since the first recorded transition)]"""
+        if not self.history:
+            return []
+        start = self.history[0][1]
+        return [(stage, at - start) for stage, at in self.history]
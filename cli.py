@@ -12,6 +12,7 @@ Commands map directly to your existing async helpers:
 - bmc_factory_reset()         -> factory-reset
 - set_ip(), grab_ip()         -> set-ip, grab-ip
 - login()                     -> login
+- artifact_daemon             -> artifacts status|publish|withdraw|limits|stop
 """
 
 import argparse
@@ -21,6 +22,7 @@ import sys
 from typing import Callable
 
 # Local modules (must be in the same directory or on PYTHONPATH)
+import artifact_daemon
 import bmc
 import network
 import utils
@@ -71,6 +73,19 @@ async def cmd_flash_emmc(args):
     progress = _log_progress(not args.quiet)
 
     dd_value = 1 if args.bmc_type.lower() == "mos-bmc" else 0
+    if args.uboot_write:
+        await bmc.flash_emmc_uboot(
+            bmc_ip=args.bmc_ip,
+            directory=args.directory,
+            my_ip=args.my_ip,
+            dd_value=dd_value,
+            callback_progress=progress,
+            callback_output=output,
+            serial_device=args.serial,
+            tftpboot=args.tftp,
+            mode=args.uboot_write
+        )
+        return
     await bmc.flash_emmc(
         bmc_ip=args.bmc_ip,
         directory=args.directory,
@@ -78,7 +93,9 @@ async def cmd_flash_emmc(args):
         dd_value=dd_value,
         callback_progress=progress,
         callback_output=output,
-        serial_device=args.serial
+        serial_device=args.serial,
+        tftpboot=args.tftp,
+        stream=args.stream
     )
 
 async def cmd_flash_fip(args):
@@ -128,7 +145,8 @@ async def cmd_factory_reset(args):
 async def cmd_set_ip(args):
     output = _log_output(not args.quiet)
     progress = _log_progress(not args.quiet)
-    await network.set_ip(args.bmc_ip, progress, output, args.serial)
+    if not await network.set_ip(args.bmc_ip, progress, output, args.serial):
+        sys.exit(1)
 
 async def cmd_grab_ip(args):
     output = _log_output(not args.quiet)
@@ -143,6 +161,38 @@ async def cmd_login(args):
     if result:
         print(result)
 
+async def cmd_artifacts(args):
+    try:
+        if args.action == "stop":
+            print("Artifact server stopped." if artifact_daemon.stop_daemon() else "Artifact server is not running.")
+        elif args.action == "publish":
+            if not args.target:
+                print("publish needs a file or directory", file=sys.stderr)
+                sys.exit(2)
+            # persist: the CLI exits right away, the registration must outlive it
+            registration = artifact_daemon.register(args.target, args.port, persist=True)
+            print(f"{registration.token} {registration.url_path}")
+        elif args.action == "withdraw":
+            if not (args.target or "").isdigit():
+                print("withdraw needs the token printed by publish", file=sys.stderr)
+                sys.exit(2)
+            artifact_daemon.withdraw(int(args.target))
+        elif args.action == "limits":
+            mb = 1024 * 1024
+            changes = {}
+            if args.max_transfers is not None:
+                changes["max_transfers"] = args.max_transfers
+            if args.rate is not None:
+                changes["rate"] = int(args.rate * mb)
+            if args.client_rate is not None:
+                changes["client_rate"] = int(args.client_rate * mb)
+            print(artifact_daemon.describe_limits(artifact_daemon.limits(**changes)))
+        else:
+            print(artifact_daemon.describe_status(artifact_daemon.status()))
+    except artifact_daemon.ArtifactDaemonError as e:
+        print(f"Artifact server: {e}", file=sys.stderr)
+        sys.exit(1)
+
 
 # ---------- Parser ----------
 
@@ -171,6 +221,16 @@ def build_parser() -> argparse.ArgumentParser:
     s.add_argument("--serial", required=True, help="Serial device (e.g., /dev/ttyUSB0)")
     s.add_argument("--bmc-type", choices=["mos-bmc", "nanobmc"], default="mos-bmc",
                    help="Image flavor used by the flow (default: mos-bmc)")
+    s.add_argument("--tftp", action="store_true",
+                   help="Load the rescue image (or the --uboot-write chunks) with U-Boot tftpboot instead of wget")
+    s.add_argument("--stream", choices=bmc.STREAM_MODES,
+                   help="Write the restore image while it downloads instead of staging it on the BMC: "
+                        "bmaptool reads the URL, pipe = curl | xz -dc | dd, mapped = only the bmap's "
+                        "blocks, decompressed on the host, or delta = only the partitions that differ "
+                        "from the eMMC")
+    s.add_argument("--uboot-write", choices=bmc.UBOOT_WRITE_MODES,
+                   help="Write the restore image from U-Boot without booting the rescue image: CRC-checked "
+                        "chunks written with mmc write, or gzipped chunks with gzwrite (--stream is ignored)")
     s.set_defaults(func=cmd_flash_emmc)
 
     # flash-fip
@@ -220,6 +280,16 @@ def build_parser() -> argparse.ArgumentParser:
     s.add_argument("--serial", required=True, help="Serial device")
     s.set_defaults(func=cmd_login)
 
+    # artifacts
+    s = sub.add_parser("artifacts", help="Inspect or control the shared artifact HTTP server")
+    s.add_argument("action", choices=["status", "publish", "withdraw", "limits", "stop"])
+    s.add_argument("target", nargs="?", help="path to publish, or token to withdraw")
+    s.add_argument("--port", type=int, default=80, help="HTTP port if the server has to be started (default: 80)")
+    s.add_argument("--max-transfers", type=int, help="limits: concurrent large downloads per interface, 0 = no cap")
+    s.add_argument("--rate", type=float, help="limits: MB/s per interface, shared fairly, 0 = unlimited")
+    s.add_argument("--client-rate", type=float, help="limits: MB/s per BMC, 0 = unlimited")
+    s.set_defaults(func=cmd_artifacts)
+
     return p
 
 
@@ -20,7 +20,9 @@ from tkinter import messagebox
 import serial
 import psutil
 
-from utils import cleanup_all_serial_connections, read_serial_data
+from utils import cleanup_all_serial_connections
+from serial_session import console_path, stage_of
+from serial_mux import console_command
 from network import *
 from bmc import *
 
@@ -62,7 +64,7 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
         self.available_devices = []
         
         # Shared server management
-        self.shared_servers = {}  # {host_ip: {'server': server_obj, 'usage_count': int}}
+        self.shared_servers = {}  # {(host_ip, directory): {'server': server_obj, 'usage_count': int}}
         self.server_lock = threading.RLock()
         
         # File paths
@@ -70,6 +72,11 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
         self.fip_file = ctk.StringVar()
         self.eeprom_file = ctk.StringVar()
         self.enable_eeprom = ctk.BooleanVar(value=True)
+        self.use_tftp = ctk.BooleanVar(value=False)
+        self.stream_image = ctk.BooleanVar(value=False)
+        self.map_on_host = ctk.BooleanVar(value=False)
+        self.delta_flash = ctk.BooleanVar(value=False)
+        self.uboot_write = ctk.BooleanVar(value=False)
         
         # Config file
         self.config_file = os.path.expanduser("~/.nanobmc_multiflash_config.json")
@@ -78,6 +85,7 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
         self.create_ui()
         self.load_config()
         self.refresh_devices()
+        self.refresh_unit_stages()
         
         self.protocol("WM_DELETE_WINDOW", self.on_close)
 
@@ -137,9 +145,28 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
                                              command=self.select_eeprom_file, width=70)
         self.eeprom_browse_btn.pack(side="right")
         
+        ctk.CTkCheckBox(frame, text="Load rescue image over TFTP (tftpboot)",
+                        variable=self.use_tftp).pack(anchor="w", padx=10, pady=2)
+        ctk.CTkCheckBox(frame, text="Stream restore image into bmaptool (nothing staged on the BMC)",
+                        variable=self.stream_image).pack(anchor="w", padx=10, pady=2)
+        ctk.CTkCheckBox(frame, text="Decompress on the host and send only mapped blocks (overrides streaming)",
+                        variable=self.map_on_host).pack(anchor="w", padx=10, pady=2)
+        ctk.CTkCheckBox(frame, text="Rewrite only the partitions that changed (overrides the two above)",
+                        variable=self.delta_flash).pack(anchor="w", padx=10, pady=2)
+        ctk.CTkCheckBox(frame, text="Write the eMMC from U-Boot, skipping the rescue boot (mmc write)",
+                        variable=self.uboot_write).pack(anchor="w", padx=10, pady=2)
+
         # Initialize state
         self.toggle_eeprom_state()
 
+    def stream_mode(self):
+        """The install_restore_image stream mode picked in the file section"""
+        if self.delta_flash.get():
+            return STREAM_DELTA
+        if self.map_on_host.get():
+            return STREAM_MAPPED
+        return STREAM_BMAPTOOL if self.stream_image.get() else None
+
     def toggle_eeprom_state(self):
         """Enable/disable EEPROM UI elements based on checkbox"""
         state = "normal" if self.enable_eeprom.get() else "disabled"
@@ -225,6 +252,11 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
                 self.fip_file.set(config.get('fip_file', ''))
                 self.eeprom_file.set(config.get('eeprom_file', ''))
                 self.enable_eeprom.set(config.get('enable_eeprom', True))
+                self.use_tftp.set(config.get('use_tftp', False))
+                self.stream_image.set(config.get('stream_image', False))
+                self.map_on_host.set(config.get('map_on_host', False))
+                self.delta_flash.set(config.get('delta_flash', False))
+                self.uboot_write.set(config.get('uboot_write', False))
                 self.toggle_eeprom_state()
                 
                 # Load units
@@ -251,6 +283,11 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
                 'fip_file': self.fip_file.get(),
                 'eeprom_file': self.eeprom_file.get(),
                 'enable_eeprom': self.enable_eeprom.get(),
+                'use_tftp': self.use_tftp.get(),
+                'stream_image': self.stream_image.get(),
+                'map_on_host': self.map_on_host.get(),
+                'delta_flash': self.delta_flash.get(),
+                'uboot_write': self.uboot_write.get(),
                 'units': [
                     {
                         'device': unit['config'].device,
@@ -364,6 +401,8 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
         ctk.CTkLabel(header, text=f"Unit {unit_id}", font=ctk.CTkFont(weight="bold")).pack(side="left")
         ctk.CTkButton(header, text="Remove", command=lambda: self.remove_unit(unit_id-1), 
                     width=60, height=25).pack(side="right")
+        stage_label = ctk.CTkLabel(header, text="Stage: Not connected", font=ctk.CTkFont(size=10))
+        stage_label.pack(side="right", padx=10)
         
         labels_frame = ctk.CTkFrame(unit_frame)
         labels_frame.pack(fill="x", padx=5, pady=(0,2))
@@ -414,7 +453,8 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             'device_dropdown': device_dropdown,
             'host_ip_dropdown': host_ip_dropdown,
             'progress_bar': progress_bar,
-            'status_label': status_label
+            'status_label': status_label,
+            'stage_label': stage_label
         }
         
         self.units.append(unit)
@@ -423,6 +463,20 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
         if not unit_data:
             self.save_config()
 
+    def refresh_unit_stages(self):
+        """Shows the live boot stage of every unit, refreshed twice a second"""
+        try:
+            for unit in self.units:
+                tracker = stage_of(unit['device_var'].get())
+                if tracker is None:
+                    text = "Stage: Not connected"
+                else:
+                    text = f"Stage: {tracker.label} ({tracker.since():.0f}s)"
+                unit['stage_label'].configure(text=text)
+            self.after(500, self.refresh_unit_stages)
+        except tk.TclError:
+            pass  # window closed
+
     def remove_unit(self, index):
         """Remove unit configuration and renumber remaining units"""
         if 0 <= index < len(self.units):
@@ -454,18 +508,19 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             self.log(f"Unit removed. {len(self.units)} units remaining.")
 
     def get_shared_server(self, host_ip: str, directory: str):
-        """Get or create a shared HTTP server for the host IP"""
+        """Get or create a shared HTTP server for the host IP and firmware directory"""
+        key = (host_ip, directory)
         with self.server_lock:
-            if host_ip in self.shared_servers:
-                self.shared_servers[host_ip]['usage_count'] += 1
-                self.log(f"Reusing server for {host_ip} (usage: {self.shared_servers[host_ip]['usage_count']})")
-                return self.shared_servers[host_ip]['server']
+            if key in self.shared_servers:
+                self.shared_servers[key]['usage_count'] += 1
+                self.log(f"Reusing server for {host_ip} (usage: {self.shared_servers[key]['usage_count']})")
+                return self.shared_servers[key]['server']
             
             try:
-                from network import start_server
-                server = start_server(directory, 80, self.log)
+                from network import serve_artifacts
+                server = serve_artifacts(directory, 80, self.log)
                 if server:
-                    self.shared_servers[host_ip] = {
+                    self.shared_servers[key] = {
                         'server': server,
                         'usage_count': 1,
                         'directory': directory
@@ -478,19 +533,20 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
                 self.log(f"Error creating server for {host_ip}: {e}")
                 return None
 
-    def release_shared_server(self, host_ip: str):
+    def release_shared_server(self, host_ip: str, directory: str):
         """Release a shared server when unit is done"""
+        key = (host_ip, directory)
         with self.server_lock:
-            if host_ip in self.shared_servers:
-                self.shared_servers[host_ip]['usage_count'] -= 1
-                remaining = self.shared_servers[host_ip]['usage_count']
+            if key in self.shared_servers:
+                self.shared_servers[key]['usage_count'] -= 1
+                remaining = self.shared_servers[key]['usage_count']
                 self.log(f"Released server for {host_ip} (remaining usage: {remaining})")
                 
                 if remaining <= 0:
                     try:
                         from network import stop_server
-                        stop_server(self.shared_servers[host_ip]['server'], self.log)
-                        del self.shared_servers[host_ip]
+                        stop_server(self.shared_servers[key]['server'], self.log)
+                        del self.shared_servers[key]
                         self.log(f"Shut down shared server for {host_ip}")
                     except Exception as e:
                         self.log(f"Error shutting down server: {e}")
@@ -498,7 +554,7 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
     def cleanup_all_servers(self):
         """Cleanup all shared servers"""
         with self.server_lock:
-            for host_ip, server_info in list(self.shared_servers.items()):
+            for (host_ip, _), server_info in list(self.shared_servers.items()):
                 try:
                     from network import stop_server
                     stop_server(server_info['server'], self.log)
@@ -618,6 +674,8 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
         config.password = unit['password_var'].get()
         config.bmc_ip = unit['bmc_ip_var'].get()
         config.host_ip = unit['host_ip_var'].get()
+        # Read once: the folder may change in the window while this unit flashes
+        directory = self.firmware_folder.get()
         
         # THREAD-SAFE UI HELPERS
         def update_progress(progress):
@@ -639,7 +697,7 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             
             unit_log(f"Using config - Device: {config.device}, Username: {config.username}, BMC IP: {config.bmc_ip}")
             
-            shared_server = self.get_shared_server(config.host_ip, self.firmware_folder.get())
+            shared_server = self.get_shared_server(config.host_ip, directory)
             if not shared_server:
                 raise Exception("Failed to get shared server")
             
@@ -653,9 +711,10 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
                 if self.operation_running:
                     update_progress(p * 0.2)
             
-            result = asyncio.run(self.flash_emmc_shared(
-                config.bmc_ip, self.firmware_folder.get(), config.host_ip, 2,
-                emmc_progress, unit_log, config.device, shared_server
+            result = asyncio.run(flash_emmc(
+                config.bmc_ip, directory, config.host_ip, 2,
+                emmc_progress, unit_log, config.device, self.use_tftp.get(), self.stream_mode(),
+                UBOOT_MMC_WRITE if self.uboot_write.get() else None, server=shared_server
             ))
             
             if not result or not self.operation_running:
@@ -685,7 +744,8 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
                 if self.operation_running:
                     update_progress(0.4 + p * 0.2)
             
-            asyncio.run(set_ip(config.bmc_ip, ip_progress, unit_log, config.device))
+            if not asyncio.run(set_ip(config.bmc_ip, ip_progress, unit_log, config.device)) and self.operation_running:
+                raise Exception("Setting the BMC IP failed")
             
             if not self.operation_running:
                 return
@@ -697,10 +757,12 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
                 if self.operation_running:
                     update_progress(0.6 + p * 0.2)
             
-            asyncio.run(self.flasher_shared(
-                self.fip_file.get(), config.host_ip, 
-                fip_progress, unit_log, config.device, shared_server
+            result = asyncio.run(flasher(
+                self.fip_file.get(), config.host_ip,
+                fip_progress, unit_log, config.device, server=shared_server
             ))
+            if not result and self.operation_running:
+                raise Exception("U-Boot flash failed")
             
             if self.operation_running and self.enable_eeprom.get():
                 update_status("Flash EEPROM")
@@ -710,10 +772,12 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
                     if self.operation_running:
                         update_progress(0.8 + p * 0.2)
                 
-                asyncio.run(self.flash_eeprom_shared(
+                result = asyncio.run(flash_eeprom(
                     self.eeprom_file.get(), config.host_ip,
-                    eeprom_progress, unit_log, config.device, shared_server
+                    eeprom_progress, unit_log, config.device, server=shared_server
                 ))
+                if not result and self.operation_running:
+                    raise Exception("EEPROM flash failed")
             elif not self.enable_eeprom.get():
                 unit_log("Skipping EEPROM flash (disabled)")
             
@@ -731,175 +795,7 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             update_progress(0)
         finally:
             if shared_server:
-                self.release_shared_server(config.host_ip)
-
-    async def flash_emmc_shared(self, bmc_ip, directory, my_ip, dd_value, 
-                               callback_progress, callback_output, serial_device, shared_server):
-        """Flash eMMC using shared HTTP server"""
-        if dd_value == 1:
-            type_name = 'mos-bmc'
-        else:
-            type_name = 'nanobmc'
-
-        ser = None
-        try:
-            callback_output("Using shared HTTP server for eMMC flash...")
-            callback_progress(0.10)
-
-            ser = serial.Serial(serial_device, 115200, timeout=0.1)
-
-            callback_output("Setting IP Address (bootloader)...")
-            command = f'setenv ipaddr {bmc_ip}\n'
-            response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-            callback_output(response)
-            callback_progress(0.20)
-
-            callback_output("Grabbing virtual restore image...")
-            command = f'wget ${{loadaddr}} {my_ip}:/obmc-rescue-image-snuc-{type_name}.itb; bootm\n'
-            response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-            callback_output(response)
-            callback_progress(0.40)
-
-            callback_output("Setting IP Address (BMC)...")
-            await asyncio.sleep(20)
-            command = f'ifconfig eth0 up {bmc_ip}\n'
-            response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-            callback_output(response)
-            callback_progress(0.50)
-
-            callback_output("Grabbing restore image...")
-            command = f"curl -o obmc-phosphor-image-snuc-{type_name}.wic.xz {my_ip}/obmc-phosphor-image-snuc-{type_name}.wic.xz\n"
-            response = await asyncio.to_thread(read_serial_data, ser, command, 2)
-            callback_output(response)
-            callback_progress(0.60)
-
-            callback_output("Grabbing the mapping file...")
-            command = f'curl -o obmc-phosphor-image-snuc-{type_name}.wic.bmap {my_ip}/obmc-phosphor-image-snuc-{type_name}.wic.bmap\n'
-            response = await asyncio.to_thread(read_serial_data, ser, command, 5)
-            callback_output(response)
-            callback_progress(0.90)
-
-            callback_output("Flashing the restore image...")
-            command = f'bmaptool copy obmc-phosphor-image-snuc-{type_name}.wic.xz /dev/mmcblk0\n'
-            response = await asyncio.to_thread(read_serial_data, ser, command, 5)
-            callback_output(response)
-
-            await asyncio.sleep(55)
-            callback_output("Factory Reset Complete. Rebooting...")
-            ser.write(b'reboot\n')
-            callback_progress(1.00)
-            await asyncio.sleep(60)
-            
-            return True
-
-        except Exception as e:
-            callback_output(f"Error during eMMC flash: {e}")
-            return False
-        finally:
-            if ser and ser.is_open:
-                try:
-                    ser.close()
-                except:
-                    pass
-
-    async def flasher_shared(self, flash_file, my_ip, callback_progress, 
-                            callback_output, serial_device, shared_server):
-        """Flash U-Boot using shared HTTP server"""
-        file_name = os.path.basename(flash_file)
-        port = 80
-
-        callback_output("Using shared HTTP server for U-Boot flash...")
-        callback_progress(0.2)
-
-        ser = None
-        try:
-            ser = serial.Serial(serial_device, 115200, timeout=1)
-            ser.dtr = True
-
-            url = f"http://{my_ip}:{port}/{file_name}"
-            curl_command = f"curl -o {file_name} {url}\n"
-            ser.write(curl_command.encode('utf-8'))
-            await asyncio.sleep(5)
-            callback_output('Curl command sent.')
-
-            callback_progress(0.6)
-
-            command = "echo 0 > /sys/block/mmcblk0boot0/force_ro\n"
-            ser.write(command.encode('utf-8'))
-            await asyncio.sleep(4)
-            callback_output('Changed MMC to RW')
-
-            callback_progress(0.8)
-
-            command = f'dd if={file_name} of=/dev/mmcblk0boot0 bs=512 seek=256\n'
-            ser.write(command.encode('utf-8'))
-            await asyncio.sleep(7)
-            callback_output("U-Boot flashing complete")
-            callback_progress(1)
-
-            remove_command = f"rm -f {file_name}\n"
-            ser.write(remove_command.encode('utf-8'))
-            await asyncio.sleep(2)
-            callback_output(f"{file_name} removed successfully.")
-        finally:
-            if ser and ser.is_open:
-                ser.close()
-
-    async def flash_eeprom_shared(self, flash_file, my_ip, callback_progress, 
-                                 callback_output, serial_device, shared_server):
-        """Flash EEPROM using shared HTTP server"""
-        file_name = os.path.basename(flash_file)
-        port = 80
-
-        callback_output("Using shared HTTP server for EEPROM flash...")
-        callback_progress(0.2)
-
-        ser = None
-        try:
-            ser = serial.Serial(serial_device, 115200, timeout=1)
-            ser.dtr = True
-
-            callback_output("Powering on...")
-            ser.write(b"obmcutil poweron\n")
-            await asyncio.sleep(8)
-            callback_progress(0.4)
-
-            callback_output("Configuring EEPROM...")
-            ser.write(b"echo 24c02 0x50 > /sys/class/i2c-adapter/i2c-1/new_device\n")
-            await asyncio.sleep(8)
-            callback_progress(0.6)
-
-            url = f"http://{my_ip}:{port}/{file_name}"
-            curl_command = f"curl -o {file_name} {url}\n"
-            ser.write(curl_command.encode('utf-8'))
-            await asyncio.sleep(8)
-            callback_output(f"Fetching FRU binary from {url}")
-
-            callback_progress(0.8)
-
-            callback_output("Flashing EEPROM...")
-            flash_command = f"dd if={file_name} of=/sys/bus/i2c/devices/1-0050/eeprom\n"
-            ser.write(flash_command.encode('utf-8'))
-            await asyncio.sleep(8)
-            callback_output("EEPROM flashing complete.")
-            callback_progress(1.0)
-
-            callback_output("Removing FRU binary...")
-            remove_command = f"rm -f {file_name}\n"
-            ser.write(remove_command.encode('utf-8'))
-            await asyncio.sleep(5)
-            callback_output("FRU binary removed successfully.")
-
-            callback_output("Rebooting system...")
-            ser.write(b"obmcutil poweroff && reboot\n")
-            await asyncio.sleep(5)
-            callback_output("System reboot initiated.")
-            
-        except Exception as e:
-            callback_output(f"EEPROM Flash Error: {e}")
-        finally:
-            if ser and ser.is_open:
-                ser.close()
+                self.release_shared_server(config.host_ip, directory)
 
     def monitor_progress(self):
         """Monitor overall progress"""
@@ -996,6 +892,14 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             self.log(f"Console error: {e}")
             self.open_individual_consoles(units_with_devices)
 
+    def console_command(self, device):
+        """minicom command for a unit, attached to the shared console pty when possible"""
+        try:
+            return console_command(console_path(device))
+        except Exception as e:
+            self.log(f"Console pty unavailable for {device} ({e}), opening it directly")
+            return f"minicom -D {device}"
+
     def try_terminator_console(self, units_with_devices):
         """Try to open Terminator with persistent config"""
         try:
@@ -1084,17 +988,17 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             subprocess.run([
                 "tmux", "new-session", "-d", "-s", session_name,
                 "-c", os.getcwd(),
-                f"minicom -D {first_unit['device_var'].get()}"
+                self.console_command(first_unit['device_var'].get())
             ])
             
             for i, unit in enumerate(units_with_devices[1:], 1):
                 device = unit['device_var'].get()
                 if i % 2 == 1:
                     subprocess.run(["tmux", "split-window", "-h", "-t", session_name, 
-                                  f"minicom -D {device}"])
+                                  self.console_command(device)])
                 else:
                     subprocess.run(["tmux", "split-window", "-v", "-t", session_name, 
-                                  f"minicom -D {device}"])
+                                  self.console_command(device)])
             
             subprocess.run(["tmux", "select-layout", "-t", session_name, "tiled"])
             
@@ -1124,14 +1028,14 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             first_unit = units_with_devices[0]
             subprocess.run([
                 "screen", "-dmS", session_name,
-                "minicom", "-D", first_unit['device_var'].get()
+                *self.console_command(first_unit['device_var'].get()).split()
             ])
             
             for i, unit in enumerate(units_with_devices[1:], 1):
                 device = unit['device_var'].get()
                 subprocess.run([
                     "screen", "-S", session_name, "-X", "screen", 
-                    "minicom", "-D", device
+                    *self.console_command(device).split()
                 ])
             
             subprocess.Popen([
@@ -1162,15 +1066,16 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             bmc_ip = unit['bmc_ip_var'].get() or "No IP"
             
             try:
+                command = self.console_command(device)
                 terminal_commands = [
                     ["x-terminal-emulator", "-T", f"Unit {unit_id} - {device} - {bmc_ip}", 
-                     "-e", f"minicom -D {device}"],
+                     "-e", command],
                     ["gnome-terminal", "--title", f"Unit {unit_id} - {device} - {bmc_ip}", 
-                     "--", "minicom", "-D", device],
+                     "--", *command.split()],
                     ["xterm", "-T", f"Unit {unit_id} - {device} - {bmc_ip}", 
-                     "-e", f"minicom -D {device}"],
+                     "-e", command],
                     ["konsole", "--title", f"Unit {unit_id} - {device} - {bmc_ip}", 
-                     "-e", f"minicom -D {device}"]
+                     "-e", command]
                 ]
                 
                 process_started = False
@@ -1257,13 +1162,15 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             except (FileNotFoundError, subprocess.SubprocessError):
                 pass
             
+            # Consoles ride on the shared sessions, so only their ptys are torn
+            # down here; the ports stay open for any flash in progress.
             try:
-                from utils import cleanup_all_serial_connections
-                connections_cleaned = cleanup_all_serial_connections()
-                if connections_cleaned > 0:
-                    self.log(f"Detached {connections_cleaned} serial connections")
+                from serial_session import registry
+                consoles_detached = registry.detach_consoles()
+                if consoles_detached > 0:
+                    self.log(f"Detached {consoles_detached} console ptys")
             except Exception as e:
-                self.log(f"Error detaching serial connections: {e}")
+                self.log(f"Error detaching console ptys: {e}")
             
             self.log("Console cleanup completed - all minicom processes closed")
                 
@@ -1291,7 +1198,7 @@ class MultiUnitFlashWindow(ctk.CTkToplevel):
             title = f"Unit{unit_id}-{device_name}-{bmc_ip}"
             
             config += f"""  [[unit_{unit_id}]]
-        custom_command = minicom -D {device}
+        custom_command = {self.console_command(device)}
         use_custom_command = True
         scrollback_lines = 500
         font = Monospace 8
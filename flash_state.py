@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Checkpoints for the Flash All sequence.
+
+Flash All writes a unit's eMMC, FIP and EEPROM in that order. Each step
+that completes is recorded in ~/.local/platypus/flash_all.json with the
+digest of what it wrote, per unit (keyed by the unit's MAC address, see
+bmc.unit_identity, so a board swapped onto the same console adapter
+starts over). A rerun with the same artifacts resumes after the steps
+already recorded instead of starting over with the eMMC. A step only counts as done while
+its recorded digest matches and every step before it counts as done too.
+Redoing a step drops the records of the steps after it.
+
+Usage:
+    python flash_state.py [show]
+    python flash_state.py forget MAC_ADDRESS
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+STATE_PATH = os.path.expanduser("~/.local/platypus/flash_all.json")
+STEP_EMMC = "emmc"
+STEP_FIP = "fip"
+STEP_EEPROM = "eeprom"
+STEPS = (STEP_EMMC, STEP_FIP, STEP_EEPROM)
+
+
+class FlashState:
+    """Per-unit step records, shared by threads and processes through a locked JSON file"""
+
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """The state, locked against other threads and processes; saved on exit if changed"""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with self._lock, open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+            before = json.dumps(state, sort_keys=True)
+            yield state
+            if json.dumps(state, sort_keys=True) != before:
+                fd, temp = tempfile.mkstemp(dir=directory, prefix=".flash_all-")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(state, f, indent=1)
+                os.replace(temp, self.path)
+
+    def units(self):
+        with self._locked() as state:
+            return dict(state)
+
+    def completed(self, unit, digests):
+        """
+        The leading steps recorded for unit with the digests given
+        ({step: digest}), in STEPS order; stops at the first step that is
+        missing, has another digest or is not in digests.
+        """
+        with self._locked() as state:
+            records = state.get(unit, {})
+        done = []
+        for step in STEPS:
+            if step not in digests or records.get(step, {}).get("digest") != digests[step]:
+                break
+            done.append(step)
+        return done
+
+    def mark(self, unit, step, digest):
+        """Records step as done for unit with digest; the steps after it are no longer done"""
+        with self._locked() as state:
+            records = state.setdefault(unit, {})
+            for later in STEPS[STEPS.index(step) + 1:]:
+                records.pop(later, None)
+            records[step] = {"digest": digest, "at": time.time()}
+
+    def forget(self, unit, step=None):
+        """Drops step and everything after it for unit, or the whole unit without step"""
+        with self._locked() as state:
+            if step is None:
+                state.pop(unit, None)
+                return
+            records = state.get(unit, {})
+            for later in STEPS[STEPS.index(step):]:
+                records.pop(later, None)
+
+
+flash_state = FlashState()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or clear Flash All checkpoints")
+    parser.add_argument("action", nargs="?", choices=["show", "forget"], default="show")
+    parser.add_argument("unit", nargs="?", help="MAC address of the unit to forget")
+    args = parser.parse_args()
+    if args.action == "forget":
+        if not args.unit:
+            parser.error("forget needs the unit's MAC address")
+        flash_state.forget(args.unit.lower())
+        return
+    for unit, records in sorted(flash_state.units().items()):
+        steps = ", ".join(f"{step} {records[step]['digest'][:12]} "
+                          f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(records[step]['at']))}"
+                          for step in STEPS if step in records)
+        print(f"{unit}: {steps or 'nothing recorded'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,25 @@
-import serial
 import asyncio
-import threading 
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+import contextlib
 import os 
+import urllib.parse
 
-from utils import read_serial_data
+import artifact_daemon
+import artifact_server
+import artifact_store
+from serial_session import aacquire_session
+from utils import UBOOT_PROMPT, SHELL_PROMPT, LOGIN_PROMPT
+from boot_stage import UBOOT, LOGIN, ROOT_SHELL
+
+# How long set_ip waits for a BMC that is still booting
+SHELL_WAIT = 120
 
 # Grabs the current ip address of the bmc
 async def grab_ip(callback_output, serial_device):
-    ser = serial.Serial(serial_device, 115200, timeout=1)
+    ser = await aacquire_session(serial_device, owner="grab_ip")
     command = "/sbin/ifconfig eth0 | grep 'inet addr' | cut -d: -f2 | awk '{print $1}'\n"
 
     try:
-        response = await asyncio.to_thread(read_serial_data, ser, command, 2)
+        response = (await ser.asend_and_expect(command)).output
 
         lines = response.split('\n')
         for line in lines:
@@ -24,77 +31,167 @@ async def grab_ip(callback_output, serial_device):
         callback_output(f"Error: {e}")
         return None
     finally:
-        ser.close()
+        ser.release()
 
 # Sets a temporary ip address to the bmc through serial 
 async def set_ip(bmc_ip, callback_progress, callback_output, serial_device):
-    """Sets the IP address of the BMC with flexible root prompt detection."""
-    ser = serial.Serial(serial_device, 115200, timeout=1)
-    ser.dtr = True
-    
-    callback_progress(0.10)
-    callback_output("Starting IP setup...")
-    
+    """Sets the IP address of the BMC once it is at a root shell. Returns True if it was set."""
+    ser = await aacquire_session(serial_device, owner="set_ip")
+
     try:
-        # Clear input buffer
-        ser.reset_input_buffer()
-        
-        # Try to ensure we're at a command prompt
-        for _ in range(1):
-            ser.write(b"\n")
-            await asyncio.sleep(0.5)
-        
-        # Read response
-        initial_response = ser.read_all().decode('utf-8', errors='ignore')
+        callback_progress(0.10)
+        callback_output("Starting IP setup...")
+
+        # Wait for a root shell instead of proceeding regardless of the prompt
+        if ser.stage != ROOT_SHELL:
+            await ser.asend_and_expect("\n", (SHELL_PROMPT, LOGIN_PROMPT, UBOOT_PROMPT), 2)
+        if ser.stage not in (ROOT_SHELL, LOGIN, UBOOT):
+            callback_output(f"BMC is at {ser.stages.label}, waiting for it to finish booting...")
+            await ser.await_stage((ROOT_SHELL, LOGIN, UBOOT), SHELL_WAIT)
+        if ser.stage != ROOT_SHELL:
+            raise Exception(f"BMC is at {ser.stages.label}, not a root shell. Log in first.")
         
-        # Proceed regardless of prompt detection
         callback_output("Setting IP address...")
         callback_progress(0.25)
+        await ser.arun(f"ifconfig eth0 up {bmc_ip}", timeout=10, check=True)
+        callback_progress(0.60)
         
-        # Send command to set IP
-        command = f"ifconfig eth0 up {bmc_ip}\n"
-        ser.write(command.encode('utf-8'))
-        await asyncio.sleep(1.5)
-        
-        # Optional verification - try to check if command ran
-        verify_cmd = "ifconfig eth0\n"
-        ser.write(verify_cmd.encode('utf-8'))
-        await asyncio.sleep(1)
-        verify_response = ser.read_all().decode('utf-8', errors='ignore')
-        
-        # Look for the IP or other success indicators in the response
-        if bmc_ip in verify_response:
+        # Verify the address actually took
+        verify = await ser.arun("ifconfig eth0", timeout=10)
+        if bmc_ip in verify.output:
             callback_output(f"Verified IP address set to {bmc_ip}")
-        elif "eth0" in verify_response and "inet" in verify_response:
+        elif "eth0" in verify.output and "inet" in verify.output:
             callback_output("Network interface configured (IP may have been set)")
         
         callback_progress(1)
-        ser.close()
-        callback_output(f"IP setup command completed.")
-        await asyncio.sleep(5)
+        callback_output("IP setup command completed.")
         callback_progress(0)
-        
+        return True
+
     except Exception as e:
         callback_output(f"Error during IP setup: {e}")
         callback_output("Exiting process. IP setup unsuccessful.")
         callback_progress(0)
-        ser.close()
+        return False
+    finally:
+        ser.release()
 
 
-# Function to start an HTTP server for serving files
+# Publishes a directory on the artifact server for the BMC to fetch from
 def start_server(directory, port, callback_output):
-    os.chdir(directory)
-    handler = SimpleHTTPRequestHandler
-    httpd = HTTPServer(('0.0.0.0', port), handler)
-    threading.Thread(target=httpd.serve_forever, daemon=True).start()
-    callback_output(f"Serving files from {directory} on port {port}")
-    return httpd
-
-# Function to stop the HTTP server
+    """
+    Registers directory with the artifact daemon (started on first use) and
+    returns the registration. If the daemon cannot be reached, a server is
+    started in this process instead.
+    """
+    try:
+        registration = artifact_daemon.register(directory, port)
+    except Exception as e:
+        callback_output(f"Artifact daemon unavailable ({e}), starting a server in this process.")
+        httpd = artifact_server.serve(directory if os.path.isdir(directory) else os.path.dirname(directory),
+                                      port, callback_output)
+        callback_output(f"Serving files from {directory} on port {port}")
+        return httpd
+    if registration.port != port:
+        callback_output(f"Warning: the artifact daemon listens on port {registration.port}, not {port}.")
+    callback_output(f"Serving files from {directory} on port {registration.port}")
+    return registration
+
+# Publishes a firmware directory through the content-addressed artifact store
+def serve_artifacts(path, port, callback_output):
+    """
+    Imports the artifacts in a directory, or a single file, into the store
+    (only a stat check once they are in) and publishes a view of them with
+    the same file names.
+    """
+    try:
+        view, staged = artifact_store.default_store.stage(path, callback_output)
+    except Exception as e:
+        callback_output(f"Could not stage {path} in the artifact store ({e}), serving it directly.")
+        return start_server(path, port, callback_output)
+    for name, artifact in staged.items():
+        callback_output(f"{name}: sha256 {artifact.digest[:16]}...")
+    return start_server(view, port, callback_output)
+
+# Offers what start_server published over TFTP as well, for U-Boot tftpboot
+def start_tftp(httpd, callback_output, port=69):
+    """Returns the TFTP port serving the same files as httpd"""
+    if isinstance(httpd, artifact_daemon.Registration):
+        tftp_port = artifact_daemon.start_tftp(port)
+    else:
+        tftp_port = httpd.start_tftp(port)
+    callback_output(f"Serving the same files over TFTP on port {tftp_port}")
+    return tftp_port
+
+# Where the BMC finds a file in what start_server or publish published
+def artifact_path(httpd, name):
+    """
+    URL path, without the leading slash, of name in the directory (or the
+    file) httpd publishes: under the registration's or mount's own prefix,
+    or at the root of a server started for one directory.
+    """
+    if isinstance(httpd, (artifact_daemon.Registration, artifact_server.Mount)):
+        url_path = httpd.url_path
+    else:
+        url_path = "/"
+    return (url_path[:url_path.rfind("/") + 1] + urllib.parse.quote(name)).lstrip("/")
+
+# Publishes one more path on the server start_server returned
+def publish(httpd, path):
+    """
+    Serves path (a file, or a directory's contents) under a URL prefix of
+    its own on what httpd serves (see artifact_path). Returns a handle
+    whose stop() withdraws it.
+    """
+    if isinstance(httpd, artifact_daemon.Registration):
+        return artifact_daemon.register(path, httpd.port)
+    return artifact_server.Mount(httpd, httpd.mount(path))
+
+# Takes a turn among the large downloads of units flashed together
+@contextlib.asynccontextmanager
+async def download_slot(httpd, interface, client, label, callback_output):
+    """
+    Queues client (a BMC IP) for one of the artifact server's large-transfer
+    slots on the host interface it downloads through, and holds the slot
+    for the block. If the scheduler cannot be reached the download goes
+    ahead without one.
+    """
+    reservation = None
+    try:
+        if isinstance(httpd, artifact_daemon.Registration):
+            reservation = await asyncio.to_thread(artifact_daemon.DaemonReservation, client, interface, label,
+                                                  httpd.port)
+        else:
+            reservation = httpd.scheduler.reservation(interface, client, label)
+        wait = asyncio.ensure_future(asyncio.to_thread(reservation.wait))
+        try:
+            waited = await asyncio.wait_for(asyncio.shield(wait), 1)
+        except asyncio.TimeoutError:
+            callback_output(f"Waiting for a transfer slot for {label}...")
+            waited = await wait
+            callback_output(f"Got a transfer slot after {waited:.0f}s.")
+    except Exception as e:
+        callback_output(f"Transfer scheduler unavailable ({e}), downloading without a slot.")
+        if reservation is not None:
+            reservation.release()
+            reservation = None
+    except BaseException:
+        if reservation is not None:
+            reservation.release()
+        raise
+    try:
+        yield
+    finally:
+        if reservation is not None:
+            reservation.release()
+
+# Withdraws what start_server published (the daemon itself keeps running)
 def stop_server(httpd, callback_output):
     if httpd:
-        httpd.shutdown()
-        httpd.server_close()
-        callback_output("Server has been stopped.")
+        httpd.stop()
+        if isinstance(httpd, artifact_daemon.Registration):
+            callback_output(f"Stopped serving {httpd.path}.")
+        else:
+            callback_output("Server has been stopped.")
     else:
-        callback_output("Server instance is None.")
\ No newline at end of file
+        callback_output("Server instance is None.")
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Partition-level delta flashing for restore images.
+
+Between two releases usually only some partitions of the .wic change,
+most often the rootfs, yet a full flash rewrites all of them. build()
+reads the image's partition table (GPT or MBR) and splits the bmap's
+mapped data by partition. Each partition becomes a region with the
+SHA-256 of its mapped bytes, a payload holding those bytes, a writer
+script (dd per extent, as bmap_image.writer_script) and a reader script
+that reads the same extents back from the device. Data outside any
+partition, such as the partition table itself, forms one more region,
+"table". On the BMC
+
+    sh <region>.read.sh | sha256sum
+
+prints the digest of what the eMMC holds there. Only regions whose
+digest differs need
+
+    curl http://<host>/<region>.bin | sh <region>.sh
+
+Only the mapped extents are hashed and written, so holes the bmap skips
+are treated as bmaptool treats them. Logical partitions inside an MBR
+extended partition are handled as one region. Results are cached in the
+artifact store under delta/<image digest>-<bmap digest>/.
+
+Usage:
+    python partition_delta.py IMAGE.wic.xz IMAGE.wic.bmap
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from typing import List
+
+from artifact_store import default_store
+from bmap_image import DEVICE, BmapError, RangeChecker, cached_build, read_extents, import_pair, mapped_extents, open_image
+
+SECTOR = 512
+# The partition tables sit in the first sectors; GPT entries end well before this
+HEAD_SIZE = 1024 * 1024
+# Largest dd block size the scripts use
+DD_BLOCK = 1024 * 1024
+TABLE = "table"
+_EXTENDED = (0x05, 0x0F, 0x85)
+_GPT_PROTECTIVE = 0xEE
+
+
+class PartitionTableError(BmapError):
+    """The image has no partition table this module can read"""
+
+
+@dataclass
+class Partition:
+    """One entry of the image's partition table, in bytes"""
+    number: int
+    label: str
+    offset: int
+    size: int
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+
+@dataclass
+class Region:
+    """A partition of the image, or TABLE for everything outside the partitions"""
+    name: str       # p<number> or TABLE, also the stem of its files
+    label: str
+    offset: int
+    size: int
+    digest: str     # SHA-256 of the region's mapped bytes, what the reader script prints
+    mapped: int     # bytes of mapped data in the region, the payload size
+    extents: int
+    payload: str
+    writer: str
+    reader: str
+
+
+@dataclass
+class DeltaImage:
+    """The regions of an image with the files to check and rewrite each one"""
+    directory: str
+    scheme: str
+    regions: List[Region]
+    image_size: int
+    cached: bool = False
+    elapsed: float = 0.0
+
+    def describe(self):
+        mb = 1024 * 1024
+        how = "cached" if self.cached else f"built in {self.elapsed:.1f}s"
+        parts = ", ".join(f"{region.label or region.name} {region.mapped / mb:.1f} MB" for region in self.regions)
+        return f"{self.scheme.upper()} image of {self.image_size / mb:.1f} MB: {parts} ({how})"
+
+
+def _gpt(head):
+    header = head[SECTOR:2 * SECTOR]
+    if header[:8] != b"EFI PART":
+        raise PartitionTableError("protective MBR without a GPT header")
+    header_size, header_crc = struct.unpack_from("<II", header, 12)
+    if zlib.crc32(header[:16] + b"\0\0\0\0" + header[20:header_size]) != header_crc:
+        raise PartitionTableError("GPT header checksum mismatch")
+    entries_lba, count, entry_size, entries_crc = struct.unpack_from("<QIII", header, 72)
+    start = entries_lba * SECTOR
+    entries = head[start:start + count * entry_size]
+    if len(entries) < count * entry_size:
+        raise PartitionTableError("GPT entries lie beyond the start of the image")
+    if zlib.crc32(entries) != entries_crc:
+        raise PartitionTableError("GPT entries checksum mismatch")
+    partitions = []
+    for index in range(count):
+        entry = entries[index * entry_size:(index + 1) * entry_size]
+        if not any(entry[:16]):
+            continue
+        first, last = struct.unpack_from("<QQ", entry, 32)
+        label = entry[56:128].decode("utf-16-le", errors="replace").split("\0", 1)[0]
+        partitions.append(Partition(index + 1, label, first * SECTOR, (last - first + 1) * SECTOR))
+    return partitions
+
+
+def parse_table(head):
+    """(scheme, partitions) from the first bytes of an image; raises PartitionTableError"""
+    if len(head) < 2 * SECTOR or head[510:512] != b"\x55\xaa":
+        raise PartitionTableError("no partition table")
+    entries = [struct.unpack_from("<B3xBxxxII", head, 446 + 16 * index) for index in range(4)]
+    if any(kind == _GPT_PROTECTIVE for _, kind, _, _ in entries):
+        scheme, partitions = "gpt", _gpt(head)
+    else:
+        scheme = "mbr"
+        partitions = [Partition(index + 1, "extended" if kind in _EXTENDED else "", lba * SECTOR, sectors * SECTOR)
+                      for index, (_, kind, lba, sectors) in enumerate(entries) if kind and sectors]
+    partitions.sort(key=lambda partition: partition.offset)
+    if not partitions:
+        raise PartitionTableError(f"the {scheme.upper()} table lists no partitions")
+    for before, after in zip(partitions, partitions[1:]):
+        if after.offset < before.end:
+            raise PartitionTableError(f"partitions {before.number} and {after.number} overlap")
+    return scheme, partitions
+
+
+def split_extents(extents, partitions):
+    """
+    Cuts (offset, size) extents at partition boundaries. Returns a list of
+    (partition or None, offset, size) in order, None for data outside
+    every partition.
+    """
+    pieces = []
+    for offset, size in extents:
+        end = offset + size
+        while offset < end:
+            inside = next((p for p in partitions if p.offset <= offset < p.end), None)
+            if inside is not None:
+                stop = min(end, inside.end)
+            else:
+                stop = min([end] + [p.offset for p in partitions if p.offset > offset])
+            pieces.append((inside, offset, stop - offset))
+            offset = stop
+    return pieces
+
+
+def _runs(offset, size, limit=DD_BLOCK):
+    """Splits an extent into (bs, first, count) runs for dd, largest blocks first"""
+    runs = []
+    while size:
+        bs = limit
+        while offset % bs or size < bs:
+            bs //= 2
+        count = size // bs
+        runs.append((bs, offset // bs, count))
+        offset += bs * count
+        size -= bs * count
+    return runs
+
+
+def region_scripts(name, extents, device=DEVICE):
+    """(writer, reader) shell scripts for a region's (offset, size) extents on device"""
+    mapped = sum(size for _, size in extents)
+    writer = ["#!/bin/sh", f"# {name}: {len(extents)} extents, {mapped} bytes", "set -e"]
+    reader = ["#!/bin/sh", f"# {name}: reads back what the writer script writes", "set -e"]
+    for offset, size in extents:
+        for bs, first, count in _runs(offset, size):
+            writer.append(f"dd of={device} bs={bs} seek={first} count={count} "
+                          f"iflag=fullblock conv=notrunc status=none")
+            reader.append(f"dd if={device} bs={bs} skip={first} count={count} status=none")
+    writer += ["sync", f"echo \"Wrote {mapped} bytes of {name} to {device}\"", ""]
+    return "\n".join(writer), "\n".join(reader + [""])
+
+
+def build(image_path, bmap_path, store=default_store, device=DEVICE):
+    """
+    Returns the DeltaImage for an image and its bmap, building it on first
+    use. Raises PartitionTableError for an image without a readable
+    partition table and BmapError if the bmap does not match the image.
+    """
+    started = time.monotonic()
+    image, bmap_artifact, bmap, base = import_pair(store, image_path, bmap_path)
+    image_path = store.object_path(image.digest)
+
+    def fill(directory):
+        with open_image(image_path, image.name) as source:
+            head = source.read(min(HEAD_SIZE, bmap.image_size))
+        scheme, partitions = parse_table(head)
+        regions = {}
+        for partition in partitions:
+            regions[partition.number] = Region(f"p{partition.number}", partition.label, partition.offset,
+                                               partition.size, "", 0, 0, "", "", "")
+        regions[None] = Region(TABLE, "", 0, bmap.image_size, "", 0, 0, "", "", "")
+        pieces = split_extents(mapped_extents(bmap), partitions)
+        extents = {number: [] for number in regions}
+        digests = {number: hashlib.sha256() for number in regions}
+        payloads = {}
+        checker = RangeChecker(bmap)
+        try:
+            with open_image(image_path, image.name) as source:
+                started = None
+                for index, offset, data in read_extents(source, [(offset, size) for _, offset, size in pieces]):
+                    checker.feed(offset, data)
+                    partition, start, size = pieces[index]
+                    number = partition.number if partition else None
+                    region = regions[number]
+                    if number not in payloads:
+                        region.payload = f"{base}.{region.name}.bin"
+                        payloads[number] = open(os.path.join(directory, region.payload), "wb")
+                    payloads[number].write(data)
+                    digests[number].update(data)
+                    if index != started:
+                        extents[number].append((start, size))
+                        started = index
+        finally:
+            for payload in payloads.values():
+                payload.close()
+
+        kept = []
+        for number, region in regions.items():
+            if not extents[number]:
+                continue
+            region.digest = digests[number].hexdigest()
+            region.mapped = sum(size for _, size in extents[number])
+            region.extents = len(extents[number])
+            region.writer, region.reader = f"{base}.{region.name}.sh", f"{base}.{region.name}.read.sh"
+            writer, reader = region_scripts(region.label or region.name, extents[number], device)
+            with open(os.path.join(directory, region.writer), "w") as f:
+                f.write(writer)
+            with open(os.path.join(directory, region.reader), "w") as f:
+                f.write(reader)
+            kept.append(asdict(region))
+        with open(os.path.join(directory, "delta.json"), "w") as f:
+            json.dump({"scheme": scheme, "image_size": bmap.image_size, "regions": kept}, f, indent=1)
+
+    directory, cached = cached_build(store, "delta", f"{image.digest[:16]}-{bmap_artifact.digest[:16]}", fill)
+    with open(os.path.join(directory, "delta.json")) as f:
+        manifest = json.load(f)
+    return DeltaImage(directory, manifest["scheme"], [Region(**region) for region in manifest["regions"]],
+                      manifest["image_size"], cached, time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a restore image into per-partition delta regions")
+    parser.add_argument("image")
+    parser.add_argument("bmap")
+    parser.add_argument("--device", default=DEVICE, help=f"device the scripts target (default: {DEVICE})")
+    args = parser.parse_args()
+    delta = build(args.image, args.bmap, device=args.device)
+    print(delta.describe())
+    for region in delta.regions:
+        print(f"{region.name:<6} {region.label:<12} {region.offset:>12} {region.size:>12} "
+              f"{region.mapped:>12} {region.digest[:16]}")
+    print(delta.directory)
+
+
+if __name__ == "__main__":
+    main()
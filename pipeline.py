@@ -0,0 +1,261 @@
+"""
+Declarative step pipelines for the flash flows.
+
+A flow is a sequence of Steps. A step has an action, a coroutine that
+starts something: a command on the console, a download, a reboot. It
+also has a probe that tells when that something has finished:
+
+- Prompt:   one of some console patterns appeared (fail patterns end it early)
+- Stage:    the boot stage tracker reached one of some stages
+- ExitCode: the CommandResult the action returned has the expected exit code
+- PortOpen: a TCP port accepts connections
+- FileHash: a file or device region on the BMC hashes to the expected digest
+
+run() starts each action and moves on as soon as its probe passes. It
+raises StepError once the step's timeout is spent. Nothing sleeps for a
+fixed time in between. The step definitions live next to the flows that
+use them (bmc.EMMC_STEPS, bmc.FIP_STEPS, ...), so the GUI, the CLI and the
+multi-unit window all run the same sequences.
+"""
+
+import abc
+import asyncio
+import contextlib
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional, Sequence, Tuple
+
+from serial_session import CommandError, CommandResult
+
+
+class StepError(Exception):
+    """A step's probe did not pass within its timeout"""
+
+    def __init__(self, step, reason, outcome=None):
+        self.step = step
+        self.reason = reason
+        self.outcome = outcome
+        super().__init__(f"{step.name}: {reason}")
+
+    @property
+    def output(self):
+        """What the failing command printed, if the step ran one"""
+        return self.outcome.output if isinstance(self.outcome, CommandResult) else ""
+
+
+def value(item, flow):
+    """item, or item(flow) for values only known once the flow runs"""
+    return item(flow) if callable(item) else item
+
+
+class Flow:
+    """
+    What the steps of one run share: the console session, the callbacks,
+    and keyword values (bmc_ip, my_ip, ...) that become attributes. Actions
+    may add attributes for later steps. results and timings are filled in
+    per step name.
+    """
+
+    def __init__(self, ser, callback_output, callback_progress, **values):
+        self.ser = ser
+        self.callback_output = callback_output
+        self.callback_progress = callback_progress
+        self.results = {}
+        self.timings = {}
+        self.deadline = None
+        self.__dict__.update(values)
+
+    def remaining(self):
+        """Seconds left of the running step's timeout"""
+        return max(0.0, self.deadline - time.monotonic()) if self.deadline else 0.0
+
+
+# ---------- Probes ----------
+
+class Probe(abc.ABC):
+    """Decides whether a step has finished"""
+
+    @abc.abstractmethod
+    async def check(self, flow, outcome, timeout, since):
+        """None once the step has finished, else why not; waits at most timeout seconds"""
+
+
+class Prompt(Probe):
+    """One of patterns appears on the console; one of fail first fails the step"""
+
+    def __init__(self, patterns, fail=(), log=True):
+        self.patterns = tuple(patterns)
+        self.fail = tuple(fail)
+        self.log = log
+
+    async def check(self, flow, outcome, timeout, since):
+        result = await flow.ser.aexpect(self.patterns + self.fail, timeout)
+        if self.log and result.output.strip():
+            flow.callback_output(result.output)
+        if result.pattern in self.patterns:
+            return None
+        if result.pattern is not None:
+            return f"'{result.pattern}' appeared instead of {', '.join(self.patterns)}"
+        return f"none of {', '.join(self.patterns)} appeared within {timeout:.0f}s"
+
+
+class Stage(Probe):
+    """The boot stage tracker reaches one of stages after the step started"""
+
+    def __init__(self, stages):
+        self.stages = tuple(stages)
+
+    async def check(self, flow, outcome, timeout, since):
+        if await flow.ser.await_stage(self.stages, timeout, since=since) is None:
+            return f"still at {flow.ser.stages.label} after {timeout:.0f}s"
+        flow.callback_output(f"BMC reached {flow.ser.stages.label} {time.monotonic() - since:.1f}s later.")
+        return None
+
+
+class ExitCode(Probe):
+    """The action returned a CommandResult with exit code code"""
+
+    def __init__(self, code=0, log=True):
+        self.code = code
+        self.log = log
+
+    async def check(self, flow, outcome, timeout, since):
+        if self.log and outcome.output:
+            flow.callback_output(outcome.output)
+        if outcome.exit_code == self.code:
+            return None
+        return str(CommandError(outcome))
+
+
+class PortOpen(Probe):
+    """host:port accepts TCP connections; host may be a callable of the flow"""
+
+    def __init__(self, host, port, interval=0.5):
+        self.host = host
+        self.port = port
+        self.interval = interval
+
+    async def check(self, flow, outcome, timeout, since):
+        host = value(self.host, flow)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(host, self.port),
+                                                   max(0.1, min(self.interval * 4, deadline - time.monotonic())))
+                writer.close()
+                return None
+            except (OSError, asyncio.TimeoutError) as e:
+                reason = e
+            if time.monotonic() + self.interval > deadline:
+                return f"{host}:{self.port} not open after {timeout:.0f}s ({reason or 'timed out'})"
+            await asyncio.sleep(self.interval)
+
+
+class FileHash(Probe):
+    """
+    path on the BMC (a file, or size bytes at seek 512-byte blocks into a
+    device) hashes to digest. Each argument may be a callable of the flow.
+    """
+
+    def __init__(self, path, digest, size=None, seek=0):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.seek = seek
+
+    async def check(self, flow, outcome, timeout, since):
+        path, digest = value(self.path, flow), value(self.digest, flow)
+        found = await digest_on_bmc(flow.ser, path, value(self.size, flow), value(self.seek, flow), timeout)
+        if found == digest:
+            flow.callback_output(f"Verified {path} (sha256 {digest[:16]}).")
+            return None
+        return f"{path} reads back {found or 'nothing'}, expected {digest}"
+
+
+def digest_command(path, size=None, seek=0):
+    """Shell command printing the SHA-256 of path, or of size bytes at seek (512-byte blocks) of a device"""
+    if size is None:
+        return f"sha256sum {path}"
+    return f"dd if={path} bs=512 skip={seek} count={-(-size // 512)} | head -c {size} | sha256sum"
+
+
+async def digest_on_bmc(ser, path, size=None, seek=0, timeout=60):
+    """SHA-256 as digest_command prints it, hashed on the BMC. None when it cannot be read."""
+    result = await ser.arun(digest_command(path, size, seek), timeout=timeout)
+    match = re.search(r"\b([0-9a-f]{64})\b", result.output)
+    return match.group(1) if result.ok and match else None
+
+
+# ---------- Actions ----------
+
+def send(command, leaves_shell=False):
+    """
+    Action that writes command (or command(flow)) to the console without
+    waiting; pair it with a Prompt or Stage probe. leaves_shell for
+    commands that reboot, so the session stops trusting its prompt.
+    """
+    async def action(flow):
+        flow.ser.reset_input_buffer()
+        flow.ser.write(value(command, flow))
+        if leaves_shell:
+            flow.ser.prompt = None
+            flow.ser.logged_in = False
+    return action
+
+
+def shell(command):
+    """Action that runs command (or command(flow)) at the shell; pair it with ExitCode"""
+    async def action(flow):
+        return await flow.ser.arun(value(command, flow), timeout=flow.remaining())
+    return action
+
+
+# ---------- Engine ----------
+
+@dataclass(frozen=True)
+class Step:
+    """
+    One declared step. span is the flow's progress before and after it;
+    when, a callable of the flow, skips the step if it returns False;
+    watch, a callable of the flow, returns a context manager held across
+    action and probe (a TransferProgress, say).
+    """
+    name: str
+    action: Optional[Callable] = None
+    probe: Optional[Probe] = None
+    timeout: float = 30
+    message: Optional[str] = None
+    span: Optional[Tuple[float, float]] = None
+    when: Optional[Callable] = None
+    watch: Optional[Callable] = None
+
+
+async def run(steps: Sequence[Step], flow: Flow):
+    """Runs steps in order on flow; raises StepError, or whatever an action raises"""
+    for step in steps:
+        if step.when is not None and not step.when(flow):
+            continue
+        if step.message:
+            flow.callback_output(step.message)
+        if step.span:
+            flow.callback_progress(step.span[0])
+        started = time.monotonic()
+        flow.deadline = started + step.timeout
+        with step.watch(flow) if step.watch else contextlib.nullcontext():
+            outcome = None
+            if step.action is not None:
+                try:
+                    outcome = await asyncio.wait_for(step.action(flow), step.timeout)
+                except asyncio.TimeoutError:
+                    raise StepError(step, f"did not finish within {step.timeout:.0f}s") from None
+            if step.probe is not None:
+                reason = await step.probe.check(flow, outcome, flow.remaining(), started)
+                if reason is not None:
+                    raise StepError(step, reason, outcome)
+        flow.results[step.name] = outcome
+        flow.timings[step.name] = time.monotonic() - started
+        if step.span:
+            flow.callback_progress(step.span[1])
+    flow.deadline = None
+    return flow
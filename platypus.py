@@ -5,12 +5,15 @@ import asyncio, glob, bmc, json, os, time, psutil, threading, subprocess
 import serial
 from utils import *
 from network import *
+from serial_session import aacquire_session, console_path, wait_for_stage, stage_of
+from boot_stage import LOGIN, ROOT_SHELL
+from serial_mux import console_command
+from artifact_store import default_store
+from flash_state import flash_state, STEP_EMMC, STEP_FIP, STEP_EEPROM
 from functools import partial
 from threading import Thread
 import tempfile
 import atexit
-from http.server import SimpleHTTPRequestHandler, HTTPServer
-import functools # <-- Import functools
 import subprocess
 import os
 import threading
@@ -270,81 +273,8 @@ temp_dir = tempfile.gettempdir()
 
 # --- DMI Flasher Utility Functions ---
 
-def read_serial_data_sync(ser, command, timeout=10, output_callback=None, eol=b'\n'):
-    """
-    Synchronous serial data reading function.
-    Sends a command, then reads until a prompt or timeout.
-    """
-    try:
-        ser.write(command)
-        if output_callback:
-            # Try to show the command, handling potential bytes/str issues
-            try:
-                cmd_str = command.decode('utf-8').strip()
-                if cmd_str:
-                    output_callback(f"# {cmd_str}")
-            except UnicodeDecodeError:
-                output_callback(f"# [sent {len(command)} bytes]")
-        
-        ser.flush()
-        
-        line_buffer = b""
-        full_response = b""
-        start_time = time.time()
-        
-        prompt_markers = [b'root@', b'# ', b'> '] # Common prompts
-        
-        while time.time() - start_time < timeout:
-            if ser.in_waiting > 0:
-                new_byte = ser.read(1)
-                if not new_byte:
-                    continue
-                
-                line_buffer += new_byte
-                full_response += new_byte
-                
-                # Check for end-of-line
-                if new_byte == eol:
-                    if output_callback:
-                        try:
-                            output_callback(line_buffer.decode('utf-8').strip())
-                        except UnicodeDecodeError:
-                            output_callback(f"[raw bytes: {line_buffer.hex()}]")
-                    line_buffer = b"" # Reset line buffer
-                
-                # Check for prompt
-                if any(marker in full_response for marker in prompt_markers):
-                    if output_callback and line_buffer:
-                        try:
-                            output_callback(line_buffer.decode('utf-8').strip())
-                        except UnicodeDecodeError:
-                             output_callback(f"[raw bytes: {line_buffer.hex()}]")
-                    return full_response.decode('utf-8', errors='ignore')
-
-            else:
-                time.sleep(0.05)
-        
-        # Timeout occurred
-        if output_callback:
-            output_callback(f"[Timeout after {timeout}s]")
-            if line_buffer:
-                try:
-                    output_callback(line_buffer.decode('utf-8').strip())
-                except UnicodeDecodeError:
-                     output_callback(f"[raw bytes: {line_buffer.hex()}]")
-        return full_response.decode('utf-8', errors='ignore')
-
-    except serial.SerialException as e:
-        if output_callback:
-            output_callback(f"Serial Error: {e}")
-        return f"Serial Error: {e}"
-    except Exception as e:
-        if output_callback:
-            output_callback(f"Error in read_serial_data: {e}")
-        return f"Error: {e}"
-
 def start_server_dmi(directory, port, callback_output):
-    """Starts a simple HTTP server in a separate thread."""
+    """Publishes directory on the artifact server for the DMI/FRU scripts."""
     global http_server
     with server_lock:
         if http_server:
@@ -352,16 +282,9 @@ def start_server_dmi(directory, port, callback_output):
             return http_server
         
         try:
-            # --- FIX ---
-            # Create a request handler that is bound to the target directory
-            # This avoids using os.chdir, which is thread-unsafe.
-            Handler = functools.partial(SimpleHTTPRequestHandler, directory=directory)
-            
-            http_server = HTTPServer(('0.0.0.0', port), Handler)
-            
-            threading.Thread(target=http_server.serve_forever, daemon=True).start()
-            callback_output(f"Serving files from {directory} on port {port}")
-            # No os.chdir or os.chdir back is needed
+            # The artifact daemon stays up between operations, so this only
+            # registers the directory instead of binding port 80 every time.
+            http_server = start_server(directory, port, callback_output)
             return http_server
         except Exception as e:
             callback_output(f"Failed to start server: {e}")
@@ -369,14 +292,12 @@ def start_server_dmi(directory, port, callback_output):
             return None
 
 def stop_server_dmi(callback_output):
-    """Stops the global HTTP server."""
+    """Withdraws the directory published by start_server_dmi."""
     global http_server
     with server_lock:
         if http_server:
             try:
-                http_server.shutdown()
-                http_server.server_close()
-                callback_output("Server has been stopped.")
+                stop_server(http_server, callback_output)
             except Exception as e:
                 callback_output(f"Error stopping server: {e}")
             finally:
@@ -386,12 +307,11 @@ def stop_server_dmi(callback_output):
             
 @atexit.register
 def cleanup_server_on_exit():
-    """Ensure server is stopped when the application exits."""
+    """Ensure nothing stays published when the application exits."""
     global http_server
     if http_server:
         print("Cleaning up HTTP server on exit...")
-        http_server.shutdown()
-        http_server.server_close()
+        http_server.stop()
 
 async def transfer_and_run_script(
     serial_device,
@@ -436,8 +356,7 @@ async def transfer_and_run_script(
         # 3. Open Serial Connection
         callback_progress(0.3)
         try:
-            ser = serial.Serial(serial_device, 115200, timeout=1)
-            ser.dtr = True
+            ser = await aacquire_session(serial_device, owner=script_name)
             callback_output(f"Serial connection open on {serial_device}")
         except serial.SerialException as e:
             callback_output(f"Failed to open serial port {serial_device}: {e}")
@@ -449,7 +368,7 @@ async def transfer_and_run_script(
         # 4. Transfer script to BMC using curl
         callback_progress(0.4)
         bmc_script_path = f"/tmp/{script_name}"
-        url = f"http://{host_ip}:{port}/{script_name}"
+        url = f"http://{host_ip}:{port}/{artifact_path(httpd, script_name)}"
         curl_command = f"curl -o {bmc_script_path} {url}\n".encode('utf-8')
         
         callback_output(f"Transferring script to BMC: {url} -> {bmc_script_path}")
@@ -480,9 +399,9 @@ async def transfer_and_run_script(
         callback_progress(0)
     finally:
         # 7. Clean up
-        if ser and ser.is_open:
-            ser.close()
-            callback_output("Serial connection closed.")
+        if ser:
+            ser.release()
+            callback_output("Serial connection released.")
         
         if httpd:
             stop_server_dmi(callback_output)
@@ -1193,6 +1112,10 @@ class PlatypusApp:
             """
             Execute the complete flash all sequence using the provided files.
             This method should be called from the FlashAllWindow.
+
+            Completed steps are checkpointed per unit (see flash_state), so a
+            rerun with the same files resumes at the first incomplete step
+            after checking that the earlier ones still hold on the device.
             """
             self.abort_requested = False
             self.log_message("=" * 50)
@@ -1201,8 +1124,10 @@ class PlatypusApp:
             self.lock_buttons = True
             
             # Determine total steps based on BMC type and if FRU flash is requested
-            total_steps = 5 if (bmc_type != 1 and eeprom_file and do_flash_fru) else 4
+            do_eeprom = bmc_type != 1 and eeprom_file and do_flash_fru
+            total_steps = 5 if do_eeprom else 4
             current_step = 0
+            unit = self.serial_device.get()
             
             # Step names for better logging
             step_names = {
@@ -1231,8 +1156,60 @@ class PlatypusApp:
                     overall_percent = int(overall_progress * 100)
                     if step_percent % 25 == 0 or step_percent in [10, 30, 50, 70, 90]:  # Log at key intervals
                         self.log_message(f"  Step {step_number}: {step_percent}% | Overall: {overall_percent}%")
+
+            def login_and_set_ip():
+                self.log_message("Logging in...")
+                result = asyncio.run(login(
+                    self.username.get(), 
+                    self.password.get(), 
+                    unit, 
+                    self.log_message
+                ))
+                if result != "Login successful.":
+                    raise Exception(f"Login failed: {result}")
+
+                self.log_message("Setting BMC IP...")
+                if not asyncio.run(set_ip(
+                    self.bmc_ip.get(), 
+                    lambda p: None, # Dummy callback to prevent progress bar jumping
+                    self.log_message, 
+                    unit
+                )):
+                    raise Exception("Setting the BMC IP failed")
             
             try:
+                # Digests of what each step writes; a checkpoint only counts for the same files
+                type_name = "mos-bmc" if self.bmc_type.get() == 1 else "nanobmc"
+                image = default_store.add(os.path.join(firmware_folder, f"obmc-phosphor-image-snuc-{type_name}.wic.xz"),
+                                          self.log_message)
+                bmap = default_store.add(os.path.join(firmware_folder, f"obmc-phosphor-image-snuc-{type_name}.wic.bmap"))
+                digests = {
+                    STEP_EMMC: f"{image.digest}-{bmap.digest}",
+                    STEP_FIP: default_store.add(fip_file).digest,
+                }
+                if do_eeprom:
+                    digests[STEP_EEPROM] = default_store.add(eeprom_file).digest
+
+                # Checkpoints follow the board, not the console it hangs off
+                identity = asyncio.run(bmc.unit_identity(self.log_message, unit))
+                if identity is None and asyncio.run(login(self.username.get(), self.password.get(), unit,
+                                                          self.log_message)) == "Login successful.":
+                    identity = asyncio.run(bmc.unit_identity(self.log_message, unit))
+                if identity is None:
+                    self.log_message("Could not read the unit's MAC address; not resuming or recording steps.")
+
+                def checkpoint(step):
+                    if identity:
+                        flash_state.mark(identity, step, digests[step])
+
+                def drop_checkpoint(step):
+                    if identity:
+                        flash_state.forget(identity, step)
+
+                done = flash_state.completed(identity, digests) if identity else []
+                if done:
+                    self.log_message(f"Resuming: {', '.join(done)} already done on unit {identity} with these files.")
+
                 # Step 1: Flash eMMC 
                 current_step = 1
                 step_name = step_names[current_step]
@@ -1241,21 +1218,39 @@ class PlatypusApp:
                 
                 def emmc_progress_callback(progress):
                     update_overall_progress(progress, current_step, step_name)
-                    
-                asyncio.run(bmc.flash_emmc2(
-                    self.bmc_ip.get(), 
-                    firmware_folder, 
-                    self.your_ip.get(), 
-                    self.bmc_type.get(), 
-                    emmc_progress_callback,
-                    self.log_message,
-                    self.serial_device.get()
-                ))
-                self.log_message("Running FRU Flash")
-                
-                time.sleep(35)
 
-                # Step 2: Flash U-Boot (FIP)
+                if STEP_EMMC not in done:
+                    flashed = asyncio.run(bmc.flash_emmc2(
+                        self.bmc_ip.get(), 
+                        firmware_folder, 
+                        self.your_ip.get(), 
+                        self.bmc_type.get(), 
+                        emmc_progress_callback,
+                        self.log_message,
+                        unit
+                    ))
+                    if not flashed:
+                        raise Exception("eMMC flash failed")
+                    checkpoint(STEP_EMMC)
+                    self.log_message("Running FRU Flash")
+                    
+                    # The rescue image stays up after bmaptool; make sure its shell is ready
+                    if not wait_for_stage(unit, ROOT_SHELL, 35):
+                        self.log_message("Rescue shell not confirmed, continuing anyway.")
+                else:
+                    # The recorded flash only counts if the eMMC still reads back as the image
+                    self.log_message("eMMC was flashed with this image, checking it on the device...")
+                    if not asyncio.run(bmc.boot_from_uboot(self.log_message, unit)):
+                        raise Exception("BMC did not reach a login prompt or shell")
+                    login_and_set_ip()
+                    if not asyncio.run(bmc.emmc_holds(self.bmc_ip.get(), firmware_folder, self.your_ip.get(),
+                                                      self.bmc_type.get(), self.log_message, unit)):
+                        drop_checkpoint(STEP_EMMC)
+                        raise Exception("eMMC does not hold the recorded image; the checkpoint was cleared, "
+                                        "run Flash All again from the U-Boot prompt")
+                    update_overall_progress(1.0, current_step, step_name)
+
+                # Step 2: Flash U-Boot (FIP); flasher skips the write if the FIP is already there
                 current_step = 2
                 step_name = step_names[current_step]
                 self.log_message(f"\n[STEP {current_step}/{total_steps}] {step_name.upper()}")
@@ -1264,51 +1259,46 @@ class PlatypusApp:
                 def fip_progress_callback(progress):
                     update_overall_progress(progress, current_step, step_name)
                     
-                asyncio.run(bmc.flasher(
+                flashed = asyncio.run(bmc.flasher(
                     fip_file, 
                     self.your_ip.get(), 
                     fip_progress_callback,
                     self.log_message, 
-                    self.serial_device.get()
+                    unit
                 ))
+                if not flashed:
+                    drop_checkpoint(STEP_FIP)
+                    raise Exception("U-Boot flash failed")
+                if STEP_FIP not in done:
+                    checkpoint(STEP_FIP)
                 
                 # Step 3: Flash EEPROM (if needed and requested)
-                if bmc_type != 1 and eeprom_file and do_flash_fru:
-                    
-                    # --- NEW REBOOT, LOGIN, & IP LOGIC ---
-                    self.log_message("Rebooting system before flashing EEPROM...")
-                    try:
-                        asyncio.run(bmc.reboot_bmc(
-                            self.log_message,
-                            self.serial_device.get()
-                        ))
-                    except Exception as reboot_err:
-                        self.log_message(f"Warning: Reboot command failed: {reboot_err}")
+                if do_eeprom:
                     
-                    self.log_message("Waiting 40 seconds for system to boot...")
-                    time.sleep(60)
-
-                    self.log_message("Logging in to prepare for EEPROM flash...")
-                    asyncio.run(login(
-                        self.username.get(), 
-                        self.password.get(), 
-                        self.serial_device.get(), 
-                        self.log_message
-                    ))
+                    # --- REBOOT OUT OF THE RESCUE IMAGE, LOGIN, & IP LOGIC ---
+                    # Whichever way the BMC got here; the EEPROM step needs the eMMC's image
+                    rescue = asyncio.run(bmc.in_rescue_image(self.log_message, unit))
+                    if rescue is None:
+                        self.log_message("Could not tell which image the BMC runs, rebooting it to be sure.")
+                    if rescue is not False:
+                        self.log_message("Rebooting system before flashing EEPROM...")
+                        rebooted_at = time.monotonic()
+                        try:
+                            asyncio.run(bmc.reboot_bmc(
+                                self.log_message,
+                                unit
+                            ))
+                        except Exception as reboot_err:
+                            self.log_message(f"Warning: Reboot command failed: {reboot_err}")
+                        
+                        self.log_message("Waiting for the system to boot...")
+                        stage = wait_for_stage(unit, (LOGIN, ROOT_SHELL), bmc.BOOT_TIMEOUT, since=rebooted_at)
+                        if stage is None:
+                            raise Exception(f"BMC did not come back within {bmc.BOOT_TIMEOUT}s after reboot")
+                        self.log_message(f"BMC reached the login prompt after {time.monotonic() - rebooted_at:.1f}s")
 
-                    self.log_message("Waiting 5 seconds before setting IP...")
-                    time.sleep(5)
-                    
-                    self.log_message("Setting BMC IP...")
-                    asyncio.run(set_ip(
-                        self.bmc_ip.get(), 
-                        lambda p: None, # Dummy callback to prevent progress bar jumping
-                        self.log_message, 
-                        self.serial_device.get()
-                    ))
+                        login_and_set_ip()
 
-                    self.log_message("Waiting 2 seconds before initiating EEPROM flash...")
-                    time.sleep(2)
                     # --------------------------------
 
                     current_step = 5
@@ -1319,19 +1309,24 @@ class PlatypusApp:
                     def eeprom_progress_callback(progress):
                         update_overall_progress(progress, current_step, step_name)
                         
-                    asyncio.run(bmc.flash_eeprom(
+                    flashed = asyncio.run(bmc.flash_eeprom(
                         eeprom_file, 
                         self.your_ip.get(), 
                         eeprom_progress_callback,
                         self.log_message, 
-                        self.serial_device.get()
+                        unit
                     ))
+                    if not flashed:
+                        drop_checkpoint(STEP_EEPROM)
+                        raise Exception("EEPROM flash failed")
+                    if STEP_EEPROM not in done:
+                        checkpoint(STEP_EEPROM)
                 elif bmc_type != 1:
                     self.log_message(f"\n[STEP 5/{total_steps}] Skipping EEPROM Flash (as requested).") 
                     try:
                         asyncio.run(bmc.reboot_bmc(
                             self.log_message,
-                            self.serial_device.get()
+                            unit
                         ))
                     except Exception as reboot_err:
                         self.log_message(f"Warning: Reboot command failed: {reboot_err}")
@@ -1353,6 +1348,7 @@ class PlatypusApp:
                 
             except Exception as e:
                 self.log_message(f"\n ERROR during Flash All sequence at Step {current_step}: {str(e)}")
+                self.log_message("Completed steps are kept; run Flash All again to resume.")
                 self.log_message("=" * 50)
                 # Reset progress on error
                 self.update_progress(0)
@@ -1445,66 +1441,6 @@ class PlatypusApp:
             pass
 
 
-    def force_close_port_80(self):
-        """
-        Force close any processes using port 80.
-        This is a more aggressive approach than cleanup_server_processes.
-        """
-        self.log_message("Forcibly closing any processes using port 80...")
-        try:
-            # Try using lsof command to find processes
-            try:
-                result = subprocess.run(
-                    ["lsof", "-i", ":80", "-t"], 
-                    capture_output=True, 
-                    text=True, 
-                    timeout=5
-                )
-                if result.returncode == 0 and result.stdout.strip():
-                    pids = result.stdout.strip().split('\n')
-                    for pid in pids:
-                        if pid:
-                            self.log_message(f"Killing process {pid} using port 80")
-                            subprocess.run(["kill", "-9", pid], timeout=2)
-            except (subprocess.SubprocessError, FileNotFoundError):
-                pass
-                
-            # Try using netstat command (alternative approach)
-            try:
-                result = subprocess.run(
-                    ["netstat", "-tulpn"], 
-                    capture_output=True, 
-                    text=True, 
-                    timeout=5
-                )
-                if result.returncode == 0:
-                    import re
-                    # Look for lines with :80 and extract PID
-                    pattern = r'tcp\s+.*:80\s+.*LISTEN\s+(\d+)/'
-                    matches = re.findall(pattern, result.stdout)
-                    for pid in matches:
-                        self.log_message(f"Killing process {pid} using port 80")
-                        subprocess.run(["kill", "-9", pid], timeout=2)
-            except (subprocess.SubprocessError, FileNotFoundError):
-                pass
-            
-            # Use psutil as another alternative
-            for proc in psutil.process_iter(['pid', 'name', 'connections']):
-                try:
-                    for conn in proc.info['connections']:
-                        if hasattr(conn, 'laddr') and hasattr(conn.laddr, 'port') and conn.laddr.port == 80:
-                            self.log_message(f"Killing process {proc.info['pid']} ({proc.info['name']}) using port 80")
-                            psutil.Process(proc.info['pid']).kill()
-                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess, KeyError, AttributeError):
-                    pass
-                    
-            self.log_message("Port 80 should now be available")
-        except Exception as e:
-            self.log_message(f"Error while closing port 80 processes: {e}")
-
-        # Give a brief pause to ensure processes are fully terminated
-        time.sleep(1)
-
     def save_config(self):
         """Save current configuration to file"""
         config = {
@@ -1556,7 +1492,6 @@ class PlatypusApp:
         
         # Clean up processes
         self.cleanup_minicom_processes()
-        self.force_close_port_80()
         self.cleanup_zombie_processes()
         
         # Stop DMI server if running
@@ -1592,6 +1527,11 @@ class PlatypusApp:
         
         ctk.CTkButton(device_frame, text="Refresh", command=self.refresh_devices, width=80, height=28).pack(side="right", padx=5)
 
+        # Live boot stage of the selected device
+        self.stage_label = ctk.CTkLabel(section, text="BMC stage: Not connected", font=ctk.CTkFont(size=12))
+        self.stage_label.pack(anchor="w", padx=15)
+        self.refresh_stage_label()
+
         # Credentials - made more compact using grid
         cred_frame = ctk.CTkFrame(section)
         cred_frame.pack(fill="x", padx=10, pady=2)
@@ -1640,6 +1580,19 @@ class PlatypusApp:
         ctk.CTkRadioButton(type_frame, text="MOS BMC", variable=self.bmc_type, value=1).pack(side="left", padx=10)
         ctk.CTkRadioButton(type_frame, text="Nano BMC", variable=self.bmc_type, value=2).pack(side="left")
 
+    def refresh_stage_label(self):
+        """Shows the boot stage of the selected serial device, refreshed twice a second"""
+        try:
+            tracker = stage_of(self.serial_device.get())
+            if tracker is None:
+                text = "BMC stage: Not connected"
+            else:
+                text = f"BMC stage: {tracker.label} ({tracker.since():.0f}s)"
+            self.stage_label.configure(text=text)
+            self.after(500, self.refresh_stage_label)
+        except tk.TclError:
+            pass  # window closed
+
     def create_main_flashing_tab(self, tab_frame):
         """Populates the main BMC Flashing tab with operations."""
         # We pass tab_frame to the original create methods
@@ -2105,11 +2058,20 @@ class PlatypusApp:
             
             # Clean up any existing minicom processes first
             self.cleanup_minicom_processes()
+
+            # Attach minicom to Platypus' console pty so it shares the port with the flows
+            try:
+                path = console_path(self.serial_device.get())
+                command = console_command(path)
+                self.log_message(f"Console mirrored on {path}")
+            except Exception as e:
+                self.log_message(f"Console pty unavailable ({e}), opening the device directly")
+                command = f"minicom -D {self.serial_device.get()}"
             
             # Try terminator first (as requested)
             try:
                 process = subprocess.Popen(
-                    ["terminator", "-e", f"minicom -D {self.serial_device.get()}"],
+                    ["terminator", "-e", command],
                     stdout=subprocess.DEVNULL,
                     stderr=subprocess.DEVNULL
                 )
@@ -2117,7 +2079,7 @@ class PlatypusApp:
             except Exception:
                 # Fall back to xterm if terminator fails
                 process = subprocess.Popen(
-                    ["xterm", "-e", f"minicom -D {self.serial_device.get()}"],
+                    ["xterm", "-e", command],
                     stdout=subprocess.DEVNULL,
                     stderr=subprocess.DEVNULL
                 )
@@ -2133,7 +2095,8 @@ class PlatypusApp:
                 if proc.info['name'] == 'minicom':
                     try:
                         cmdline = ' '.join(proc.info['cmdline'] or [])
-                        if self.serial_device.get() in cmdline:
+                        device = self.serial_device.get()
+                        if device in cmdline or f"platypus-{os.path.basename(device)}" in cmdline:
                             self.log_message(f"Terminating existing minicom process: {proc.info['pid']}")
                             proc.terminate()
                     except (psutil.NoSuchProcess, psutil.AccessDenied):
@@ -2207,58 +2170,6 @@ class PlatypusApp:
         finally:
             self.lock_buttons = False
 
-    def force_close_port_80(self):
-        """
-        Force close any processes using port 80 with better error handling.
-        """
-        self.log_message("Forcibly closing any processes using port 80...")
-        try:
-            # Method 1: Use lsof command
-            try:
-                result = subprocess.run(
-                    ["lsof", "-i", ":80", "-t"], 
-                    capture_output=True, 
-                    text=True, 
-                    timeout=10  # Add timeout
-                )
-                if result.returncode == 0 and result.stdout.strip():
-                    pids = result.stdout.strip().split('\n')
-                    for pid in pids:
-                        if pid and pid.isdigit():
-                            self.log_message(f"Killing process {pid} using port 80")
-                            try:
-                                subprocess.run(["kill", "-9", pid], timeout=5)
-                            except subprocess.TimeoutExpired:
-                                self.log_message(f"Timeout killing process {pid}")
-            except (subprocess.SubprocessError, subprocess.TimeoutExpired, FileNotFoundError):
-                pass
-            
-            # Method 2: Use psutil with better error handling
-            try:
-                for proc in psutil.process_iter(['pid', 'name', 'connections']):
-                    try:
-                        connections = proc.info.get('connections', [])
-                        if connections:
-                            for conn in connections:
-                                if (hasattr(conn, 'laddr') and 
-                                    hasattr(conn.laddr, 'port') and 
-                                    conn.laddr.port == 80):
-                                    self.log_message(f"Killing process {proc.info['pid']} ({proc.info['name']}) using port 80")
-                                    psutil.Process(proc.info['pid']).kill()
-                                    break
-                    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess, 
-                            KeyError, AttributeError, TypeError):
-                        pass
-            except Exception as e:
-                self.log_message(f"Error using psutil method: {e}")
-                
-            self.log_message("Port 80 cleanup completed")
-        except Exception as e:
-            self.log_message(f"Error while closing port 80 processes: {e}")
-
-        # Give a brief pause to ensure processes are fully terminated
-        time.sleep(1)
-    
     # --- DMI Flasher Operations ---
 
     def flash_fru(self):
@@ -2805,12 +2716,13 @@ class PlatypusApp:
     async def run_set_bmc_ip(self):
         """Run set BMC IP operation with Web UI hyperlink update"""
         try:
-            await set_ip(
+            if not await set_ip(
                 self.bmc_ip.get(), 
                 self.update_progress, 
                 self.log_message, 
                 self.serial_device.get()
-            )
+            ):
+                return
             
             # Add notification about Web UI after IP is set
             self.log_message(f"IP set successfully to {self.bmc_ip.get()}")
@@ -2858,7 +2770,7 @@ class PlatypusApp:
             except Exception:
                 pass
                 
-            # 2. Gracefully stop the HTTP server so port 80 is freed up
+            # 2. Withdraw anything the DMI tools published on the artifact server
             try:
                 stop_server_dmi(self.log_message)
             except Exception:
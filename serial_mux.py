@@ -0,0 +1,176 @@
+"""
+Fan-out of serial port traffic to more than one consumer.
+
+Each port is read exactly once, by the reactor. Every chunk goes to the
+flow-facing buffer in aserial.AsyncSerialPort and to any subscribers
+registered here: a LogSink that keeps a per-device capture on disk (and a
+transcript.TranscriptWriter with timestamps for both directions), and a
+PtyConsole that exposes the port as a local pseudo terminal so minicom (or
+any other terminal program) can stay attached while a flash is running
+without stealing bytes from it.
+"""
+
+import os
+import pty
+import threading
+import time
+import tty
+
+from utils import PromptScanner
+
+LOG_DIR = os.path.expanduser("~/.local/platypus/logs")
+TRANSCRIPT_DIR = os.path.expanduser("~/.local/platypus/transcripts")
+CONSOLE_LINK_PREFIX = "/tmp/platypus-"
+
+
+def device_name(device):
+    return os.path.basename(device) or "serial"
+
+
+class LogSink:
+    """Appends everything received on a port to a log file"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._file = open(path, "ab")
+
+    def __call__(self, data):
+        if self._file is None:
+            return
+        try:
+            self._file.write(data)
+            self._file.flush()
+        except OSError:
+            self.close()
+
+    def close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+
+class PtyConsole:
+    """
+    Local pseudo terminal mirroring one serial port.
+
+    Port output is copied to the pty and keystrokes typed into the pty are
+    written to the port, so a terminal program opened on `path` behaves as if
+    it were on the real device.
+    """
+
+    def __init__(self, port, device):
+        self.port = port
+        self.device = device
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.tty_name = os.ttyname(self.slave)
+        self.path = self._link(f"{CONSOLE_LINK_PREFIX}{device_name(device)}")
+        self.closed = False
+
+    def _link(self, link):
+        """Points a stable name at the pty so console commands stay the same across runs"""
+        try:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.tty_name, link)
+            return link
+        except OSError:
+            return self.tty_name
+
+    def start(self):
+        self.port.subscribe(self)
+        self.port.reactor.call(self.port.reactor.loop.add_reader, self.master, self._on_keys)
+        return self
+
+    def __call__(self, data):
+        """Port output: copy it to the pty, dropping it if nobody is reading"""
+        try:
+            os.write(self.master, data)
+        except (BlockingIOError, OSError):
+            pass
+
+    def _on_keys(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        if data:
+            try:
+                self.port.write(data)
+            except Exception:
+                pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.port.unsubscribe(self)
+        reactor = self.port.reactor
+        if reactor._loop is not None:
+            reactor.call(reactor._loop.remove_reader, self.master)
+        if self.path != self.tty_name:
+            try:
+                if os.readlink(self.path) == self.tty_name:
+                    os.unlink(self.path)
+            except OSError:
+                pass
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class AutoResponder:
+    """
+    Writes a reply the moment one of patterns shows up on a port.
+
+    It runs as a subscriber on the reactor thread, so the reply goes out in
+    the same callback that delivered the matching bytes, without waiting for
+    the flow's coroutine to be scheduled.
+    """
+
+    def __init__(self, port, patterns, reply):
+        self.port = port
+        self.reply = reply
+        self.scanner = PromptScanner(patterns)
+        self.armed_at = None
+        self.seen_at = None
+        self.sent_at = None
+        self.fired = threading.Event()
+
+    def start(self):
+        self.armed_at = time.monotonic()
+        self.port.subscribe(self)
+        return self
+
+    def stop(self):
+        self.port.unsubscribe(self)
+
+    def __call__(self, data):
+        if self.fired.is_set() or not self.scanner.feed(data):
+            return
+        self.seen_at = time.monotonic()
+        try:
+            self.port.write(self.reply)
+        finally:
+            self.sent_at = time.monotonic()
+            self.fired.set()
+            self.stop()
+
+    @property
+    def latency(self):
+        """Seconds between the pattern arriving and the reply being written"""
+        if self.sent_at is None:
+            return None
+        return self.sent_at - self.seen_at
+
+
+def console_command(path):
+    """minicom command line for a console pty (-o skips the modem init string)"""
+    return f"minicom -D {path} -o"
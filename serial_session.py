@@ -0,0 +1,567 @@
+"""
+Persistent serial sessions shared by every flow.
+
+One port is opened per device path and kept open between steps, so
+execute_flash_all and the multi-unit flasher no longer reopen the same tty
+five times per unit and lose whatever was buffered in between. Flows lease
+a session, use it like a pyserial port, and release it when done. A
+lease belongs to the asyncio task that took it (or the thread, outside an
+event loop), so flows sharing one loop still take turns on a port.
+
+Reads are served from an aserial.AsyncSerialPort buffer, so the same
+session works from plain threads (expect, read) and from coroutines
+(aexpect, aread) without parking a worker thread per read. The same bytes
+are also copied to a log file and, on request, to a console pty.
+"""
+
+import asyncio
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+import serial
+
+from aserial import AsyncSerialPort
+from boot_stage import BootStageTracker, UBOOT, LOGIN, ROOT_SHELL
+from serial_mux import LogSink, PtyConsole, LOG_DIR, TRANSCRIPT_DIR, device_name
+from transcript import TranscriptWriter, SUFFIX as TRANSCRIPT_SUFFIX, prune as prune_transcripts
+from utils import DEFAULT_PROMPTS, UBOOT_PROMPT, SHELL_PROMPT, LOGIN_PROMPT
+
+
+# Prompt state names tracked per session
+PROMPT_STATES = {
+    UBOOT_PROMPT: "uboot",
+    SHELL_PROMPT: "shell",
+    LOGIN_PROMPT: "login",
+}
+
+# Boot stage implied by each prompt state
+PROMPT_STAGES = {
+    "uboot": UBOOT,
+    "shell": ROOT_SHELL,
+    "login": LOGIN,
+}
+
+
+@dataclass
+class CommandResult:
+    """Result of a Linux shell command run over serial"""
+    command: str
+    output: str
+    exit_code: Optional[int]    # None if the command did not finish in time
+    elapsed: float
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0
+
+
+class CommandError(Exception):
+    """Raised by run/arun with check=True when a command fails or times out"""
+
+    def __init__(self, result):
+        self.result = result
+        if result.exit_code is None:
+            message = f"'{result.command}' did not finish after {result.elapsed:.0f}s"
+        else:
+            message = f"'{result.command}' failed with exit code {result.exit_code}"
+        super().__init__(message)
+
+
+def _wrap_command(command):
+    """Appends a unique end marker carrying $? to command"""
+    marker = f"__PLATYPUS_{uuid.uuid4().hex[:8]}__"
+    wrapped = f"{command.rstrip()}; echo {marker}:$?\n"
+    return marker, wrapped, re.compile(rf"{marker}:(\d+)")
+
+
+def _command_result(command, marker, result, elapsed):
+    output = result.output
+    if result.matched:
+        output = output[:len(output) - len(result.match)]
+    # Drop the echoed command line
+    echo = output.rfind(f"{marker}:$?")
+    if echo != -1:
+        newline = output.find("\n", echo)
+        output = output[newline + 1:] if newline != -1 else ""
+    exit_code = int(result.match.rsplit(":", 1)[1]) if result.matched else None
+    return CommandResult(command, output.strip(), exit_code, elapsed)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _lease_holder():
+    """Who a lease belongs to: the running asyncio task, else the calling thread"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return task if task is not None else threading.get_ident()
+
+
+class SerialSession:
+    """A single open serial port plus the prompt/login state seen on it"""
+
+    # Directories for per-device capture logs and binary transcripts, None to disable
+    log_dir = LOG_DIR
+    transcript_dir = TRANSCRIPT_DIR
+
+    def __init__(self, device, baudrate=115200, timeout=1):
+        self.device = device
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.ser = None
+        self.port = None
+        self.log_sink = None
+        self.transcript = None
+        self.console = None
+
+        # State carried across steps
+        self.prompt = None          # "uboot", "shell", "login" or None if unknown
+        self.logged_in = False
+        self.last_activity = 0.0
+        self.stages = BootStageTracker()
+
+        # Lease bookkeeping
+        self.owner = None
+        self._holder = None
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._waiters = []          # (loop, future) of coroutines in aacquire
+        self._open_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<SerialSession {self.device} prompt={self.prompt} owner={self.owner}>"
+
+    # ---------- Port lifecycle ----------
+
+    @property
+    def is_open(self):
+        return self.ser is not None and self.ser.is_open
+
+    def open(self):
+        """Opens the port if it is not open yet"""
+        with self._open_lock:
+            if not self.is_open:
+                self.ser = serial.Serial(self.device, baudrate=self.baudrate, timeout=self.timeout)
+                try:
+                    self.ser.dtr = True
+                except OSError:
+                    pass    # ptys (console mirrors, bmc_sim) have no modem lines
+                self.port = AsyncSerialPort(self.ser)
+                if self.log_dir:
+                    try:
+                        self.log_sink = LogSink(os.path.join(self.log_dir, f"{device_name(self.device)}.log"))
+                        self.port.subscribe(self.log_sink)
+                    except OSError:
+                        self.log_sink = None
+                if self.transcript_dir:
+                    self._start_transcript()
+                self.port.subscribe(self.stages)
+                self.port.start()
+                self.prompt = None
+                self.logged_in = False
+        return self
+
+    def _start_transcript(self):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.transcript_dir, f"{device_name(self.device)}-{stamp}{TRANSCRIPT_SUFFIX}")
+        try:
+            self.transcript = TranscriptWriter(path, self.device)
+        except OSError:
+            self.transcript = None
+            return
+        prune_transcripts(self.transcript_dir)
+        self.port.subscribe(self.transcript.received)
+        self.port.subscribe(self.transcript.sent, sent=True)
+
+    @contextmanager
+    def redacted(self):
+        """Within the block, what is written is kept out of the transcript (passwords)"""
+        writer = self.transcript
+        if writer is not None:
+            writer.redacting = True
+        try:
+            yield self
+        finally:
+            if writer is not None:
+                writer.redacting = False
+
+    def attach_console(self):
+        """Opens the port if needed and returns the path of a pty mirroring it"""
+        self.open()
+        if self.console is None:
+            self.console = PtyConsole(self.port, self.device).start()
+        return self.console.path
+
+    def detach_console(self):
+        if self.console is not None:
+            self.console.close()
+            self.console = None
+
+    def close(self):
+        """Really closes the port (only the registry should need this)"""
+        self.detach_console()
+        if self.log_sink is not None:
+            self.log_sink.close()
+            self.log_sink = None
+        if self.transcript is not None:
+            self.transcript.close()
+            self.transcript = None
+        if self.port is not None:
+            self.port.stop()
+            self.port = None
+        if self.ser is not None:
+            try:
+                if self.ser.is_open:
+                    self.ser.close()
+            except Exception:
+                pass
+        self.ser = None
+        self.prompt = None
+        self.logged_in = False
+
+    # ---------- Leasing ----------
+
+    def _take(self, me, owner):
+        self._holder = me
+        self._depth += 1
+        if owner:
+            self.owner = owner
+
+    def acquire(self, owner=None, timeout=None):
+        """
+        Leases the session to the calling task (or thread outside an event
+        loop), opening the port if needed. Blocks while another holder has
+        it; coroutines use aacquire so the loop keeps running meanwhile.
+        """
+        me = _lease_holder()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._holder not in (None, me):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise serial.SerialException(f"{self.device} is busy ({self.owner})")
+                self._cond.wait(remaining)
+            self._take(me, owner)
+        return self._open_leased()
+
+    async def aacquire(self, owner=None, timeout=None):
+        """Coroutine version of acquire: waits for the holder without blocking the event loop"""
+        me = _lease_holder()
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                if self._holder in (None, me):
+                    self._take(me, owner)
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise serial.SerialException(f"{self.device} is busy ({self.owner})")
+                future = loop.create_future()
+                waiter = (loop, future)
+                self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._cond:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+        return self._open_leased()
+
+    def _open_leased(self):
+        try:
+            return self.open()
+        except Exception:
+            self.release()
+            raise
+
+    def release(self):
+        """
+        Ends the lease. The port stays open for the next flow. Raises
+        RuntimeError if the caller does not hold the lease.
+        """
+        with self._cond:
+            if self._holder != _lease_holder():
+                raise RuntimeError(f"{self.device} released by a caller that does not hold it "
+                                   f"(held by {self.owner or 'nobody'})")
+            self._depth -= 1
+            if self._depth <= 0:
+                self._holder = None
+                self._depth = 0
+                self.owner = None
+                self._cond.notify_all()
+                for loop, future in self._waiters:
+                    loop.call_soon_threadsafe(_wake, future)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    # ---------- pyserial-compatible I/O ----------
+
+    @property
+    def in_waiting(self):
+        return self.port.in_waiting
+
+    @property
+    def dtr(self):
+        return self.ser.dtr
+
+    @dtr.setter
+    def dtr(self, value):
+        self.ser.dtr = value
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.last_activity = time.monotonic()
+        return self.port.write(data)
+
+    def read(self, size=1):
+        data = self.port.read(size, self.timeout)
+        if data:
+            self.last_activity = time.monotonic()
+        return data
+
+    def read_all(self):
+        return self.port.take()
+
+    def read_until(self, expected=b'\n', size=None):
+        return self.port.read_until(expected, size, self.timeout)
+
+    def reset_input_buffer(self):
+        self.port.reset_input_buffer()
+
+    def flush(self):
+        self.ser.flush()
+
+    # ---------- Prompt tracking ----------
+
+    def expect(self, patterns=DEFAULT_PROMPTS, timeout=10, idle_timeout=None):
+        """Waits for one of patterns, remembering which prompt was seen"""
+        result = self.port.expect(patterns, timeout=timeout, idle_timeout=idle_timeout)
+        self.note_prompt(result.pattern)
+        return result
+
+    def send_and_expect(self, command, patterns=DEFAULT_PROMPTS, timeout=10, idle_timeout=None):
+        """Sends command and waits for one of patterns"""
+        self.reset_input_buffer()
+        self.write(command)
+        return self.expect(patterns, timeout=timeout, idle_timeout=idle_timeout)
+
+    def run(self, command, timeout=30, idle_timeout=None, check=False):
+        """
+        Runs a Linux shell command and waits for its end marker.
+
+        Returns a CommandResult as soon as the command finishes, however long
+        that takes up to timeout.
+        """
+        marker, wrapped, pattern = _wrap_command(command)
+        started = time.monotonic()
+        result = self.send_and_expect(wrapped, (pattern,), timeout=timeout, idle_timeout=idle_timeout)
+        return self._finish_command(command, marker, result, started, check)
+
+    def _finish_command(self, command, marker, result, started, check, prompt="shell"):
+        command_result = _command_result(command, marker, result, time.monotonic() - started)
+        if command_result.exit_code is not None:
+            self.prompt = prompt
+            self.logged_in = prompt == "shell"
+            self.stages.set_stage(PROMPT_STAGES[prompt])
+        if check and not command_result.ok:
+            raise CommandError(command_result)
+        return command_result
+
+    # ---------- Coroutine I/O ----------
+
+    async def aread(self, size=1, timeout=None):
+        return await self.port.aread(size, self.timeout if timeout is None else timeout)
+
+    async def aread_until(self, expected=b'\n', timeout=None):
+        return await self.port.aread_until(expected, self.timeout if timeout is None else timeout)
+
+    async def aexpect(self, patterns=DEFAULT_PROMPTS, timeout=10, idle_timeout=None):
+        """Coroutine version of expect"""
+        result = await self.port.aexpect(patterns, timeout=timeout, idle_timeout=idle_timeout)
+        self.note_prompt(result.pattern)
+        return result
+
+    async def asend_and_expect(self, command, patterns=DEFAULT_PROMPTS, timeout=10, idle_timeout=None):
+        """Coroutine version of send_and_expect"""
+        self.reset_input_buffer()
+        self.write(command)
+        return await self.aexpect(patterns, timeout=timeout, idle_timeout=idle_timeout)
+
+    async def arun(self, command, timeout=30, idle_timeout=None, check=False):
+        """Coroutine version of run"""
+        marker, wrapped, pattern = _wrap_command(command)
+        started = time.monotonic()
+        result = await self.asend_and_expect(wrapped, (pattern,), timeout=timeout, idle_timeout=idle_timeout)
+        return self._finish_command(command, marker, result, started, check)
+
+    async def arun_uboot(self, command, timeout=30, idle_timeout=None, check=False):
+        """
+        arun for the U-Boot prompt, whose hush shell keeps $? as well. Waits
+        for the end marker rather than "=>", which U-Boot also prints inside
+        output (crc32 ... ==> 1a2b3c4d).
+        """
+        marker, wrapped, pattern = _wrap_command(command)
+        started = time.monotonic()
+        result = await self.asend_and_expect(wrapped, (pattern,), timeout=timeout, idle_timeout=idle_timeout)
+        return self._finish_command(command, marker, result, started, check, prompt="uboot")
+
+    # ---------- Boot stage ----------
+
+    @property
+    def stage(self):
+        return self.stages.stage
+
+    def wait_stage(self, stages, timeout, since=None):
+        """Blocks until the BMC reaches one of stages (see BootStageTracker.wait)"""
+        return self.stages.wait(stages, timeout, since)
+
+    async def await_stage(self, stages, timeout, since=None):
+        """Coroutine version of wait_stage"""
+        return await self.stages.await_stage(stages, timeout, since)
+
+    def note_prompt(self, pattern):
+        """Updates prompt and login state from a matched prompt pattern"""
+        state = PROMPT_STATES.get(pattern)
+        if state is None:
+            return
+        self.prompt = state
+        self.stages.set_stage(PROMPT_STAGES[state])
+        if state == "shell":
+            self.logged_in = True
+        elif state in ("login", "uboot"):
+            self.logged_in = False
+
+
+class SessionRegistry:
+    """Holds one SerialSession per device path"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._foreign = set()   # raw pyserial ports opened outside the registry
+        self._lock = threading.Lock()
+
+    def get(self, device, baudrate=115200):
+        """Returns the session for device, creating it if needed (the port is opened on acquire)"""
+        with self._lock:
+            session = self._sessions.get(device)
+            if session is None:
+                session = SerialSession(device, baudrate)
+                self._sessions[device] = session
+            return session
+
+    def find(self, device):
+        """Returns the session for device if one exists, without creating it"""
+        with self._lock:
+            return self._sessions.get(device)
+
+    def acquire(self, device, owner=None, timeout=None):
+        """Leases the session for device. Pair with session.release()."""
+        return self.get(device).acquire(owner, timeout)
+
+    async def aacquire(self, device, owner=None, timeout=None):
+        """Coroutine version of acquire"""
+        return await self.get(device).aacquire(owner, timeout)
+
+    def lease(self, device, owner=None, timeout=None):
+        """Context manager form of acquire"""
+        return self.acquire(device, owner, timeout)
+
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def adopt(self, ser):
+        """Tracks a raw port opened elsewhere so close_all can clean it up"""
+        if isinstance(ser, SerialSession):
+            return
+        with self._lock:
+            self._foreign.add(ser)
+
+    def close(self, device):
+        """Closes the port for device, e.g. before handing the tty to another program"""
+        with self._lock:
+            session = self._sessions.pop(device, None)
+        if session is not None:
+            session.close()
+
+    def detach_consoles(self):
+        """Closes every console pty, leaving the ports open. Returns how many were attached."""
+        detached = 0
+        for session in self.sessions():
+            if session.console is not None:
+                session.detach_console()
+                detached += 1
+        return detached
+
+    def close_all(self):
+        """Closes every open port. Returns how many were open."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            foreign = list(self._foreign)
+            self._sessions.clear()
+            self._foreign.clear()
+
+        closed = 0
+        for session in sessions:
+            if session.is_open:
+                session.close()
+                closed += 1
+        for ser in foreign:
+            try:
+                if hasattr(ser, 'is_open') and ser.is_open:
+                    ser.close()
+                    closed += 1
+            except Exception:
+                pass
+        return closed
+
+
+registry = SessionRegistry()
+
+
+def acquire_session(device, owner=None, timeout=None):
+    """Leases the shared session for device from the global registry"""
+    return registry.acquire(device, owner, timeout)
+
+
+async def aacquire_session(device, owner=None, timeout=None):
+    """Leases the shared session for device without blocking the event loop"""
+    return await registry.aacquire(device, owner, timeout)
+
+
+def stage_of(device):
+    """Current BootStageTracker for device, or None if the port has not been opened"""
+    session = registry.find(device)
+    if session is None or not session.is_open:
+        return None
+    return session.stages
+
+
+def wait_for_stage(device, stages, timeout, since=None):
+    """Blocks until device reaches one of stages. Opens the port if needed so the stream is watched."""
+    session = registry.get(device)
+    session.open()
+    return session.wait_stage(stages, timeout, since)
+
+
+def console_path(device):
+    """Returns a pty path a terminal program can open instead of device"""
+    return registry.get(device).attach_console()
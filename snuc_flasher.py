@@ -2,10 +2,11 @@ import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext, filedialog
 import subprocess
 import os
+import re
 import sys
 import threading
-import http.server
-import socketserver
+
+import artifact_daemon
 
 class SNUCFlasher(tk.Tk):
     def __init__(self):
@@ -141,6 +142,7 @@ class SNUCFlasher(tk.Tk):
             s.close()
         except:
             host_ip = "<YOUR_HOST_IP>"
+        self.host_ip = host_ip
 
         cmds = f"""# 1. SSH into the BMC.
 # 2. Download the script from this host:
@@ -227,25 +229,25 @@ chmod +x ./FRU_flash_v2.sh
 
     def toggle_http_server(self):
         if self.http_server_process is None:
-            # Start server
-             # Note: Port 80 requires sudo. If the GUI isn't run with sudo, this fails.
-             # We'll try a high port if 80 fails, or assume user ran GUI with sudo.
+            # Start server: publish the working directory on the shared artifact
+            # server, which is started on first use (port 80 needs sudo then).
             try:
-                handler = http.server.SimpleHTTPRequestHandler
-                self.httpd = socketserver.TCPServer(("", 80), handler)
-                self.server_thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
-                self.server_thread.start()
+                self.httpd = artifact_daemon.register(os.getcwd(), 80)
                 self.http_server_process = True
                 self.server_btn_var.set("STOP HTTP Server")
-                self.log("HTTP Server started on Port 80.")
-            except PermissionError:
-                 messagebox.showerror("Permission Error", "Cannot bind to Port 80. Please run this GUI with 'sudo' to use the HTTP feature, or use a different port manually.")
+                self.log(f"Serving {os.getcwd()} on port {self.httpd.port}.")
+                # The registration's own URL, not the root another registration's copy may shadow
+                url = self.httpd.url(self.host_ip) + "FRU_flash_v2.sh"
+                text = self.bmc_text.get("1.0", "end-1c")
+                self.bmc_text.delete("1.0", tk.END)
+                self.bmc_text.insert("1.0", re.sub(r"http://\S+/FRU_flash_v2\.sh", url, text))
+            except artifact_daemon.ArtifactDaemonError as e:
+                 messagebox.showerror("HTTP Server Error", f"Cannot start the artifact server: {e}\n\nPort 80 requires running this GUI with 'sudo'.")
             except Exception as e:
                  self.log(f"Error starting HTTP server: {e}")
         else:
             # Stop server
-            self.httpd.shutdown()
-            self.httpd.server_close()
+            self.httpd.stop()
             self.http_server_process = None
             self.server_btn_var.set("Start HTTP Server (Port 80)")
             self.log("HTTP Server stopped.")
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Read-only TFTP server for U-Boot image loads.
+
+U-Boot's TCP wget is slow and fragile on some boards; tftpboot is the
+loader every U-Boot has. Plain RFC 1350 TFTP is lock-step with 512-byte
+blocks, so this server also negotiates block size (RFC 2348), transfer
+size (RFC 2349), timeout (RFC 2349) and window size (RFC 7440): with
+tftpblocksize=1468 and tftpwindowsize=16 a 12 MB rescue image needs one
+round trip per 23 KB instead of one per 512 bytes.
+
+Each read request is answered from its own UDP socket (a new TID) on its
+own thread. Files come from a resolve callable, normally the artifact
+server's mounts, and transfers are published to artifact_server.transfers
+like HTTP downloads.
+
+fetch() is a matching client, used by the simulator and the benchmark.
+
+Usage:
+    python tftp_server.py DIRECTORY [--port 69]
+"""
+
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+
+import artifact_server
+
+TFTP_PORT = 69
+# Options U-Boot is told to ask for (setenv tftpblocksize / tftpwindowsize).
+# 1468 keeps every DATA packet inside a 1500-byte Ethernet frame.
+BLKSIZE = 1468
+WINDOWSIZE = 16
+DEFAULT_BLKSIZE = 512
+DEFAULT_TIMEOUT = 1.0
+MAX_RETRIES = 5
+
+RRQ, WRQ, DATA, ACK, ERROR, OACK = 1, 2, 3, 4, 5, 6
+# Error codes
+NOT_DEFINED, FILE_NOT_FOUND, ACCESS_VIOLATION, ILLEGAL_OPERATION, OPTION_REFUSED = 0, 1, 2, 4, 8
+
+_OPCODE = struct.Struct("!H")
+_BLOCK = struct.Struct("!HH")
+
+
+class TftpError(Exception):
+    """A transfer was refused or gave up"""
+
+
+def _error_packet(code, message):
+    return _BLOCK.pack(ERROR, code) + message.encode() + b"\0"
+
+
+def _parse_request(packet):
+    """Returns (filename, mode, {option: value}) of an RRQ/WRQ packet"""
+    fields = packet[2:].split(b"\0")
+    if len(fields) < 3:
+        raise ValueError("truncated request")
+    filename, mode = fields[0].decode(errors="replace"), fields[1].decode(errors="replace").lower()
+    options = {}
+    for index in range(2, len(fields) - 1, 2):
+        if fields[index]:
+            options[fields[index].decode(errors="replace").lower()] = fields[index + 1].decode(errors="replace")
+    return filename, mode, options
+
+
+def _negotiate(options, size):
+    """Accepted options as {name: value} for the OACK, per RFC 2348/2349/7440"""
+    accepted = {}
+    try:
+        if "blksize" in options:
+            accepted["blksize"] = max(8, min(int(options["blksize"]), 65464))
+        if "windowsize" in options:
+            accepted["windowsize"] = max(1, min(int(options["windowsize"]), 65535))
+        if "timeout" in options and 1 <= int(options["timeout"]) <= 255:
+            accepted["timeout"] = int(options["timeout"])
+        if "tsize" in options:
+            accepted["tsize"] = size
+    except ValueError:
+        pass
+    return accepted
+
+
+class TftpServer:
+    """Serves files returned by resolve(filename) to TFTP read requests"""
+
+    def __init__(self, resolve, port=TFTP_PORT, host="0.0.0.0", callback_output=None):
+        self.resolve = resolve
+        self.host = host
+        self.callback_output = callback_output
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.5)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def log(self, message):
+        if self.callback_output:
+            self.callback_output(message)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, name=f"tftp-{self.port}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        self.sock.close()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                packet, client = self.sock.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if len(packet) < 2:
+                continue
+            opcode = _OPCODE.unpack_from(packet)[0]
+            if opcode not in (RRQ, WRQ):
+                continue
+            threading.Thread(target=self._session, args=(opcode, packet, client),
+                             name=f"tftp-{client[0]}", daemon=True).start()
+
+    def _session(self, opcode, packet, client):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        filename = ""
+        try:
+            sock.bind((self.host, 0))
+            sock.connect(client)
+            if opcode == WRQ:
+                sock.send(_error_packet(ACCESS_VIOLATION, "read-only server"))
+                return
+            try:
+                filename, mode, options = _parse_request(packet)
+            except ValueError:
+                sock.send(_error_packet(ILLEGAL_OPERATION, "malformed request"))
+                return
+            if mode != "octet":
+                sock.send(_error_packet(ILLEGAL_OPERATION, "only octet mode is supported"))
+                return
+            path = self.resolve(filename)
+            if not path or not os.path.isfile(path):
+                sock.send(_error_packet(FILE_NOT_FOUND, "file not found"))
+                return
+            with open(path, "rb") as f:
+                self._send_file(sock, client, filename, f.fileno(), os.fstat(f.fileno()).st_size, options)
+        except TftpError as e:
+            self.log(f"TFTP {client[0]} {filename}: {e}")
+        except OSError as e:
+            self.log(f"TFTP {client[0]}: {e}")
+        finally:
+            sock.close()
+
+    def _send_file(self, sock, client, filename, fd, size, options):
+        accepted = _negotiate(options, size)
+        blksize = accepted.get("blksize", DEFAULT_BLKSIZE)
+        windowsize = accepted.get("windowsize", 1)
+        sock.settimeout(accepted.get("timeout", DEFAULT_TIMEOUT))
+
+        if accepted:
+            oack = _OPCODE.pack(OACK) + b"".join(f"{k}\0{v}\0".encode() for k, v in accepted.items())
+            self._exchange(sock, [oack], 0, 0)
+
+        transfer = artifact_server.Transfer(client[0], "/" + filename.lstrip("/"), size, 0, size)
+        artifact_server.transfers.begin(transfer)
+        try:
+            last = size // blksize + 1      # a file that fills its last block ends with an empty one
+            base = 1
+            while base <= last:
+                end = min(base + windowsize - 1, last)
+                packets = [_BLOCK.pack(DATA, block & 0xFFFF) + os.pread(fd, blksize, (block - 1) * blksize)
+                           for block in range(base, end + 1)]
+                acked = self._exchange(sock, packets, base - 1, end)
+                sent = min(acked * blksize, size) - transfer.sent
+                if sent > 0:
+                    artifact_server.transfers.advance(transfer, sent)
+                base = acked + 1
+        finally:
+            artifact_server.transfers.end(transfer)
+
+    def _exchange(self, sock, packets, low, high):
+        """
+        Sends packets and waits for an ACK of a block in low..high (absolute
+        numbers; the wire carries them modulo 65536). Retransmits on timeout.
+        Returns the acknowledged block; an ACK of low means nothing new
+        arrived and the caller resends from there.
+        """
+        timeout = sock.gettimeout()
+        for _ in range(MAX_RETRIES):
+            for packet in packets:
+                sock.send(packet)
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                sock.settimeout(remaining)
+                try:
+                    reply = sock.recv(1024)
+                except socket.timeout:
+                    break
+                finally:
+                    sock.settimeout(timeout)
+                if len(reply) < 4:
+                    continue
+                opcode, number = _BLOCK.unpack_from(reply)
+                if opcode == ERROR:
+                    message = reply[4:].rstrip(b"\0").decode(errors="replace")
+                    raise TftpError(f"client error {number}: {message}")
+                if opcode != ACK:
+                    continue
+                for block in range(high, low - 1, -1):
+                    if block & 0xFFFF == number:
+                        return block
+        raise TftpError(f"no acknowledgement after {MAX_RETRIES} tries")
+
+
+def fetch(host, filename, port=TFTP_PORT, blksize=DEFAULT_BLKSIZE, windowsize=1, timeout=DEFAULT_TIMEOUT):
+    """Downloads filename and returns its bytes. Asks for blksize/windowsize when not the defaults."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # A whole window arrives back to back; don't let the kernel drop the tail of it
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, max(blksize, DEFAULT_BLKSIZE) * windowsize * 4)
+    sock.settimeout(timeout)
+    try:
+        options = {"tsize": 0}
+        if blksize != DEFAULT_BLKSIZE:
+            options["blksize"] = blksize
+        if windowsize != 1:
+            options["windowsize"] = windowsize
+        request = _OPCODE.pack(RRQ) + filename.encode() + b"\0octet\0" + \
+            b"".join(f"{k}\0{v}\0".encode() for k, v in options.items())
+        sock.sendto(request, (host, port))
+
+        blksize, windowsize = DEFAULT_BLKSIZE, 1
+        chunks = []
+        expected = 1
+        in_window = 0
+        server = None
+        retries = 0
+        while True:
+            try:
+                packet, address = sock.recvfrom(65536)
+            except socket.timeout:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    raise TftpError("timed out")
+                if server is None:
+                    sock.sendto(request, (host, port))
+                else:
+                    sock.sendto(_BLOCK.pack(ACK, (expected - 1) & 0xFFFF), server)
+                    in_window = 0
+                continue
+            if server is None:
+                server = address
+            elif address != server:
+                continue
+            opcode = _OPCODE.unpack_from(packet)[0]
+            if opcode == ERROR:
+                raise TftpError(packet[4:].rstrip(b"\0").decode(errors="replace"))
+            if opcode == OACK and expected == 1:
+                _, _, accepted = _parse_request(b"\0\0\0\0" + packet[2:])   # empty filename and mode
+                blksize = int(accepted.get("blksize", DEFAULT_BLKSIZE))
+                windowsize = int(accepted.get("windowsize", 1))
+                sock.sendto(_BLOCK.pack(ACK, 0), server)
+                continue
+            if opcode != DATA:
+                continue
+            retries = 0
+            number = _BLOCK.unpack_from(packet)[1]
+            if number != expected & 0xFFFF:
+                # Lost or reordered block: acknowledge what we have so the window restarts there
+                if in_window:
+                    sock.sendto(_BLOCK.pack(ACK, (expected - 1) & 0xFFFF), server)
+                    in_window = 0
+                continue
+            data = packet[4:]
+            chunks.append(data)
+            expected += 1
+            in_window += 1
+            if len(data) < blksize:
+                sock.sendto(_BLOCK.pack(ACK, number), server)
+                return b"".join(chunks)
+            if in_window >= windowsize:
+                sock.sendto(_BLOCK.pack(ACK, number), server)
+                in_window = 0
+    finally:
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a directory over TFTP")
+    parser.add_argument("directory")
+    parser.add_argument("--port", type=int, default=TFTP_PORT)
+    args = parser.parse_args()
+    root = os.path.abspath(args.directory)
+
+    def resolve(filename):
+        path = os.path.normpath(os.path.join(root, filename.lstrip("/")))
+        return path if path.startswith(root + os.sep) else None
+
+    server = TftpServer(resolve, args.port, callback_output=print).start()
+    print(f"Serving {root} over TFTP on port {server.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Binary serial transcripts: record, inspect and replay.
+
+A transcript holds every chunk received from and sent to one port with a
+monotonic timestamp, so a capture of a real flash can be profiled after
+the fact or fed back through a pty to regression-test prompt detection.
+
+Sent bytes written while a session is redacted (the login password) are
+stored as asterisks, and only the newest KEEP transcripts are kept in a
+directory: prune drops the older ones when a new one starts.
+
+File layout (little endian):
+    header  b"PLTR" | u8 version | f64 wall-clock start | u16 name length | name
+    record  u8 direction (0 received, 1 sent) | u32 microseconds since the
+            previous record | u16 length | data
+
+Usage:
+    python transcript.py show FILE
+    python transcript.py profile FILE
+    python transcript.py replay FILE [--speed 10] [--follow-input]
+"""
+
+import argparse
+import glob
+import os
+import pty
+import re
+import select
+import struct
+import threading
+import time
+import tty
+
+MAGIC = b"PLTR"
+VERSION = 1
+RECEIVED = 0
+SENT = 1
+SUFFIX = ".ptr"
+# Transcripts kept per directory; older ones are deleted as new ones start
+KEEP = 50
+
+_HEADER = struct.Struct("<4sBdH")
+_RECORD = struct.Struct("<BIH")
+_MAX_DELTA = 0xFFFFFFFF
+_MAX_CHUNK = 0xFFFF
+
+
+class TranscriptWriter:
+    """Appends timestamped records for one port. Safe to call from several threads."""
+
+    def __init__(self, path, device):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._file = open(path, "wb")
+        name = device.encode("utf-8")[:_MAX_CHUNK]
+        self._file.write(_HEADER.pack(MAGIC, VERSION, time.time(), len(name)) + name)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self.redacting = False      # record sent bytes as asterisks (see SerialSession.redacted)
+
+    def received(self, data):
+        self._record(RECEIVED, data)
+
+    def sent(self, data):
+        if self.redacting:
+            # Keep line ends so commands() still splits the sends
+            data = re.sub(rb"[^\r\n]", b"*", data)
+        self._record(SENT, data)
+
+    def _record(self, direction, data):
+        with self._lock:
+            if self._file is None:
+                return
+            now = time.monotonic()
+            delta = int((now - self._last) * 1_000_000)
+            self._last = now
+            try:
+                while delta > _MAX_DELTA:
+                    self._file.write(_RECORD.pack(direction, _MAX_DELTA, 0))
+                    delta -= _MAX_DELTA
+                for offset in range(0, max(len(data), 1), _MAX_CHUNK):
+                    chunk = data[offset:offset + _MAX_CHUNK]
+                    self._file.write(_RECORD.pack(direction, delta, len(chunk)) + chunk)
+                    delta = 0
+                self._file.flush()
+            except (OSError, ValueError):
+                self._file = None
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                try:
+                    self._file.close()
+                except OSError:
+                    pass
+                self._file = None
+
+
+def prune(directory, keep=KEEP):
+    """Deletes all but the keep most recently written transcripts in directory"""
+    paths = sorted(glob.glob(os.path.join(directory, "*" + SUFFIX)), key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Transcript:
+    """A transcript loaded from disk: device, start time and (seconds, direction, data) records"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            blob = f.read()
+        magic, version, self.started, name_length = _HEADER.unpack_from(blob, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a Platypus transcript")
+        offset = _HEADER.size
+        self.device = blob[offset:offset + name_length].decode("utf-8", errors="replace")
+        offset += name_length
+
+        self.records = []
+        clock = 0.0
+        while offset + _RECORD.size <= len(blob):
+            direction, delta, length = _RECORD.unpack_from(blob, offset)
+            offset += _RECORD.size
+            data = blob[offset:offset + length]
+            offset += length
+            clock += delta / 1_000_000
+            if data:
+                self.records.append((clock, direction, data))
+
+    @property
+    def duration(self):
+        return self.records[-1][0] if self.records else 0.0
+
+    def commands(self):
+        """
+        Groups the transcript by what was sent. Returns (start, duration, sent
+        text, bytes received) per command, where duration runs until the next
+        send, i.e. how long the flow waited on that step.
+        """
+        steps = []
+        current = None
+        for clock, direction, data in self.records:
+            if direction == SENT:
+                if current is not None and not current[2].endswith("\n"):
+                    current[2] += data.decode("utf-8", errors="replace")
+                    continue
+                if current is not None:
+                    steps.append(current)
+                current = [clock, 0.0, data.decode("utf-8", errors="replace"), 0]
+            elif current is not None:
+                current[3] += len(data)
+        if current is not None:
+            steps.append(current)
+        for index, step in enumerate(steps):
+            end = steps[index + 1][0] if index + 1 < len(steps) else self.duration
+            step[1] = end - step[0]
+        return [tuple(step) for step in steps]
+
+
+class Replayer:
+    """
+    Plays the received side of a transcript through a pty.
+
+    With follow_input, playback pauses at every recorded send until the
+    client writes something, so a flow run against the replay stays in step
+    with the capture however fast or slow it is.
+    """
+
+    def __init__(self, transcript, speed=1.0, follow_input=False):
+        self.transcript = transcript
+        self.speed = speed
+        self.follow_input = follow_input
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.play, name="transcript-replay", daemon=True)
+        self._thread.start()
+        return self
+
+    def _wait_input(self, timeout):
+        ready, _, _ = select.select([self.master], [], [], timeout)
+        if ready:
+            try:
+                os.read(self.master, 4096)
+            except OSError:
+                pass
+            return True
+        return False
+
+    def play(self):
+        previous = 0.0
+        try:
+            for clock, direction, data in self.transcript.records:
+                gap = (clock - previous) / self.speed if self.speed > 0 else 0
+                previous = clock
+                if direction == SENT:
+                    if self.follow_input:
+                        while not self._wait_input(1.0):
+                            pass
+                    continue
+                if gap > 0:
+                    # Keep draining client input so its writes never block
+                    deadline = time.monotonic() + gap
+                    while (remaining := deadline - time.monotonic()) > 0:
+                        if not self.follow_input:
+                            self._wait_input(remaining)
+                        else:
+                            time.sleep(remaining)
+                os.write(self.master, data)
+        except OSError:
+            pass
+        finally:
+            self.done.set()
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _show(transcript):
+    print(f"{transcript.device}, started {time.ctime(transcript.started)}, "
+          f"{transcript.duration:.3f} s, {len(transcript.records)} records")
+    for clock, direction, data in transcript.records:
+        arrow = ">>" if direction == SENT else "<<"
+        print(f"{clock:10.6f} {arrow} {data!r}")
+
+
+def _profile(transcript, top):
+    steps = transcript.commands()
+    print(f"{transcript.device}: {len(steps)} commands over {transcript.duration:.1f} s")
+    print(f"{'start':>9} {'waited':>9} {'rx bytes':>9}  command")
+    for start, duration, text, received in sorted(steps, key=lambda s: s[1], reverse=True)[:top]:
+        print(f"{start:9.2f} {duration:9.2f} {received:9d}  {text.strip()[:70]!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay Platypus serial transcripts")
+    sub = parser.add_subparsers(dest="mode", required=True)
+    show = sub.add_parser("show", help="dump every record")
+    show.add_argument("file")
+    profile = sub.add_parser("profile", help="list the commands the flow waited on longest")
+    profile.add_argument("file")
+    profile.add_argument("--top", type=int, default=20)
+    replay = sub.add_parser("replay", help="play the received bytes back through a pty")
+    replay.add_argument("file")
+    replay.add_argument("--speed", type=float, default=1.0, help="playback speed, 0 = as fast as possible")
+    replay.add_argument("--follow-input", action="store_true",
+                        help="pause at each recorded command until the client sends something")
+    args = parser.parse_args()
+
+    transcript = Transcript(args.file)
+    if args.mode == "show":
+        _show(transcript)
+    elif args.mode == "profile":
+        _profile(transcript, args.top)
+    else:
+        replayer = Replayer(transcript, args.speed, args.follow_input).start()
+        print(f"Replaying {args.file} on {replayer.path}")
+        try:
+            replayer.done.wait()
+            print("Replay finished.")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            replayer.close()
+
+
+if __name__ == "__main__":
+    main()
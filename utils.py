@@ -1,67 +1,171 @@
+import re
 import time
 import asyncio
 import serial
 import redfish
-import threading
-import weakref
+from dataclasses import dataclass
+from typing import Optional
 
 
-# Global set to track serial connections - initialized properly
-_serial_connections = set()
+# Prompts the BMC prints when it is ready for the next command
+UBOOT_PROMPT = "=>"
+SHELL_PROMPT = "root@"
+LOGIN_PROMPT = "login:"
+PASSWORD_PROMPT = "Password:"
+DEFAULT_PROMPTS = (UBOOT_PROMPT, SHELL_PROMPT, LOGIN_PROMPT)
+
+# Banners U-Boot prints while counting down to autoboot
+AUTOBOOT_BANNERS = ("Hit any key to stop autoboot", "to abort autoboot", "to stop autoboot")
 
 
 def register_serial_connection(ser):
     """Register a serial connection for cleanup tracking"""
-    global _serial_connections
-    _serial_connections.add(ser)
+    from serial_session import registry
+    registry.adopt(ser)
 
 def cleanup_all_serial_connections():
-    """Clean up all registered serial connections"""
-    global _serial_connections
-    connections_cleaned = 0
-    for ser in list(_serial_connections):
-        try:
-            if hasattr(ser, 'is_open') and ser.is_open:
-                ser.close()
-                connections_cleaned += 1
-        except:
-            pass
-    _serial_connections.clear()  # Clear the set after cleanup
-    return connections_cleaned
-
-
-def read_serial_data(ser, command, delay):
-    """Improved serial data reading with better error handling and resource management"""
-    global _serial_connections
-    
-    try:
-        # Register this connection for tracking
-        register_serial_connection(ser)
-        
-        # Clear input buffer before sending command
-        if hasattr(ser, 'reset_input_buffer'):
-            ser.reset_input_buffer()
-        
+    """Close every serial port held by the session registry"""
+    from serial_session import registry
+    return registry.close_all()
+
+
+@dataclass
+class ExpectResult:
+    """Outcome of waiting for a prompt on a serial stream"""
+    output: str
+    pattern: Optional[str] = None   # pattern that matched, None if nothing did
+    match: str = ""                 # text that matched the pattern
+    reason: str = "timeout"         # "match", "timeout" or "idle"
+    elapsed: float = 0.0
+
+    @property
+    def matched(self) -> bool:
+        return self.pattern is not None
+
+
+class PromptScanner:
+    """
+    Incrementally scans a byte stream for prompts.
+
+    Plain strings are matched literally, compiled regexes (str or bytes) are
+    searched as-is. Only the newly received tail plus a small overlap is
+    rescanned on each feed, so long outputs stay linear.
+    """
+
+    REGEX_OVERLAP = 256
+
+    def __init__(self, patterns):
+        self.patterns = []
+        overlap = 0
+        for pattern in patterns:
+            if isinstance(pattern, re.Pattern):
+                regex = pattern
+                if isinstance(regex.pattern, str):
+                    regex = re.compile(regex.pattern.encode("utf-8"), regex.flags & ~re.UNICODE)
+                self.patterns.append((pattern.pattern, regex, None))
+                overlap = max(overlap, self.REGEX_OVERLAP)
+            else:
+                literal = pattern.encode("utf-8") if isinstance(pattern, str) else bytes(pattern)
+                label = pattern if isinstance(pattern, str) else pattern.decode("utf-8", errors="ignore")
+                self.patterns.append((label, None, literal))
+                overlap = max(overlap, len(literal) - 1)
+        self.overlap = overlap
+        self.buffer = bytearray()
+        self._scanned = 0
+
+    def feed(self, chunk):
+        """Adds chunk to the buffer and returns (label, start, end) of the earliest match, or None."""
+        self.buffer += chunk
+        start = max(0, self._scanned - self.overlap)
+        best = None
+        for label, regex, literal in self.patterns:
+            if regex is not None:
+                found = regex.search(self.buffer, start)
+                span = found.span() if found else None
+            else:
+                index = self.buffer.find(literal, start)
+                span = (index, index + len(literal)) if index != -1 else None
+            if span and (best is None or span[0] < best[1]):
+                best = (label, span[0], span[1])
+        self._scanned = len(self.buffer)
+        return best
+
+
+def expect(ser, patterns=DEFAULT_PROMPTS, timeout=10, idle_timeout=None, poll=0.05):
+    """
+    Reads from ser until one of patterns is seen.
+
+    Returns as soon as a pattern matches. Gives up after timeout seconds
+    overall, or after idle_timeout seconds without any new bytes.
+    """
+    scanner = PromptScanner(patterns)
+    start_time = time.monotonic()
+    last_data = start_time
+
+    while True:
+        now = time.monotonic()
+        if now - start_time >= timeout:
+            reason = "timeout"
+            break
+        if idle_timeout is not None and now - last_data >= idle_timeout:
+            reason = "idle"
+            break
+
+        waiting = ser.in_waiting
+        if not waiting:
+            time.sleep(poll)
+            continue
+
+        chunk = ser.read(waiting)
+        if not chunk:
+            continue
+        last_data = time.monotonic()
+
+        found = scanner.feed(chunk)
+        if found:
+            label, match_start, match_end = found
+            buffer = bytes(scanner.buffer)
+            return ExpectResult(
+                output=buffer.decode("utf-8", errors="ignore"),
+                pattern=label,
+                match=buffer[match_start:match_end].decode("utf-8", errors="ignore"),
+                reason="match",
+                elapsed=last_data - start_time,
+            )
+
+    return ExpectResult(
+        output=bytes(scanner.buffer).decode("utf-8", errors="ignore"),
+        reason=reason,
+        elapsed=time.monotonic() - start_time,
+    )
+
+
+def send_and_expect(ser, command, patterns=DEFAULT_PROMPTS, timeout=10, idle_timeout=None, delay=0):
+    """Sends command over ser and waits for one of patterns. Returns an ExpectResult."""
+    register_serial_connection(ser)
+
+    # Clear input buffer before sending command
+    if hasattr(ser, 'reset_input_buffer'):
+        ser.reset_input_buffer()
+
+    if delay:
         time.sleep(delay)
-        ser.write(command.encode('utf-8'))
-        time.sleep(2)  
-        
-        # Use read_all() with timeout handling
-        start_time = time.time()
-        response = b""
-        timeout = 10  # 10 second timeout
-        
-        while time.time() - start_time < timeout:
-            if ser.in_waiting:
-                chunk = ser.read(ser.in_waiting)
-                if chunk:
-                    response += chunk
-                else:
-                    break
-            time.sleep(0.1)
-        
-        return response.decode('utf-8', errors='ignore')
-        
+    ser.write(command.encode('utf-8'))
+    return expect(ser, patterns, timeout=timeout, idle_timeout=idle_timeout)
+
+
+def read_serial_data(ser, command, delay, prompts=DEFAULT_PROMPTS, timeout=10, idle_timeout=None):
+    """
+    Sends command and returns the response text.
+
+    Returns as soon as one of prompts shows up instead of always polling for
+    the full timeout. Pass prompts=() to read until timeout or idle_timeout.
+    """
+    try:
+        result = send_and_expect(ser, command, prompts, timeout=timeout,
+                                 idle_timeout=idle_timeout, delay=delay)
+        return result.output
+
     except serial.SerialTimeoutException:
         print("Serial timeout occurred")
         return ""
@@ -72,6 +176,80 @@ def read_serial_data(ser, command, delay):
         print(f"Error reading serial data: {e}")
         return ""
     
+def _emit_line(output_callback, line):
+    try:
+        output_callback(bytes(line).decode('utf-8').strip())
+    except UnicodeDecodeError:
+        output_callback(f"[raw bytes: {bytes(line).hex()}]")
+
+
+def read_serial_data_sync(ser, command, timeout=10, output_callback=None, eol=b'\n'):
+    """
+    Synchronous serial data reading function.
+    Sends a command, then reads until a prompt or timeout.
+
+    Reads whatever is waiting in one call and only scans the new bytes (plus
+    a marker-length overlap) for the prompt, so long outputs such as
+    bmaptool or frugy logs stay linear. output_callback gets one call per line.
+    """
+    try:
+        ser.write(command)
+        if output_callback:
+            # Try to show the command, handling potential bytes/str issues
+            try:
+                cmd_str = command.decode('utf-8').strip()
+                if cmd_str:
+                    output_callback(f"# {cmd_str}")
+            except UnicodeDecodeError:
+                output_callback(f"# [sent {len(command)} bytes]")
+        
+        ser.flush()
+        
+        prompt_markers = [b'root@', b'# ', b'> '] # Common prompts
+        scanner = PromptScanner(prompt_markers)
+        line_buffer = bytearray()
+        start_time = time.time()
+        
+        while time.time() - start_time < timeout:
+            waiting = ser.in_waiting
+            if waiting <= 0:
+                time.sleep(0.05)
+                continue
+
+            chunk = ser.read(waiting)
+            if not chunk:
+                continue
+
+            if output_callback:
+                line_buffer += chunk
+                if eol in chunk:
+                    *lines, rest = line_buffer.split(eol)
+                    for line in lines:
+                        _emit_line(output_callback, line)
+                    line_buffer = bytearray(rest)
+
+            # Check for prompt
+            if scanner.feed(chunk):
+                if output_callback and line_buffer:
+                    _emit_line(output_callback, line_buffer)
+                return bytes(scanner.buffer).decode('utf-8', errors='ignore')
+        
+        # Timeout occurred
+        if output_callback:
+            output_callback(f"[Timeout after {timeout}s]")
+            if line_buffer:
+                _emit_line(output_callback, line_buffer)
+        return bytes(scanner.buffer).decode('utf-8', errors='ignore')
+
+    except serial.SerialException as e:
+        if output_callback:
+            output_callback(f"Serial Error: {e}")
+        return f"Serial Error: {e}"
+    except Exception as e:
+        if output_callback:
+            output_callback(f"Error in read_serial_data: {e}")
+        return f"Error: {e}"
+
 # Continuously grabs that status of a redfish task 
 async def monitor_task(redfish_client, task_url, callback_output, callback_progress):
     while True:
@@ -94,10 +272,19 @@ async def monitor_task(redfish_client, task_url, callback_output, callback_progr
 
 async def login(bmc_user, bmc_pass, serial_device, callback_output):
     """Logs into the BMC using the serial device."""
+    from serial_session import aacquire_session
+
+    ser = None
     try:
         callback_output(f"Opening serial connection to {serial_device}...")
-        ser = serial.Serial(serial_device, baudrate=115200, timeout=1)
-        ser.dtr = True
+        ser = await aacquire_session(serial_device, owner="login")
+
+        # Skip the login sequence if this session is already at a root shell
+        if ser.logged_in:
+            result = await ser.asend_and_expect("\n", (SHELL_PROMPT, LOGIN_PROMPT), 2)
+            if result.pattern == SHELL_PROMPT:
+                callback_output("Already logged in.")
+                return "Login successful."
 
         user = f"{bmc_user}\n"
         passw = f"{bmc_pass}\n"
@@ -105,27 +292,31 @@ async def login(bmc_user, bmc_pass, serial_device, callback_output):
         # Send username
         callback_output("Sending username...")
         ser.write(user.encode("utf-8"))
-        await asyncio.sleep(1)
+        # The password goes out as soon as it is asked for
+        asked = await ser.aexpect((PASSWORD_PROMPT,), 5)
+        if not asked.matched:
+            callback_output("No password prompt seen, sending the password anyway.")
 
         # Send password
         callback_output("Sending password...")
-        ser.write(passw.encode("utf-8"))
-        await asyncio.sleep(1)
+        with ser.redacted():
+            ser.write(passw.encode("utf-8"))
 
         # Read response from the serial device
-        response = ser.read(1024).decode("utf-8").strip()
+        result = await ser.aexpect((SHELL_PROMPT, "Login incorrect", "login failed"), 3)
+        response = result.output.strip()
         if response:
             callback_output(f"Response from BMC: {response}")
         else:
             callback_output("No explicit response received from BMC.")
 
         # Determine login success
-        if "login failed" in response.lower():
-            ser.close()
+        if "login failed" in response.lower() or "login incorrect" in response.lower():
+            ser.logged_in = False
             return "Login failed. Check credentials."
 
         # If no failure detected, assume success
-        ser.close()
+        ser.logged_in = True
         return "Login successful."
     except serial.SerialException as e:
         callback_output(f"Serial error: {e}")
@@ -133,6 +324,9 @@ async def login(bmc_user, bmc_pass, serial_device, callback_output):
     except Exception as e:
         callback_output(f"Error during login: {e}")
         return "Login failed due to an unexpected error."
+    finally:
+        if ser:
+            ser.release()
     
 def create_serial_connection(device, baudrate=115200, timeout=5):
     """Create a serial connection with proper error handling and registration"""